@@ -43,7 +43,8 @@ setup(name = "MP3 Tools", version = "0.2",
         'src/repair-mp3',
         'src/test-mp3',
         'src/dump-id3',
-        'src/sanitize-mp3'
+        'src/sanitize-mp3',
+        'src/find-duplicate-mp3'
       ],
       packages = [
         'mp3', 'mp3.tests',
@@ -51,5 +52,9 @@ setup(name = "MP3 Tools", version = "0.2",
       ],
       package_dir = { '': 'src' },
       test_suite = 'mp3.tests.suite',
-      install_requires = install_requires
+      install_requires = install_requires,
+      extras_require = {
+        # mp3.FrameTable
+        'table': ['numpy'],
+      }
     )
@@ -1,7 +1,24 @@
 __all__ = ['id3tag', 'load']
 
+import re
+
+import ape
 import v1
-import neds_id3reader
+import v2
+
+# Bytes read from the beginning of a file, enough for the ID3v2 tags of
+# most files (unless they embed pictures in front of the text frames)
+_HEAD_SIZE = 64 * 1024
+# Bytes read from the end of a file, for the ID3v1 tag and an APE tag
+# in front of it
+_TAIL_SIZE = 4 * 1024
+
+# Strings Python decodes as UTF-8 (which includes plain ASCII)
+_UTF8 = re.compile(r'(?:[\x00-\x7f]|[\xc2-\xdf][\x80-\xbf]|\xe0[\xa0-\xbf][\x80-\xbf]|'
+    r'[\xe1-\xef][\x80-\xbf]{2}|\xf0[\x90-\xbf][\x80-\xbf]{2}|[\xf1-\xf3][\x80-\xbf]{3}|'
+    r'\xf4[\x80-\x8f][\x80-\xbf]{2})*\Z')
+# Track numbers int() takes
+_TRACK = re.compile(r'\s*[0-9]+\s*\Z')
 
 no_tag = {
     'title': None,
@@ -13,48 +30,108 @@ no_tag = {
     'genre': None,
 }
 
+def _read_ends(f):
+    """_read_ends(f) -> (head, tail)
+
+    Reads the beginning and the end of the file-like object f, in one read
+    if the file is small and in two otherwise.
+    """
+    f.seek(0, 2)
+    size = f.tell()
+    f.seek(0, 0)
+
+    if size <= _HEAD_SIZE + _TAIL_SIZE:
+        head = tail = f.read(size)
+    else:
+        head = f.read(_HEAD_SIZE)
+        f.seek(-_TAIL_SIZE, 2)
+        tail = f.read(_TAIL_SIZE)
+
+    f.seek(0, 0)
+    return head, tail
+
+def _v2tag(f, head):
+    if v2.tag_size(head) is None:
+        return None
+
+    tag = v2.parse(head, v2.FIELD_IDS, truncated = True)
+    if tag.truncated and None in v2.values(tag).values():
+        # The missing frames might be in the rest of the tag, e.g. behind
+        # a large picture
+        v2.resume(f, tag, v2.FIELD_IDS)
+        f.seek(0, 0)
+    return v2.values(tag)
+
+def _apetag(f, tail, end):
+    tag = ape.id3tag(tail, end)
+    if tag is not None or end < ape.FOOTER_SIZE:
+        return tag
+
+    size = ape.tag_size(tail[end - ape.FOOTER_SIZE:end])
+    if size is None:
+        return None
+
+    # The tag starts in front of the tail, read all of it
+    f.seek(0, 2)
+    start = f.tell() - (len(tail) - end) - size
+    if start < 0:
+        return None
+    f.seek(start, 0)
+    data = f.read(size)
+    f.seek(0, 0)
+    return ape.id3tag(data)
+
+def _track(value):
+    if isinstance(value, basestring) and _TRACK.match(value):
+        return int(value)
+    return 0
+
+def _decode(value):
+    if _UTF8.match(value):
+        return value.decode('utf-8')
+    return value.decode('iso-8859-1')
+
 def id3tag(f, **kwargs):
-    # Use Ned's ID3-reader to get basic tags
-    id3r = neds_id3reader.Reader(f)
-    tag = {
-        'album': id3r.getValue('album'),
-        'artist': id3r.getValue('performer'),
-        'title': id3r.getValue('title'),
-        'track': id3r.getValue('track'),
-        'year': id3r.getValue('year'),
-    }
+    """id3tag(f, **kwargs) -> dict
+
+    Reads the ID3v2, APE and ID3v1 tags of the file-like object f and
+    combines them; kwargs are defaults for values none of them has. The
+    first 64 KB and the last 4 KB of f are read, in one or two reads.
+    Tags larger than that take extra reads: an ID3v2 tag only if its
+    frames in the head don't have all values, from where the head ends on
+    (see v2.resume()), and an APE tag in one more read of the size its
+    footer gives.
+    """
+    # ID3v2 tags are at the beginning, ID3v1 and APE tags at the end
+    head, tail = _read_ends(f)
+
+    # Get basic tags from the ID3v2 tag
+    v2tag = _v2tag(f, head)
 
     # Use own ID3-reader to get genre and comment
-    v1tag = v1.id3tag(f)
+    v1tag = v1.parse(tail[-128:])
+    apetag = _apetag(f, tail, len(tail) - (v1tag and 128 or 0))
 
-    # Combine all the dicts
+    # Combine all the dicts, APE tags override ID3v1 tags and ID3v2 tags
+    # override both
     w = {}
     w.update(no_tag)
     w.update(kwargs)
     if v1tag:
         w.update(v1tag)
-    try:
-        tag['track'] = int(tag['track'])
-    except:
-        tag['track'] = 0
-    for k, v in tag.items():
-        if v:
-            w[k] = v
-    for k in w:
-        if not isinstance(w[k], str):
+    for tag in (apetag, v2tag):
+        if not tag:
             continue
-        if k == 'path':
-            break
-        for encoding in [None, 'utf-8', 'iso-8859-1']:
-            try:
-                w[k] = w[k].decode(encoding)
-                break
-            except:
-                pass
-        else:
-            w[k] = w[k].decode('ascii', 'replace')
+        tag['track'] = _track(tag['track'])
+        for k, v in tag.items():
+            if v:
+                w[k] = v
+    for k, v in w.items():
+        if k != 'path' and isinstance(v, str):
+            w[k] = _decode(v)
 
     return w
 
 def load(path, **kwargs):
-    return id3tag(open(path), path=path, **kwargs)
+    with open(path, 'rb') as f:
+        return id3tag(f, path=path, **kwargs)
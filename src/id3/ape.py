@@ -0,0 +1,90 @@
+#
+# id3.ape -- Python module for reading APEv1/v2 tags
+# Copyright (C) 2012  Lorenz Bauer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+__all__ = ['FOOTER_SIZE', 'id3tag', 'parse', 'tag_size']
+
+import struct
+
+FOOTER_SIZE = 32
+
+# Item keys (compared case-insensitively) of the values id3tag() returns
+_FIELDS = ('album', 'artist', 'comment', 'genre', 'title', 'track', 'year')
+
+def tag_size(footer):
+    """tag_size(footer) -> size or None
+
+    Returns the size of the APE tag (including its header and footer) that
+    ends with the 32 byte footer, or None if footer is not an APE footer.
+    """
+    if len(footer) != FOOTER_SIZE or footer[0:8] != 'APETAGEX':
+        return None
+
+    version, size, count, flags = struct.unpack_from('<IIII', footer, 8)
+    if version not in (1000, 2000):
+        return None
+    return size + (flags & 0x80000000 and FOOTER_SIZE or 0)
+
+def parse(data, end = None):
+    """parse(data, end = None) -> dict or None
+
+    Parses the APE tag whose footer ends at offset end (default: the end)
+    of data, returns its text items keyed by their lower case keys, or None
+    if there is no APE tag or data does not hold all of it.
+    """
+    if end is None:
+        end = len(data)
+
+    footer = data[end - FOOTER_SIZE:end]
+    if end < FOOTER_SIZE or tag_size(footer) is None:
+        return None
+
+    size, count = struct.unpack_from('<II', footer, 12)
+    offset = end - size
+    if offset < 0:
+        return None
+
+    items = {}
+    for i in xrange(count):
+        if offset + 8 > end - FOOTER_SIZE:
+            break
+        length, flags = struct.unpack_from('<II', data, offset)
+        key_end = data.find('\0', offset + 8, end - FOOTER_SIZE)
+        if key_end < 0 or key_end + 1 + length > end - FOOTER_SIZE:
+            break
+
+        key = data[offset + 8:key_end].lower()
+        offset = key_end + 1 + length
+        # Binary items and external links
+        if not flags & 0x6:
+            items[key] = data[key_end + 1:offset]
+
+    return items
+
+def id3tag(data, end = None):
+    """id3tag(data, end = None) -> dict or None
+
+    Like parse(), but only returns the values id3.id3tag() knows, as
+    (undecoded, UTF-8) strings.
+    """
+    items = parse(data, end)
+    if items is None:
+        return None
+
+    # APEv2 items can have several values, separated by zero bytes
+    return dict((key, items.get(key, '').split('\0')[0] or None) for key in _FIELDS)
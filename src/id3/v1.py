@@ -17,7 +17,7 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 #
 
-__all__ = ['id3tag']
+__all__ = ['id3tag', 'parse']
 
 import struct
 
@@ -155,6 +155,13 @@ def id3tag(f):
     tag = f.read(128)
     f.seek(0, 0)
 
+    return parse(tag)
+
+def parse(tag):
+    """parse(tag) -> dict or None
+
+    Parses a 128 byte ID3v1 tag, returns None if tag is none.
+    """
     if len(tag) != 128 or tag[0:3] != 'TAG':
         v = None
 
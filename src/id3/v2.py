@@ -1,23 +1,377 @@
 #
 # id3.v2 -- Python module for reading ID3 version 2 tags
 # Copyright (C) 2003-2004  Sune Kirkeby
-# 
+#
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
-# 
+#
 # This program is distributed in the hope that it will be useful,
 # but WITHOUT ANY WARRANTY; without even the implied warranty of
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
-# 
+#
 # You should have received a copy of the GNU General Public License
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 #
 
-__all__ = ['id3tag']
+__all__ = ['FIELD_IDS', 'Frame', 'Tag', 'id3tag', 'parse', 'read', 'resume', 'tag_size', \
+    'values']
+
+import struct
+import zlib
+
+from neds_id3reader import Id3Error
+
+# Text encodings, by the first byte of a text frame
+_ENCODINGS = ('iso-8859-1', 'utf-16', 'utf-16-be', 'utf-8')
+_HEADER_SIZE = 10
+# Bytes resume() reads at a time
+_RESUME_SIZE = 4096
+_VALID_ID_CHARS = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+
+# Frame ids of the values id3tag() returns, for ID3v2.3/4 and ID3v2.2
+_FIELDS = {
+    'album':  ('TALB', 'TAL'),
+    'artist': ('TPE1', 'TP1'),
+    'title':  ('TIT2', 'TT2'),
+    'track':  ('TRCK', 'TRK'),
+    'year':   ('TYER', 'TYE', 'TDRC'),
+}
+FIELD_IDS = frozenset(id for ids in _FIELDS.values() for id in ids)
+
+def _syncsafe(data, offset = 0):
+    b = struct.unpack_from('>4B', data, offset)
+    return (b[0] << 21) + (b[1] << 14) + (b[2] << 7) + b[3]
+
+def _resync(data):
+    """Undoes unsynchronisation, i.e. drops the 0x00 bytes stuffed after
+    every 0xff byte, in one pass."""
+    return data.replace('\xff\x00', '\xff')
+
+class Frame(object):
+    """A frame of an ID3v2 tag. Frames are windows into the tag, their
+    contents are only decoded when data or value is first asked for.
+
+    data holds the contents with unsynchronisation and compression undone.
+    value holds the text of text (T***) frames and the URL of link (W***)
+    frames, or a list of them if there are several; it is None for other
+    frames.
+    """
+
+    _data = None
+    _value = None
+    _interpreted = False
+
+    def __init__(self, id, flags, raw, version, tag_unsynchronized = False):
+        self.id = id
+        self.flags = flags
+        # Size of the frame's contents as stored in the tag
+        self.size = len(raw)
+        self._raw = raw
+        self._version = version
+        self._tag_unsynchronized = tag_unsynchronized
+
+    def __repr__(self):
+        return '<id3.v2.Frame %s, %d bytes>' % (self.id, self.size)
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = _frame_data(self._version, self.flags, self._raw, \
+                self._tag_unsynchronized)
+            self._raw = None
+        return self._data
+
+    @property
+    def value(self):
+        if not self._interpreted:
+            if self.id[0] in 'TW':
+                self._value = self._interpret()
+            self._interpreted = True
+        return self._value
+
+    def _interpret(self):
+        data = self.data
+        if not data:
+            return None
+
+        if self.id[0] == 'T':
+            encoding = ord(data[0])
+            # Unknown encodings are taken for the default one, latin-1
+            if encoding >= len(_ENCODINGS):
+                encoding = 0
+            value = data[1:].decode(_ENCODINGS[encoding], 'replace')
+            # Don't let trailing zero bytes fool you
+            value = value.strip(u'\0')
+            if u'\0' in value:
+                value = value.split(u'\0')
+            return value
+
+        value = data.strip('\0')
+        if self.id in ('WXXX', 'WXX'):
+            value = value.split('\0')
+        return value
+
+class Tag(object):
+    """An ID3v2 tag. frames maps frame ids to frames (the last one, if an
+    id occurs more than once), all_frames lists all of them in order.
+    truncated is True if the tag was cut off before its last frame, see
+    resume()."""
+
+    truncated = False
+    # Offset of the first frame left out of a truncated tag
+    _resume = None
+    # End of the frames and padding
+    _end = None
+
+    def __init__(self, version, revision, flags, size):
+        self.version = version
+        self.revision = revision
+        self.flags = flags
+        # Size of the whole tag, including the header and footer
+        self.size = size
+        self.frames = {}
+        self.all_frames = []
+
+    def value(self, *ids):
+        """value(*ids) -> value
+
+        Returns the value of the first frame among ids that has one, or
+        None.
+        """
+        for id in ids:
+            frame = self.frames.get(id)
+            if frame is not None and frame.value:
+                return frame.value
+        return None
+
+def tag_size(data):
+    """tag_size(data) -> size or None
+
+    Returns the size of the ID3v2 tag (including its header and footer)
+    whose 10 byte header data starts with, or None if data does not start
+    with an ID3v2 header.
+    """
+    if len(data) < _HEADER_SIZE or data[0:3] != 'ID3' or \
+        max(struct.unpack_from('>4B', data, 6)) & 0x80:
+        return None
+
+    size = _HEADER_SIZE + _syncsafe(data, 6)
+    if ord(data[3]) >= 4 and ord(data[5]) & 0x10:
+        # Footer
+        size += _HEADER_SIZE
+    return size
+
+def _frame_header(version, data, offset):
+    """_frame_header(version, data, offset) -> (id, size, flags, header size)"""
+    if version == 2:
+        id = data[offset:offset + 3]
+        b = struct.unpack_from('>3B', data, offset + 3)
+        return id, (b[0] << 16) + (b[1] << 8) + b[2], 0, 6
+
+    id = data[offset:offset + 4]
+    if version == 3:
+        size, flags = struct.unpack_from('>IH', data, offset + 4)
+    else:
+        size = _syncsafe(data, offset + 4)
+        flags, = struct.unpack_from('>H', data, offset + 8)
+    return id, size, flags, 10
+
+def _format_flags(version, flags):
+    """_format_flags(version, flags) -> (skip, compressed, encrypted, unsynchronized)
+
+    Tells what a frame's format flags say about its contents: the number
+    of bytes preceding them (e.g. a group id) and how they are stored.
+    """
+    if version == 3:
+        # Decompressed size, encryption method and group id
+        skip = (flags & 0x0080 and 4) + (flags & 0x0040 and 1) + (flags & 0x0020 and 1)
+        return skip, flags & 0x0080, flags & 0x0040, 0
+    elif version == 4:
+        # Group id, encryption method and data length indicator
+        skip = (flags & 0x0040 and 1) + (flags & 0x0004 and 1) + (flags & 0x0001 and 4)
+        return skip, flags & 0x0008, flags & 0x0004, flags & 0x0002
+    return 0, 0, 0, 0
+
+def _frame_data(version, flags, raw, tag_unsynchronized):
+    """Copies a frame's contents out of raw (a memoryview of the tag),
+    undoing unsynchronisation and compression."""
+    skip, compressed, encrypted, unsynchronized = _format_flags(version, flags)
+    data = raw[skip:].tobytes()
+
+    # Before ID3v2.4, unsynchronisation is undone for the whole tag at once
+    if version == 4 and (unsynchronized or tag_unsynchronized):
+        data = _resync(data)
+    if compressed:
+        try:
+            data = zlib.decompress(data)
+        except zlib.error, e:
+            raise Id3Error, 'Bad compressed frame: %s' % e
+    return data
+
+def parse(data, ids = None, truncated = False):
+    """parse(data, ids = None, truncated = False) -> Tag
+
+    Parses the ID3v2.2, 2.3 or 2.4 tag that data (a string) starts with.
+    data has to hold all of the tag, see tag_size(), unless truncated is
+    True: then the frames up to where data ends are parsed and, if any of
+    the others are needed, the tag is marked as truncated. If ids is given,
+    only frames with these ids are kept, the others are skipped. Encrypted
+    frames are always skipped.
+    """
+    size = tag_size(data)
+    if size is None:
+        raise Id3Error, 'Not an ID3v2 tag'
+
+    version, revision, flags = struct.unpack_from('>3B', data, 3)
+    if version not in (2, 3, 4):
+        raise Id3Error, 'Unsupported major version: %d' % version
+    complete = len(data) >= size
+    if not complete and not truncated:
+        raise Id3Error, 'Short read: (%d < %d)' % (len(data), size)
+
+    tag = Tag(version, revision, flags, size)
+    if version == 2 and flags & 0x40:
+        # "Since no compression scheme has been decided yet, the ID3
+        # decoder (for now) should just ignore the entire tag if the
+        # compression bit is set."
+        return tag
+
+    end = _HEADER_SIZE + _syncsafe(data, 6)
+    # Before ID3v2.4, unsynchronisation applies to the whole tag, sizes are
+    # those of the resynchronised data
+    if flags & 0x80 and version < 4:
+        data = data[:_HEADER_SIZE] + _resync(data[_HEADER_SIZE:end])
+        # Where a cut off tag ends after resynchronisation is not known
+        if complete:
+            end = len(data)
+
+    offset = _HEADER_SIZE
+    if version >= 3 and flags & 0x40:
+        # Extended header, not interpreted
+        if version == 3:
+            offset += 4 + struct.unpack_from('>I', data, offset)[0]
+        else:
+            offset += _syncsafe(data, offset)
+
+    tag._end = end
+    tag._resume = _parse_frames(tag, data, 0, offset, ids)
+    tag.truncated = tag._resume is not None
+    return tag
+
+def _parse_frames(tag, data, base, offset, ids):
+    """Adds the frames from offset on to tag, out of data, which holds the
+    tag from offset base on. Frames that are not in ids are skipped, even
+    if they go on past data. Returns the offset of the first frame that is
+    needed but not all in data, or None if the end of the tag is reached.
+    """
+    version, end = tag.version, tag._end
+    tag_unsynchronized = tag.flags & 0x80
+    frame_header_size = version == 2 and 6 or 10
+    available = min(end, base + len(data))
+    view = memoryview(data)
+
+    while offset + frame_header_size <= end:
+        if offset + frame_header_size > available:
+            return offset
+
+        id, frame_size, frame_flags, header_size = _frame_header(version, data, \
+            offset - base)
+        if not _VALID_ID_CHARS.issuperset(id):
+            # Padding
+            break
+
+        start = offset + header_size
+        frame_end = start + frame_size
+        if frame_end > end:
+            raise Id3Error, 'Long read (%s): (%d > %d)' % (id, frame_size, end - start)
+
+        if ids is not None and id not in ids or _format_flags(version, frame_flags)[2]:
+            offset = frame_end
+            continue
+        if frame_end > available:
+            return offset
+
+        frame = Frame(id, frame_flags, view[start - base:frame_end - base], version, \
+            tag_unsynchronized)
+        tag.frames[id] = frame
+        tag.all_frames.append(frame)
+        offset = frame_end
 
-def id3tag(f):
     return None
+
+def resume(f, tag, ids = None):
+    """resume(f, tag, ids = None) -> nothing
+
+    Adds the frames parse() left out of a truncated tag, reading them from
+    the file-like object f, which starts with the tag. Frames are read
+    from where the tag was cut off in chunks, frames not in ids are skipped
+    by seeking past them. If f ends early, the tag stays truncated.
+    """
+    if tag._resume is None:
+        return
+
+    if tag.flags & 0x80 and tag.version < 4:
+        # Offsets are those of the resynchronised tag, read all of it
+        f.seek(0, 0)
+        whole = parse(f.read(tag.size), ids, truncated = True)
+        tag.frames, tag.all_frames = whole.frames, whole.all_frames
+        tag.truncated, tag._resume = whole.truncated, whole._resume
+        return
+
+    offset, size = tag._resume, _RESUME_SIZE
+    while offset is not None:
+        f.seek(offset, 0)
+        data = f.read(size)
+        next_offset = _parse_frames(tag, data, offset, offset, ids)
+        if next_offset == offset:
+            if len(data) < size:
+                break
+            # A frame larger than a chunk
+            id, frame_size, frame_flags, header_size = _frame_header(tag.version, data, 0)
+            size = header_size + frame_size
+        else:
+            size = _RESUME_SIZE
+        offset = next_offset
+
+    tag._resume = offset
+    tag.truncated = offset is not None
+
+def read(f, ids = None):
+    """read(f, ids = None) -> Tag or None
+
+    Reads the ID3v2 tag at the current position of the file-like object f,
+    if there is one. After the header, all of the tag is read at once. See
+    parse() for ids.
+    """
+    header = f.read(_HEADER_SIZE)
+    size = tag_size(header)
+    if size is None:
+        return None
+
+    return parse(header + f.read(size - _HEADER_SIZE), ids)
+
+def id3tag(f):
+    f.seek(0, 0)
+    tag = read(f, FIELD_IDS)
+    f.seek(0, 0)
+
+    return values(tag)
+
+def values(tag):
+    """values(tag) -> dict or None
+
+    Returns the values id3tag() returns for tag, which has to hold the
+    frames in FIELD_IDS, or None if tag is None.
+    """
+    if tag is None:
+        return None
+
+    v = dict((name, tag.value(*ids)) for name, ids in _FIELDS.items())
+    if isinstance(v['year'], unicode):
+        # ID3v2.4 only has a recording time, yyyy-MM-ddTHH:mm:ss
+        v['year'] = v['year'][:4]
+    return v
@@ -25,17 +25,24 @@ raw frame-data and meta-data (such as frame bitrates)."""
 
 from __future__ import generators
 from collections import namedtuple
+from itertools import islice
 import struct
+import binascii
 from _bitpack import bitpack_into, formatstr as bitpack_formatstr, invalid_input_error
 from _crc16 import crc16
-from _buffer import ZeroCopyBuffer
+from _buffer import ZeroCopyBuffer, MappedBuffer, storage as _storage
 import os
+import re
 import math
+import hashlib
+import mmap
+from timeit import default_timer
 
-__all__ = ['APEFrame', 'Channelmode', 'Frame', 'Header', 'ID3Frame', 'MP3Error', \
-           'MP3FrameHeaderError', 'MPEGFrame', 'MetaFrame', 'RIFFFrame', 'Reader', \
-           'XingFrame', 'ZeroCopyBuffer', 'framedata', 'frameheader', 'framelen', \
-           'frames', 'good_data']
+__all__ = ['APEFrame', 'Channelmode', 'CompactHeader', 'Duration', 'Frame', 'FrameTable', \
+           'FrameWriter', 'Header', 'ID3Frame', 'MP3Error', 'MP3FrameHeaderError', 'MPEGFrame', \
+           'MappedBuffer', 'MetaFrame', 'Parser', 'RIFFFrame', 'Reader', 'ReaderStats', \
+           'VBRIFrame', 'XingFrame', 'ZeroCopyBuffer', 'audio_digest', 'coalesce', 'duration', \
+           'framedata', 'frameheader', 'framelen', 'frames', 'good_data']
 
 class MP3Error(Exception):
     """I signal a generic error related to MP3-data."""
@@ -49,6 +56,10 @@ class _InvalidFrame(Exception):
     """I signal that the parsing of the current frame type failed."""
     pass
 
+class _NeedMoreData(Exception):
+    """I signal that a Parser has to be fed more data before it can go on."""
+    pass
+
 class Channelmode:
     """Read-only convenience container for the different MPEG channel modes. See
     http://www.mp3-tech.org/programmer/frame_header.html for further information."""
@@ -58,6 +69,11 @@ class Frame(object):
     """Basic frame object, all other frametypes extend from this."""
     _buffer = None
     length = None
+    # Position of the frame in the stream it was read from
+    offset = None
+
+    # Bytes a frame of this type can start with
+    _FIRST_BYTES = ''
 
     @property
     def view(self):
@@ -85,18 +101,32 @@ class Frame(object):
         as the frames buffer is available."""
         pass
 
-    def append(self, buf):
-        """append(buf) -> nothing
+    def append(self, buf, share = False):
+        """append(buf, share = False) -> nothing
         
         Append data from buf to this frame, up to the frame's
-        length. Expects a ZeroCopyBuffer as input.
+        length. Expects a ZeroCopyBuffer as input. If buf is a
+        MappedBuffer, or if share is True and the frame fits into
+        buf, the frame's data is a window into buf instead of a copy.
         """
+        if isinstance(buf, MappedBuffer) or (share and self.length <= buf._size):
+            buf.fill(at_least = self.length)
+
+            self._buffer = buf.window(0, self.length)
+            buf.delete(self.length)
+            self._frame_assembled()
+            return
+
         self._buffer = ZeroCopyBuffer(self.length)
         buf.delete(self._buffer.extend(buf))
         
         if (len(self._buffer) < self.length):
             assert(len(buf) == 0)
+            missing = self.length - len(self._buffer)
+            self._buffer.stats = buf.stats
             self._buffer.fill(buf._fileobj, completely=True)
+            # The rest of the frame bypassed buf
+            buf._offset += missing
         
         assert(len(self._buffer) == self.length)
         self._frame_assembled()
@@ -108,6 +138,7 @@ class MetaFrame(Frame):
 class ID3Frame(MetaFrame):
     """Represents and ID3v1/2 frame (storing file meta-data)."""
     V1, V2 = range(2)
+    _FIRST_BYTES = 'TI'
 
     version = None
 
@@ -118,11 +149,15 @@ class ID3Frame(MetaFrame):
         elif buf.startswith('ID3', offset):
             self.version = self.V2
 
-            if len(buf) < 10:
-                raise MP3Error, 'need at least 10 bytes of data'
+            if len(buf) < offset + 10:
+                raise _InvalidFrame
+
+            # Major version and synchsafe size, to tell tags from garbage
+            size = [buf[offset + i] for i in xrange(6, 10)]
+            if not 2 <= buf[offset + 3] <= 4 or max(size) & 0x80:
+                raise _InvalidFrame
 
-            self.length = (buf[offset + 6] << 21) + (buf[offset + 7] << 14) + \
-                (buf[offset + 8] << 7) + (buf[offset + 9]) + 10
+            self.length = (size[0] << 21) + (size[1] << 14) + (size[2] << 7) + size[3] + 10
         else:
             raise _InvalidFrame
 
@@ -130,6 +165,7 @@ class APEFrame(MetaFrame):
     """Represents and APETAGv1/2 frame (storing file meta-data)."""
     V1, V2 = range(2)
     _HEADER_SIZE = 32
+    _FIRST_BYTES = 'A'
 
     version = None
 
@@ -139,12 +175,15 @@ class APEFrame(MetaFrame):
 
         version, length = buf.unpack('<II', offset + 8)
         if version == 2000: self.version = self.V2
-        elif version == 1000: self.version = self.CV1
+        elif version == 1000: self.version = self.V1
+        else: raise _InvalidFrame
 
         self.length = length + self._HEADER_SIZE
 
 class RIFFFrame(Frame):
     """Represents a RIFF frame (commonly used for compatibility with broken Windows players)."""
+    _FIRST_BYTES = 'Rdf'
+
     def __init__(self, buf, fileobj = None, offset = 0, strict = False):
         if buf.startswith('RIFF', offset) and buf.startswith('WAVE', offset + 8):
             if fileobj: fileobj._has_riff_header = True
@@ -172,6 +211,7 @@ class RIFFFrame(Frame):
 
 class MPEGFrame(Frame):
     header = None
+    _FIRST_BYTES = '\xff'
     
     """Represents an MPEG frame (storing raw audio data)."""
     def __init__(self, buf, fileobj = None, offset = 0, strict = False):
@@ -182,13 +222,12 @@ class MPEGFrame(Frame):
 
         self.header = header
 
-        version, layer = header.version, header.layer
         if strict and fileobj and \
-            ((fileobj._mpeg_version and version != fileobj._mpeg_version) or \
-            (fileobj._mpeg_layer and layer != fileobj._mpeg_layer)):
+            ((fileobj._mpeg_version and header.version != fileobj._mpeg_version) or \
+            (fileobj._mpeg_layer and header.layer != fileobj._mpeg_layer)):
             raise _InvalidFrame
 
-        self.length = self._calculate_length(header)
+        self.length = header._info.frame_length
 
     def _frame_assembled(self):
         self.header.update(self._buffer)
@@ -201,22 +240,7 @@ class MPEGFrame(Frame):
 
     @classmethod
     def _calculate_length(cls, header):
-        version, layer = header.version, header.layer
-        bitrate, samplingrate = header.bitrate, header.samplingrate
-        padding = header.padding
-
-        if version == 1:
-            if layer == 1:
-                mul, slot = 12, 4
-            else:
-                mul, slot = 144, 1
-        else:
-            if layer == 1:
-                mul, slot = 240, 4
-            else:
-                mul, slot = 72, 1
-
-        return ((mul * bitrate * 1000 / samplingrate) + (padding * slot)) * slot
+        return header.frame_length()
 
 class XingFrame(MPEGFrame):
     """Represents a Xing frame (storing VBR encoding information)."""
@@ -225,6 +249,12 @@ class XingFrame(MPEGFrame):
     
     _MIN_HEADER_SIZE = 4 + 4
 
+    encoder = None
+    encoder_delay = 0
+    encoder_padding = 0
+    # True for Info frames, which LAME writes instead for CBR streams
+    info = False
+
     def __init__(self, buf, fileobj = None, offset = 0, strict = False):
         if fileobj and fileobj._has_xing_header == False:
             raise _InvalidFrame
@@ -243,6 +273,8 @@ class XingFrame(MPEGFrame):
             buf.startswith('Info', offset + 2))):
 
             if fileobj: fileobj._has_xing_header = True
+            self.info = buf.startswith('Info', offset) or \
+                (header.crc and buf.startswith('Info', offset + 2))
 
             self.has_vbr_quality, self.has_toc, self.has_total_size, self.has_total_frames = \
                 [bool(buf[offset+7] & 1 << 3 - i) for i in xrange(4)]
@@ -282,6 +314,16 @@ class XingFrame(MPEGFrame):
             self.vbr_quality, = self._buffer.unpack('>I', offset)
             offset += 4
 
+        # LAME (and compatible encoders) put their own tag right after the
+        # Xing header, it tells how many samples to cut off for gapless
+        # playback.
+        if len(self._buffer) >= offset + 24 and \
+            (self._buffer.startswith('LAME', offset) or self._buffer.startswith('Lavc', offset)):
+            self.encoder = str(self._buffer.bytes(offset, 9)).rstrip('\x00 ')
+            a, b, c = self._buffer.unpack('>3B', offset + 21)
+            self.encoder_delay = a << 4 | b >> 4
+            self.encoder_padding = (b & 0xf) << 8 | c
+
     def seekpoint(self, percent, file_size = None):
         """seekpoint(percent, file_size = None) -> byte offset in file
         
@@ -302,96 +344,1018 @@ class XingFrame(MPEGFrame):
         factor = factor_a + (factor_b - factor_a) * (percent - index)
         return int((1.0/256.0) * factor * file_size)
 
+class VBRIFrame(MPEGFrame):
+    """Represents a VBRI frame (storing VBR encoding information, as written
+    by the Fraunhofer encoder)."""
 
-class Reader(object):
-    """Reader object representing a stream of MPEG/ID3/APE/RIFF frames."""
-    _FRAME_TYPES = (XingFrame, MPEGFrame, RIFFFrame, ID3Frame, APEFrame)
+    # The VBRI header always starts 32 bytes after the frame header
+    _VBRI_OFFSET = 4 + 32
+    _VBRI_HEADER = struct.Struct('>4sHHHIIHHHH')
+
+    encoder_delay = 0
+    encoder_padding = 0
+
+    def __init__(self, buf, fileobj = None, offset = 0, strict = False):
+        if fileobj and fileobj._has_vbri_header == False:
+            raise _InvalidFrame
+
+        super(VBRIFrame, self).\
+            __init__(buf, fileobj, offset=offset, strict=strict)
+
+        if self.length < self._VBRI_OFFSET + self._VBRI_HEADER.size or \
+            not buf.startswith('VBRI', offset + self._VBRI_OFFSET):
+            if fileobj: fileobj._has_vbri_header = False
+            raise _InvalidFrame
+
+        if fileobj: fileobj._has_vbri_header = True
+
+    def _frame_assembled(self):
+        super(VBRIFrame, self)._frame_assembled()
+
+        offset = self._VBRI_OFFSET
+        _, self.version, self.delay, self.quality, self.total_size, self.total_frames, \
+            entries, self.toc_scale, entry_size, self.frames_per_entry = \
+            self._buffer.unpack(self._VBRI_HEADER.format, offset)
+        offset += self._VBRI_HEADER.size
+        self.encoder_delay = self.delay
+
+        # Each entry is the (scaled down) number of bytes between two seek points
+        data = self._buffer.bytes(offset, entries * entry_size)
+        self.toc = []
+        for i in xrange(0, len(data) - entry_size + 1, entry_size):
+            value = 0
+            for byte in data[i:i + entry_size]:
+                value = value << 8 | byte
+            self.toc.append(value * self.toc_scale)
+
+    def seekpoint(self, percent):
+        """seekpoint(percent) -> byte offset from the start of the frame
+        
+        Returns a byte offset according to the VBRI table of contents."""
+        percent = min(max(percent * 1.0, 0.0), 100.0)
+        position = percent / 100.0 * self.total_frames / max(self.frames_per_entry, 1)
+
+        index = min(int(position), len(self.toc))
+        offset = sum(self.toc[:index])
+        if index < len(self.toc):
+            offset += int(self.toc[index] * (position - index))
+        return offset
+
+
+def _sync_pattern(*markers):
+    """Returns a regular expression matching the positions frames may start at."""
+    # Frame sync, then a valid version and layer, then a valid bitrate and sampling rate
+    mpeg = r'\xff[\xe2-\xe7\xf2-\xf7\xfa-\xff][%s]' % \
+        ''.join(r'\x%x0-\x%xb' % (i, i) for i in xrange(1, 15))
+    return re.compile('|'.join([mpeg] + [re.escape(m) for m in markers]))
+
+def _frame_types_by_byte(frame_types):
+    """Returns a table of the frame types to try for each possible first byte."""
+    return [tuple(frame_class for frame_class in frame_types \
+        if chr(i) in frame_class._FIRST_BYTES) for i in xrange(256)]
+
+class _FrameScanner(object):
+    """Frame detection shared by Reader and Parser: telling frames apart and
+    finding them again after losing sync. The state gathered on the way
+    (e.g. whether the stream has a RIFF header) is kept in the instance."""
+    _FRAME_TYPES = (XingFrame, VBRIFrame, MPEGFrame, RIFFFrame, ID3Frame, APEFrame)
+    _FRAME_TYPES_BY_BYTE = _frame_types_by_byte(_FRAME_TYPES)
     _MIN_FRAME_SIZE = 38
 
-    _offset = 0
+    # Used to find the next frame after losing sync. RIFF chunks other than
+    # the header are only looked for in RIFF files.
+    _SYNC_PATTERN = _sync_pattern('ID3', 'TAG', 'APETAGEX', 'RIFF')
+    _RIFF_SYNC_PATTERN = _sync_pattern('ID3', 'TAG', 'APETAGEX', 'RIFF', 'data', 'fmt ', 'fact')
+    _SYNC_MARKER_SIZE = len('APETAGEX')
+    # Number of valid frames that have to follow a frame found while out of sync
+    _SYNC_FRAMES = 2
+
     _has_riff_header = False
     _has_xing_header = None
+    _has_vbri_header = None
 
     _mpeg_version = None
     _mpeg_layer = None
 
-    _buffer_size = None
+    def _parse_frame(self, buf, offset = 0, strict = False):
+        """_parse_frame(buf, offset = 0, strict = False) -> frame or None
+        
+        Returns the frame starting at offset in buf, or None if there is none.
+        """
+        for frame_class in self._FRAME_TYPES_BY_BYTE[buf[offset]]:
+            try:
+                return frame_class(buf, self, offset=offset, strict=strict)
+            except _InvalidFrame:
+                pass
+
+        return None
 
-    def __init__(self, inobj, buffer_size=8192):
+    def _check_sync(self, buf, frame):
+        """_check_sync(buf, frame) -> bool
+        
+        Checks if frame, found at the start of buf while out of sync, is followed
+        by _SYNC_FRAMES valid frames.
+        """
+        offset = frame.length
+
+        for i in xrange(self._SYNC_FRAMES):
+            try:
+                buf.fill(at_least = offset + 12)
+            except EOFError:
+                # Not enough data left to check the next frame, accept it anyways
+                break
+
+            if not buf.match(self._sync_pattern(), offset):
+                return False
+
+            next_frame = self._parse_frame(buf, offset, strict=True)
+            if not next_frame:
+                return False
+
+            offset += next_frame.length
+
+        return True
+
+    def _sync_pattern(self):
+        return self._has_riff_header and self._RIFF_SYNC_PATTERN or self._SYNC_PATTERN
+
+    def _skip_to_sync(self, buf):
+        """_skip_to_sync(buf) -> nothing
+        
+        Drops data from buf up to the next position a frame might start at,
+        skipping at least one byte. If there is no such position in buf, only
+        data that might be the beginning of a sync marker is kept.
+        """
+        pattern = self._sync_pattern()
+        buf.delete(1)
+
+        while True:
+            offset = buf.search(pattern)
+
+            if offset < 0:
+                buf.delete(max(0, len(buf) - self._SYNC_MARKER_SIZE + 1))
+                return
+
+            buf.delete(offset)
+            if not self._is_false_sync(buf, pattern):
+                return
+
+            buf.delete(1)
+
+    def _is_false_sync(self, buf, pattern):
+        """_is_false_sync(buf, pattern) -> bool
+        
+        Cheaply rules out MPEG frame candidates at the start of buf that are
+        not followed by anything looking like a frame. This keeps long runs of
+        bogus candidates from being fully parsed one at a time.
+        """
+        if buf[0] != 0xff or len(buf) < 4:
+            return False
+
+        try:
+            length = Header._decode(buf.unpack('>I')[0]).frame_length
+        except MP3FrameHeaderError:
+            return True
+
+        return len(buf) >= length + 4 and not buf.match(pattern, length)
+
+def _is_emitted(frame_type, emit_meta_frames, emit_riff_frames, emit_id3_frames, \
+    emit_ape_frames):
+    return (issubclass(frame_type, ID3Frame) and (emit_meta_frames or emit_id3_frames)) or \
+        (issubclass(frame_type, APEFrame) and (emit_meta_frames or emit_ape_frames)) or \
+        (issubclass(frame_type, RIFFFrame) and emit_riff_frames) or \
+        issubclass(frame_type, MPEGFrame)
+
+# Fields frames(fields=...) can return besides the header fields, and the
+# namedtuple types used for them, by field names
+_FRAME_FIELDS = ('offset', 'length', 'type', 'data')
+_HEADER_FIELDS = ('version', 'layer', 'crc', 'bitrate', 'samplingrate', 'padding', 'private', \
+    'channelmode', 'modeextension', 'copyright', 'original', 'emphasis', 'samples')
+_FRAME_RECORDS = {}
+
+def _frame_record(fields):
+    record = _FRAME_RECORDS.get(fields)
+    if record is None:
+        for name in fields:
+            if name not in _FRAME_FIELDS and name not in _HEADER_FIELDS:
+                raise ValueError('unknown frame field: %s' % name)
+
+        record = _FRAME_RECORDS[fields] = namedtuple('FrameFields', fields)
+    return record
+
+class ReaderStats(object):
+    """Counters a Reader keeps while parsing, if it is given one.
+
+    on_sync_lost(offset) is called when invalid data is found at offset
+    while in sync, on_sync_recovered(offset, skipped) when a frame at
+    offset is accepted after skipping that many bytes since then.
+    """
+
+    def __init__(self, on_sync_lost = None, on_sync_recovered = None):
+        self.on_sync_lost = on_sync_lost
+        self.on_sync_recovered = on_sync_recovered
+
+        # Number of frames by frame class name
+        self.frames = {}
+        # Audio frames with a wrong CRC, only checked by frames() without fields
+        self.crc_failures = 0
+        self.sync_losses = 0
+        # Bytes of invalid data dropped while out of sync
+        self.bytes_skipped = 0
+        # Frames found while out of sync, and how many of them were accepted
+        self.resync_attempts = 0
+        self.resyncs = 0
+        # Time spent looking for frames and checking them while out of sync
+        self.resync_seconds = 0.0
+        # Reads from the stream and bytes moved within the read buffer
+        self.fill_calls = 0
+        self.bytes_read = 0
+        self.bytes_shifted = 0
+
+        # Position sync was lost at
+        self._lost_at = None
+
+    def as_dict(self):
+        """as_dict() -> dict
+
+        Returns the counters, e.g. for writing them out as JSON.
+        """
+        counters = dict((name, value) for name, value in self.__dict__.items() \
+            if not name.startswith(('_', 'on_')))
+        counters['frames'] = dict(self.frames)
+        return counters
+
+    def _count(self, frame_type, header = None):
+        name = frame_type.__name__
+        self.frames[name] = self.frames.get(name, 0) + 1
+
+        if header is not None and header.crc and not header.valid():
+            self.crc_failures += 1
+
+class Reader(_FrameScanner):
+    """Reader object representing a stream of MPEG/ID3/APE/RIFF frames."""
+    _SHARED_BUFFER_SIZE = 256 * 1024
+    _IN_MEMORY_TYPES = (bytearray, buffer, memoryview, mmap.mmap)
+    # Number of audio frames that are inspected to tell CBR from VBR streams
+    _PROBE_FRAMES = 4
+    # Seeking to computed offsets starts this many bytes early, to make up for
+    # rounding in encoders' padding schemes
+    _SEEK_SLACK = 4
+
+    _offset = 0
+
+    _buffer_size = None
+    _data = None
+    stats = None
+    _data_offset = 0
+    # The mmap opened for use_mmap, closed by close()
+    _map = None
+
+    # Set by seeks to positions that might not be a frame boundary
+    _resync = False
+    # Filled in by _probe()
+    _start = 0
+    _probed = False
+    _audio_start = None
+    _first_header = None
+    _vbr_frame = None
+    _is_cbr = False
+
+    index = None
+
+    def __init__(self, inobj, buffer_size=8192, use_mmap=False, index=None, stats=None):
+        """__init__(inobj, buffer_size=8192, use_mmap=False, index=None, stats=None)
+        
+        inobj is either a file-like object or data that is already in
+        memory (a bytearray, buffer, memoryview or mmap). Writeable data
+        (a bytearray or an mmap that is not ACCESS_READ) is parsed in
+        place, frames are windows into it. Read-only data (e.g. a buffer
+        of a string) and memoryviews are copied whole into a bytearray
+        once, here. Strings are not taken, as they are too easily mistaken
+        for paths. If use_mmap is True and inobj is a regular file, it is
+        memory-mapped and parsed the same way, starting at the file's
+        current position, until close() is called. Otherwise, data is read
+        in chunks of buffer_size bytes.
+
+        index is an optional mp3.index.FrameIndex of inobj, which makes
+        seeking exact and cheap.
+
+        stats is an optional ReaderStats object, which counts frames, reads
+        and the work spent on invalid data from then on.
+        """
         self._inobj = inobj
         self._buffer_size = buffer_size
+        self.index = index
+        self.stats = stats
+
+        if isinstance(inobj, basestring):
+            raise TypeError, 'Reader takes a file-like object or in-memory data, not a string'
+        if isinstance(inobj, self._IN_MEMORY_TYPES):
+            self._data = _storage(inobj)
+        elif use_mmap:
+            self._map_file(inobj)
+
+        if self._data is not None:
+            self._start = self._data_offset
+        else:
+            try:
+                self._start = inobj.tell()
+            except (AttributeError, EnvironmentError):
+                pass
+
+    def _map_file(self, fileobj):
+        try:
+            offset = fileobj.tell()
+            data = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (AttributeError, EnvironmentError, ValueError):
+            # Not a regular file or empty, fall back to reading chunks
+            return
+
+        self._map = data
+        self._data = _storage(data)
+        self._data_offset = offset
+
+    def close(self):
+        """close() -> nothing
+
+        Closes the memory map use_mmap opened, frames read from it must not
+        be used afterwards. The file-like object is left open. Readers can
+        also be used in with statements, which close them at the end.
+        """
+        if self._map is not None:
+            self._data = None
+            self._map.close()
+            self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _open_buffer(self, shared_buffers = False):
+        if self._data is None:
+            size = self._buffer_size
+            if shared_buffers:
+                size = max(size, self._SHARED_BUFFER_SIZE)
+
+            buf = ZeroCopyBuffer(size, self._inobj)
+            buf.stats = self.stats
+            try:
+                buf._offset = self._inobj.tell()
+            except (AttributeError, EnvironmentError):
+                pass
+            return buf
+
+        buf = MappedBuffer(self._data)
+        buf.delete(self._data_offset)
+        return buf
 
     def frames(self, skip_invalid_data = True, emit_meta_frames = True, \
-        emit_riff_frames = True, emit_id3_frames = True, emit_ape_frames = True):
+        emit_riff_frames = True, emit_id3_frames = True, emit_ape_frames = True, \
+        shared_buffers = False, fields = None):
         """frames(skip_invalid_data = True, emit_meta_frames = True, \
-            emit_riff_frames = True, emit_id3_frames = True, emit_ape_frames = True) -> frame data
+            emit_riff_frames = True, emit_id3_frames = True, emit_ape_frames = True, \
+            shared_buffers = False, fields = None) -> frame data
         
         Reads frames one-by-one, according to the method's arguments.
         Raises an MP3Error if invalid data is encountered and ingore_invalid_data
         is False.
+
+        If shared_buffers is True, frames are windows into large chunks of
+        read data instead of getting a buffer of their own. No frame data is
+        copied, but every frame still gets a small window object. A chunk
+        is kept alive as long as a frame points into it. Frames read from
+        in-memory data are always windows.
+
+        If fields is a sequence of field names, a namedtuple holding just
+        these fields is returned for each frame instead of a frame object.
+        Work for anything else is skipped, e.g. audio frames' side info and
+        CRC are not read, and their data is not copied unless 'data' is
+        requested. Possible fields are 'offset', 'length', 'type' (the frame
+        class), 'data' (a memoryview of the frame), 'samples' and the header
+        fields (e.g. 'bitrate'), which are None for frames other than audio
+        frames.
         """
-        in_sync = True
+        emit_flags = (emit_meta_frames, emit_riff_frames, emit_id3_frames, emit_ape_frames)
+        if fields is not None:
+            return self._projected_frames(_frame_record(tuple(fields)), skip_invalid_data, \
+                emit_flags, shared_buffers)
+
+        return self._frames(skip_invalid_data, emit_flags, shared_buffers)
+
+    def _frames(self, skip_invalid_data, emit_flags, shared_buffers):
+        """Implements frames()."""
+        stats = self.stats
+        in_sync = not self._resync
+        self._resync = False
 
         try:
-            buf = ZeroCopyBuffer(self._buffer_size, self._inobj)
+            buf = self._open_buffer(shared_buffers)
             buf.fill()
 
             while len(buf) > 4: # We need at least 4 bytes for our shortest header
                 # Try to parse a frame
-                frame = None
-                for frame_class in self._FRAME_TYPES:
-                    try:
-                        frame = frame_class(buf, self, strict=not in_sync)
-                        break
-                    except _InvalidFrame:
-                        pass
+                frame = self._parse_frame(buf, strict=not in_sync)
 
                 if frame and not in_sync:
                     # Recover from lost sync
-                    try:
-                        buf.fill(at_least = frame.length + 12)
-
-                        # See if there is a consequent valid frame
-                        for frame_class in self._FRAME_TYPES:
-                            try:
-                                frame_class(buf, self, offset=frame.length, strict=True)
-                                in_sync = True
-                                break
-                            except _InvalidFrame:
-                                pass
-    
-                        frame = in_sync and frame or None
-                    except EOFError:
-                        # Not enough data left to check the next frame, accept it anyways
-                        pass
+                    in_sync = self._regain_sync(buf, frame)
+                    frame = in_sync and frame or None
 
                 if frame:
                     # Consumed data is removed from the buffer in Frame.append()
-                    frame.append(buf)
+                    frame.offset = buf.tell()
+                    frame.append(buf, shared_buffers)
 
-                    if (isinstance(frame, ID3Frame) and (emit_meta_frames or emit_id3_frames)) or \
-                        (isinstance(frame, APEFrame) and (emit_meta_frames or emit_ape_frames)) or \
-                        (isinstance(frame, RIFFFrame) and emit_riff_frames) or \
-                        isinstance(frame, MPEGFrame):
+                    if stats is not None:
+                        stats._count(type(frame), getattr(frame, 'header', None))
+                    if _is_emitted(type(frame), *emit_flags):
                         yield frame
                 else:
+                    if not skip_invalid_data:
+                        raise MP3Error('encountered invalid data')
+
+                    self._lose_sync(buf, in_sync)
+                    in_sync = False
+
+                if len(buf) < 12:
+                    buf.fill()
+        except EOFError:
+            if not skip_invalid_data:
+                raise MP3Error('encountered invalid data')
+        finally:
+            del buf
+
+    def _projected_frames(self, record, skip_invalid_data, emit_flags, shared_buffers):
+        """Implements frames(fields=...). Once the stream is known to have no
+        Xing or VBRI header, audio frames found in sync are handled by
+        decoding the header word only, no frame or Header object is built."""
+        fields = record._fields
+        header_fields = [name for name in fields if name in _HEADER_FIELDS]
+        # Position of each field in the values gathered for a frame
+        indices = [name in _HEADER_FIELDS and len(_FRAME_FIELDS) + header_fields.index(name) \
+            or _FRAME_FIELDS.index(name) for name in fields]
+        want_data = 'data' in fields
+
+        # Header field values by header word
+        projected = {}
+        no_header = (None,) * len(header_fields)
+        compact = CompactHeader()
+
+        stats = self.stats
+        in_sync = not self._resync
+        self._resync = False
+
+        try:
+            buf = self._open_buffer(shared_buffers)
+            buf.fill()
+
+            while len(buf) > 4:
+                frame = None
+                frame_type = None
+                word = None
+
+                if in_sync and buf[0] == 0xff and self._has_xing_header == False and \
+                    self._has_vbri_header == False:
+                    word, = buf.unpack('>I')
+                    try:
+                        length = Header._decode(word).frame_length
+                        frame_type = MPEGFrame
+                    except MP3FrameHeaderError:
+                        pass
+                else:
+                    frame = self._parse_frame(buf, strict=not in_sync)
+
+                    if frame and not in_sync:
+                        in_sync = self._regain_sync(buf, frame)
+                        frame = in_sync and frame or None
+
+                    if frame:
+                        frame_type = type(frame)
+                        length = frame.length
+                        if isinstance(frame, MPEGFrame):
+                            word, = buf.unpack('>I')
+
+                if frame_type is None:
+                    if not skip_invalid_data:
+                        raise MP3Error('encountered invalid data')
+
+                    self._lose_sync(buf, in_sync)
                     in_sync = False
+                else:
+                    if stats is not None:
+                        stats._count(frame_type)
+
+                    offset = buf.tell()
+                    data = None
+                    if want_data:
+                        if frame is None:
+                            frame = Frame()
+                            frame.length = length
+                        frame.append(buf, shared_buffers)
+                        data = frame.view
+                    else:
+                        self._skip_frame(buf, length)
+
+                    if _is_emitted(frame_type, *emit_flags):
+                        header = no_header
+                        if word is not None:
+                            header = projected.get(word)
+                            if header is None:
+                                compact._word = word
+                                header = projected[word] = tuple(name == 'samples' and \
+                                    compact.samples() or getattr(compact, name) \
+                                    for name in header_fields)
+
+                        values = (offset, length, frame_type, data) + header
+                        yield record._make([values[i] for i in indices])
 
+                if len(buf) < 12:
+                    buf.fill()
+        except EOFError:
+            if not skip_invalid_data:
+                raise MP3Error('encountered invalid data')
+        finally:
+            del buf
+
+    def headers(self, skip_invalid_data = True, include_side_info = False, compact = False):
+        """headers(skip_invalid_data = True, include_side_info = False, compact = False) -> headers
+        
+        Reads the headers of audio frames one-by-one, without copying the
+        frames' data. The stream is read in chunks of buffer_size bytes like
+        frames() does, the rest of frames that go past a chunk is skipped
+        by seeking if possible. Each header's offset attribute is the
+        position of its frame. If include_side_info is True, the CRC and
+        side info are read as well. If compact is True, CompactHeader
+        objects are returned instead of Header objects, for keeping many of
+        them in memory. Raises an MP3Error if invalid data is encountered
+        and skip_invalid_data is False.
+        """
+        return self._headers(skip_invalid_data, include_side_info, compact = compact)
+
+    def _headers(self, skip_invalid_data = True, include_side_info = False, \
+        emit_vbr_frames = False, compact = False):
+        """Implements headers(). If emit_vbr_frames is True, Xing and VBRI
+        frames are read completely and yielded, too."""
+        stats = self.stats
+        in_sync = not self._resync
+        self._resync = False
+
+        end = None
+        if self._data is None:
+            try:
+                end = self._stream_size()
+            except (AttributeError, EnvironmentError):
+                pass
+
+        try:
+            buf = self._open_buffer()
+            buf.fill()
+
+            while len(buf) > 4:
+                frame = self._parse_frame(buf, strict=not in_sync)
+
+                if frame and not in_sync:
+                    in_sync = self._regain_sync(buf, frame)
+                    frame = in_sync and frame or None
+
+                if frame and stats is not None:
+                    stats._count(type(frame))
+
+                if frame and isinstance(frame, (XingFrame, VBRIFrame)) and emit_vbr_frames:
+                    frame.offset = buf.tell()
+                    frame.append(buf)
+                    yield frame
+
+                elif frame:
+                    header = None
+                    if isinstance(frame, MPEGFrame) and \
+                        not isinstance(frame, (XingFrame, VBRIFrame)):
+                        header = compact and CompactHeader(buf) or frame.header
+                        header.offset = buf.tell()
+                        if include_side_info:
+                            size = header.length()
+                            if header.crc and header.layer != 3:
+                                size = min(frame.length, size + header._CRC_DATA_SIZE)
+                            buf.fill(at_least = size)
+                            header.update(buf)
+
+                    self._skip_frame(buf, frame.length, end)
+                    if header is not None:
+                        yield header
+                else:
                     if not skip_invalid_data:
                         raise MP3Error('encountered invalid data')
 
-                    buf.delete(1)
+                    self._lose_sync(buf, in_sync)
+                    in_sync = False
 
                 if len(buf) < 12:
-                    buf.fill(self._inobj)
+                    buf.fill()
         except EOFError:
             if not skip_invalid_data:
                 raise MP3Error('encountered invalid data')
         finally:
             del buf
 
-class Header(object):
-    """Represents an MPEG frame header."""
+    def _lose_sync(self, buf, in_sync):
+        """_lose_sync(buf, in_sync) -> nothing
+        
+        Skips invalid data at the start of buf (see _skip_to_sync()),
+        keeping track of it in stats. in_sync tells if the data was found
+        while in sync.
+        """
+        stats = self.stats
+        if stats is None:
+            return self._skip_to_sync(buf)
+
+        offset = buf.tell()
+        if in_sync:
+            stats.sync_losses += 1
+            stats._lost_at = offset
+            if stats.on_sync_lost:
+                stats.on_sync_lost(offset)
+
+        start = default_timer()
+        self._skip_to_sync(buf)
+        stats.resync_seconds += default_timer() - start
+        stats.bytes_skipped += buf.tell() - offset
+
+    def _regain_sync(self, buf, frame):
+        """_regain_sync(buf, frame) -> bool
+        
+        Checks frame, found at the start of buf while out of sync, with
+        _check_sync(), keeping track of it in stats.
+        """
+        stats = self.stats
+        if stats is None:
+            return self._check_sync(buf, frame)
+
+        start = default_timer()
+        in_sync = self._check_sync(buf, frame)
+        stats.resync_seconds += default_timer() - start
+        stats.resync_attempts += 1
+
+        if in_sync:
+            stats.resyncs += 1
+            offset = buf.tell()
+            lost_at, stats._lost_at = stats._lost_at, None
+            if stats.on_sync_recovered:
+                stats.on_sync_recovered(offset, lost_at is not None and offset - lost_at or 0)
+        return in_sync
+
+    def _skip_frame(self, buf, length, end = None):
+        """_skip_frame(buf, length, end = None) -> nothing
+        
+        Drops a frame of length bytes from the start of buf, seeking past
+        the part that has not been read yet if the size of the stream
+        (end) is known. Raises EOFError if the frame is truncated.
+        """
+        if len(buf) >= length:
+            return buf.delete(length)
+
+        if isinstance(buf, MappedBuffer):
+            raise EOFError
+
+        if end is None:
+            # Read through the frame
+            while len(buf) < length:
+                length -= len(buf)
+                buf.delete(len(buf))
+                buf.fill(at_least = min(length, buf._size))
+            return buf.delete(length)
+
+        position = buf.tell() + length
+        if position > end:
+            raise EOFError
+
+        self._inobj.seek(position)
+        buf.discard(position)
+
+    def seek_frame(self, n):
+        """seek_frame(n) -> nothing
+        
+        Positions the reader so that the next call to frames() starts at
+        audio frame n (counting from 0, excluding Xing and VBRI frames).
+        With an index, the position is looked up. CBR streams (including
+        those with an Info frame) are positioned by calculation, followed
+        by a search for the next frame boundary. The headers of other
+        streams are counted from the first audio frame on, as a Xing or
+        VBRI table of contents does not tell where exactly a frame starts.
+        """
+        n = max(0, n)
+
+        if self.index is not None:
+            if n < len(self.index):
+                self._set_position(self.index.offsets[n])
+            else:
+                self._set_position(self._stream_size())
+            return
+
+        self._probe()
+        if self._first_header is None:
+            return self._set_position(self._start)
+
+        header = self._first_header
+        if self._is_cbr:
+            frame_size = header.samples() * header.bitrate * 1000 / 8.0 / header.samplingrate
+            offset = self._audio_start + int(n * frame_size)
+            return self._set_position(max(self._audio_start, offset - self._SEEK_SLACK), True)
+
+        self._set_position(self._audio_start)
+        for i, header in enumerate(self.headers()):
+            if i == n:
+                return self._set_position(header.offset)
+        self._set_position(self._stream_size())
+
+    def seek_time(self, seconds):
+        """seek_time(seconds) -> nothing
+        
+        Positions the reader so that the next call to frames() starts at
+        the audio frame playing at the given time. See seek_frame(), except
+        that VBR streams without an index are positioned by their Xing or
+        VBRI table of contents, followed by a search for the next frame
+        boundary; the position is accurate to about 1% of the stream then.
+        """
+        if self.index is not None:
+            return self.seek_frame(self.index.find_time(seconds))
+
+        self._probe()
+        if self._first_header is None:
+            return self._set_position(self._start)
+
+        header = self._first_header
+        n = max(0, int(seconds * header.samplingrate / header.samples()))
+
+        vbr_frame = self._vbr_frame
+        if not self._is_cbr and getattr(vbr_frame, 'toc', None) and \
+            getattr(vbr_frame, 'total_frames', 0):
+            percent = 100.0 * n / vbr_frame.total_frames
+            if isinstance(vbr_frame, XingFrame):
+                size = getattr(vbr_frame, 'total_size', None) or \
+                    self._stream_size() - vbr_frame.offset
+                offset = vbr_frame.offset + vbr_frame.seekpoint(percent, size)
+            else:
+                offset = vbr_frame.offset + vbr_frame.seekpoint(percent)
+            # Interpolated positions may overshoot, back off by about a frame
+            offset -= header._info.frame_length
+            return self._set_position(max(self._audio_start, offset), True)
+
+        self.seek_frame(n)
+
+    def __getitem__(self, n):
+        """reader[n] -> frame
+        
+        Returns audio frame n, see seek_frame(). Negative numbers count
+        from the end if the number of frames is known from an index or a
+        Xing or VBRI frame.
+        """
+        if n < 0:
+            if self.index is not None:
+                total = len(self.index)
+            else:
+                self._probe()
+                total = getattr(self._vbr_frame, 'total_frames', None)
+                if total is None:
+                    raise IndexError, 'number of frames is unknown'
+            n += total
+            if n < 0:
+                raise IndexError, 'frame number out of range'
+
+        self.seek_frame(n)
+        for frame in self._audio_frames():
+            return frame
+        raise IndexError, 'frame number out of range'
+
+    def _audio_frames(self):
+        for frame in self.frames(emit_meta_frames = False, emit_riff_frames = False, \
+            shared_buffers = True):
+            if isinstance(frame, MPEGFrame) and \
+                not isinstance(frame, (XingFrame, VBRIFrame)):
+                yield frame
+
+    def _probe(self):
+        """Inspects the first frames of the stream to decide how to seek."""
+        if self._probed:
+            return
+        self._probed = True
+
+        self._set_position(self._start)
+        headers = []
+        for item in self._headers(emit_vbr_frames = True):
+            if isinstance(item, MPEGFrame):
+                if not headers and self._vbr_frame is None:
+                    self._vbr_frame = item
+                continue
+
+            if not headers:
+                self._audio_start = item.offset
+                self._first_header = item
+
+            headers.append(item)
+            if len(headers) == self._PROBE_FRAMES:
+                break
+
+        # Xing and VBRI frames are only written for VBR streams, Info frames
+        # for CBR streams
+        vbr_frame = self._vbr_frame
+        self._is_cbr = bool(headers) and \
+            (vbr_frame is None or getattr(vbr_frame, 'info', False)) and \
+            len(set(header.bitrate for header in headers)) == 1
+
+    def _set_position(self, offset, resync = False):
+        """Makes the next call to frames() start at offset."""
+        if self._data is None:
+            self._inobj.seek(offset)
+        else:
+            self._data_offset = offset
+        self._resync = resync
+
+    def _stream_size(self):
+        if self._data is not None:
+            return len(self._data)
+
+        position = self._inobj.tell()
+        self._inobj.seek(0, os.SEEK_END)
+        size = self._inobj.tell()
+        self._inobj.seek(position)
+        return size
+
+    def _read_at(self, offset, size):
+        """Returns up to size bytes from offset, without moving the reader."""
+        offset = max(offset, 0)
+        if self._data is not None:
+            return bytearray(memoryview(self._data)[offset:offset + size])
+
+        position = self._inobj.tell()
+        try:
+            self._inobj.seek(offset)
+            return bytearray(self._inobj.read(size))
+        finally:
+            self._inobj.seek(position)
+
+    def _audio_end(self):
+        """Returns the end of the stream, minus ID3v1 and APE tags at its end."""
+        end = self._stream_size()
+
+        if end >= 128 and self._read_at(end - 128, 3) == 'TAG':
+            end -= 128
+
+        footer = self._read_at(end - 32, 32)
+        if len(footer) == 32 and footer.startswith('APETAGEX'):
+            size, = struct.unpack_from('<I', footer, 12)
+            flags, = struct.unpack_from('<I', footer, 20)
+            end -= size + (flags & 0x80000000 and 32 or 0)
+
+        return max(end, self._audio_start or 0)
+
+class _FeedBuffer(MappedBuffer):
+    """MappedBuffer over the data fed to a Parser. Instead of reading,
+    fill() raises _NeedMoreData until the end of the stream is reached."""
+
+    closed = False
+    # Bytes fill() asked for last time, there is no point in parsing again
+    # before they are available
+    needed = 0
+
+    def __init__(self):
+        self._init_storage(bytearray(), 0, 0)
+
+    def feed(self, data):
+        if self._exported or self._pos:
+            # Frames point into the current memory, continue in a fresh one.
+            # This only copies the partial frame left over.
+            storage = bytearray(self.view())
+            storage += data
+            self._offset += self._pos
+            self._exported = False
+            self._init_storage(storage, 0, len(storage))
+        else:
+            self._buffer += data
+            self._len = self._size = len(self._buffer)
+
+    def fill(self, fileobj = None, completely = False, at_least = None):
+        if at_least is None or len(self) >= at_least:
+            return
+        if self.closed:
+            raise EOFError
+
+        self.needed = at_least
+        raise _NeedMoreData
+
+class Parser(_FrameScanner):
+    """Push parser for streams of MPEG/ID3/APE/RIFF frames.
+
+    Unlike Reader, a Parser does no I/O itself: data is handed to it in
+    chunks of any size through feed(), which returns the frames completed so
+    far. Partial frames and the sync state are kept between calls, so the
+    data can come from a socket, an event loop or a decoder's input queue.
+    """
+    # Bytes needed before the end of the stream to tell frame types apart,
+    # e.g. a Xing or VBRI frame from a plain MPEG frame
+    _LOOKAHEAD = 64
+
+    def __init__(self, skip_invalid_data = True, emit_meta_frames = True, \
+        emit_riff_frames = True, emit_id3_frames = True, emit_ape_frames = True):
+        """__init__(skip_invalid_data = True, emit_meta_frames = True, \
+            emit_riff_frames = True, emit_id3_frames = True, emit_ape_frames = True)
+
+        The arguments have the same meaning as those of Reader.frames().
+        """
+        self._buf = _FeedBuffer()
+        self._in_sync = True
+        self._skip_invalid_data = skip_invalid_data
+        self._emit = (emit_meta_frames, emit_riff_frames, emit_id3_frames, emit_ape_frames)
+
+    def feed(self, data):
+        """feed(data) -> list of frames
+
+        Appends data to the stream and returns the frames it completed. Never
+        blocks and never waits for more data than has been fed; incomplete
+        frames are returned by a later call. Raises an MP3Error if invalid
+        data is encountered and skip_invalid_data is False.
+        """
+        if self._buf.closed:
+            raise ValueError('feed() called after close()')
+
+        self._buf.feed(data)
+        return self._parse()
+
+    def close(self):
+        """close() -> list of frames
+
+        Ends the stream and returns the frames that were still waiting for
+        more data. A truncated last frame is dropped, or raises an MP3Error
+        if skip_invalid_data is False.
+        """
+        if self._buf.closed:
+            return []
+
+        self._buf.closed = True
+        return self._parse()
+
+    def tell(self):
+        """tell() -> position in stream
+
+        Returns the position of the first byte that has not been turned
+        into a frame or skipped yet.
+        """
+        return self._buf.tell()
+
+    def _parse(self):
+        buf = self._buf
+        frames = []
+
+        if len(buf) < buf.needed and not buf.closed:
+            return frames
+        buf.needed = 0
+
+        minimum = buf.closed and 5 or self._LOOKAHEAD
+        try:
+            while len(buf) >= minimum:
+                frame = self._parse_frame(buf, strict=not self._in_sync)
+
+                if frame and not self._in_sync:
+                    # Recover from lost sync
+                    if not self._check_sync(buf, frame):
+                        frame = None
+
+                if frame:
+                    buf.fill(at_least = frame.length)
+                    self._in_sync = True
+
+                    frame.offset = buf.tell()
+                    frame.append(buf)
+
+                    if _is_emitted(type(frame), *self._emit):
+                        frames.append(frame)
+                else:
+                    self._in_sync = False
+
+                    if not self._skip_invalid_data:
+                        raise MP3Error('encountered invalid data')
+
+                    self._skip_to_sync(buf)
+
+            if not buf.closed:
+                buf.needed = minimum
+        except _NeedMoreData:
+            pass
+        except EOFError:
+            buf.delete(len(buf))
+            if not self._skip_invalid_data:
+                raise MP3Error('encountered invalid data')
+
+        return frames
+
+_HeaderInfo = namedtuple('_HeaderInfo', 'fields frame_length side_info_size samples')
+
+class _HeaderBase(object):
+    """Properties and methods shared by Header and CompactHeader. Subclasses
+    store the raw field values, see _get_field() and _set_field()."""
+    __slots__ = ()
+
     _BITRATES = [
         # Version 1
         [
@@ -419,11 +1383,34 @@ class Header(object):
         [22050, 24000, 16000],
     ]
 
+    # Layer III only, the other layers don't have side information
     _SIDE_INFO_SIZE = [
         [32, 17],
         [17, 9]
     ]
 
+    # The CRC of Layer I and II frames covers the bit allocation (and the
+    # scale factor selection) at the start of the audio data instead, this
+    # is as much of it as there can be
+    _CRC_DATA_SIZE = 39
+
+    # Bits of the Layer II bit allocation of each subband, by allocation
+    # table: ISO 11172-3 B.2a - B.2d and ISO 13818-3 B.1 (MPEG 2/2.5)
+    _LAYER2_ALLOCATION = [
+        (4,) * 11 + (3,) * 12 + (2,) * 4,
+        (4,) * 11 + (3,) * 12 + (2,) * 7,
+        (4,) * 2 + (3,) * 6,
+        (4,) * 2 + (3,) * 10,
+        (4,) * 4 + (3,) * 7 + (2,) * 19,
+    ]
+
+    _SAMPLES = [
+        # Version 1, Layer I - III
+        [384, 1152, 1152],
+        # Version 2/2.5, Layer I - III
+        [384, 1152, 576],
+    ]
+
     _HEADER = (
         ('i:11=0x7ff', 'sync'),
         ('i:2',        'version'),
@@ -443,29 +1430,71 @@ class Header(object):
     _FORMAT, _FIELDS = zip(*_HEADER)
     _FORMAT = bitpack_formatstr(_FORMAT)
 
-    _crc16 = None
-    _side_info = None
+    # Decoded header words, see _decode()
+    _DECODED = {}
+    _DECODED_MAX = 4096
 
-    def __init__(self, buf, offset = 0):
-        """__init__(buf, offset = 0)
+    @classmethod
+    def _decode(cls, word):
+        """_decode(word) -> _HeaderInfo
         
-        Read an MPEG frame header from buf at position offset. Raises
-        an MP3FrameHeaderError if no valid header can be found.
+        Decodes the 32-bit header word. The result holds the raw field values,
+        the frame length, the side info size and the number of samples. Results
+        are cached, so a stream only decodes each distinct header once. Raises
+        an MP3FrameHeaderError if word is not a valid header.
         """
-        if buf is None:
-            self.__dict__.update(dict.fromkeys(self._FIELDS))
-        else:
-            try:
-                self.__dict__.update(zip(self._FIELDS, \
-                    buf.bitunpack(self._FORMAT, offset)))
-            except invalid_input_error:
-                raise MP3FrameHeaderError('frame sync not found')
+        info = cls._DECODED.get(word)
+
+        if info is None:
+            info = cls._decode_uncached(word)
+
+            if len(cls._DECODED) >= cls._DECODED_MAX:
+                cls._DECODED.clear()
+            cls._DECODED[word] = info
+
+        if isinstance(info, MP3FrameHeaderError):
+            raise info
+
+        return info
 
-            for key in self._FIELDS:
+    @classmethod
+    def _decode_uncached(cls, word):
+        header = Header(None)
+
+        try:
+            values = cls._FORMAT.unpack_from(struct.pack('>I', word))
+        except invalid_input_error:
+            return MP3FrameHeaderError('frame sync not found')
+
+        fields = tuple(zip(cls._FIELDS, values))
+        header.__dict__.update(fields)
+
+        try:
+            for key in cls._FIELDS:
                 # This works as a basic validator
-                getattr(self, key)
-                
-            self.update(buf, offset)
+                getattr(header, key)
+
+            version, layer = header.version, header.layer
+            frame_length = cls._frame_length(version, layer, header.bitrate, \
+                header.samplingrate, header.padding)
+        except MP3FrameHeaderError, e:
+            return e
+
+        return _HeaderInfo(fields, frame_length, header.side_info_size(), \
+            cls._SAMPLES[version != 1][layer - 1])
+
+    @classmethod
+    def _frame_length(cls, version, layer, bitrate, samplingrate, padding):
+        """_frame_length(version, layer, bitrate, samplingrate, padding) -> length
+        
+        Returns the length of a frame in bytes, including the header. Layer I
+        frames consist of 4 byte slots, all others of single bytes.
+        """
+        if layer == 1:
+            return (12 * bitrate * 1000 / samplingrate + padding) * 4
+
+        samples = cls._SAMPLES[version != 1][layer - 1]
+        return samples / 8 * bitrate * 1000 / samplingrate + padding
 
     def update(self, buf, offset = 0):
         """update(buf, offset = 0) -> nothing
@@ -484,8 +1513,14 @@ class Header(object):
                 self._crc16, = buf.unpack('>H', offset)
             offset += 2
 
-        if not self._side_info and length >= offset + self.side_info_size():
-            self._side_info = buf.bytes(offset, self.side_info_size())
+        side_info_size = self.side_info_size()
+        if not self._side_info and length >= offset + side_info_size:
+            self._side_info = buf.bytes(offset, side_info_size)
+
+        if self.crc and self.layer != 3 and not self._crc_data:
+            size = min(self._CRC_DATA_SIZE, self.frame_length() - self.length())
+            if length >= offset + size:
+                self._crc_data = buf.bytes(offset, size)
 
 
     def bytes(self, include_crc = True):
@@ -496,14 +1531,14 @@ class Header(object):
         the header.crc flag.
         """
         buf = bytearray(self._FORMAT.length)
-        bitpack_into(self._FORMAT, buf, 0, *[self.__dict__[k] for k in self._FIELDS])
+        bitpack_into(self._FORMAT, buf, 0, *[self._get_field(k) for k in self._FIELDS])
 
         pos = len(buf)
         buf.extend(self._side_info)
 
         if include_crc and self.crc:
-            crc = crc16(memoryview(buf)[2:])
-            buf[pos:pos] = 2 # Inserts two bytes at pos
+            crc = self._calculate_crc(buf)
+            buf[pos:pos] = '\x00\x00' # Inserts two bytes at pos
             struct.pack_into('>H', buf, pos, crc)
 
         return buf
@@ -513,6 +1548,9 @@ class Header(object):
         
         Returns the length of the side channel informaton in bytes.
         """
+        if self.layer != 3:
+            return 0
+
         return self._SIDE_INFO_SIZE[self.version > 1][self.channelmode == Channelmode.MONO]
 
     def length(self, include_crc = True, include_side_info = True):
@@ -541,21 +1579,83 @@ class Header(object):
         one that is. Use header._crc16 to get this.
         """
         # TODO: Check for empty side info?
+        return self._calculate_crc(self.bytes(include_crc = False))
+
+    def _calculate_crc(self, buf):
+        """Returns the CRC of buf, the packed header and side info, and of
+        the bit allocation read by update() for Layer I and II."""
         # First two bytes of the header are skipped
-        buf = self.bytes(include_crc = False)
-        return crc16(memoryview(buf)[2:])
+        if self.layer == 3:
+            return crc16(memoryview(buf)[2:])
+
+        data = self._crc_data or bytearray()
+        bits = min(self._crc_data_bits(data), len(data) * 8)
+        return crc16(memoryview(buf[2:] + data), 16 + bits)
+
+    def _crc_data_bits(self, data):
+        """Returns the number of bits at the start of data, the audio data
+        of a Layer I or II frame, that the CRC covers: the bit allocation
+        of each subband (shared by both channels above the intensity stereo
+        bound) and, for Layer II, the scale factor selection of each
+        subband and channel with bits allocated."""
+        channels = self.channelmode == Channelmode.MONO and 1 or 2
+        joint_stereo = self.channelmode == Channelmode.JOINT_STEREO
+        bound = joint_stereo and 4 + 4 * self.modeextension or 32
+
+        if self.layer == 1:
+            return 4 * (channels * bound + 32 - bound)
+
+        if self.version != 1:
+            table = 4
+        elif self.bitrate / channels <= 48:
+            table = self.samplingrate == 32000 and 3 or 2
+        elif self.bitrate / channels <= 80:
+            table = 0
+        else:
+            table = self.samplingrate == 48000 and 0 or 1
+        allocation = self._LAYER2_ALLOCATION[table]
+        bound = min(bound, len(allocation))
+
+        size = len(data) * 8
+        value = data and int(binascii.hexlify(data), 16) or 0
+        position = scfsi = 0
+        for subband, width in enumerate(allocation):
+            shared = subband >= bound
+            for channel in xrange(shared and 1 or channels):
+                position += width
+                if position > size:
+                    return position + scfsi
+                if value >> size - position & (1 << width) - 1:
+                    scfsi += 2 * (shared and channels or 1)
+
+        return position + scfsi
+
+    def frame_length(self):
+        """frame_length() -> length of the frame
+        
+        Returns the length of the whole frame, including the header.
+        """
+        return self._frame_length(self.version, self.layer, self.bitrate, \
+            self.samplingrate, self.padding)
+
+    def samples(self):
+        """samples() -> number of samples
+        
+        Returns the number of samples (per channel) in the frame.
+        """
+        return self._SAMPLES[self.version != 1][self.layer - 1]
 
     def time(self):
         """time() -> running time in seconds
         
         Returns the frame's running time in seconds.
         """
-        return (self.layer == 1) and (384.0 / 44100) or (1152.0 / 44100)
+        return float(self.samples()) / self.samplingrate
 
     @property
     def version(self):
         """MPEG Version. Possible values are 1, 2 and 2.5."""
-        version = self.__dict__['version']
+        version = self._get_field('version')
 
         if version == 0:
             return 2.5
@@ -573,12 +1673,12 @@ class Header(object):
         else:
             raise MP3FrameHeaderError('invalid MPEG version: %d' % value)
 
-        self.__dict__['version'] = value
+        self._set_field('version', value)
 
     @property
     def layer(self):
         """MPEG Layer. Possible values are 1, 2, 3."""
-        layer = self.__dict__['layer']
+        layer = self._get_field('layer')
 
         if layer == 0:
             raise MP3FrameHeaderError, 'unknown Layer description'
@@ -594,21 +1694,21 @@ class Header(object):
         else:
             raise MP3FrameHeaderError('invalid Layer description: %d' % value)
 
-        self.__dict__['layer'] = value
+        self._set_field('layer', value)
 
     @property
     def crc(self):
         """Is the frame protected by a CRC?"""
-        return not self.__dict__['crc']
+        return not self._get_field('crc')
 
     @crc.setter
     def crc(self, val):
-        self.__dict__['crc'] = not val
+        self._set_field('crc', not val)
 
     @property
     def bitrate(self):
         """Frame's bitrate."""
-        bitrate = self.__dict__['bitrate']
+        bitrate = self._get_field('bitrate')
 
         if bitrate == 0xF or bitrate == 0x0:
             raise MP3FrameHeaderError, 'bad bitrate'
@@ -618,15 +1718,15 @@ class Header(object):
     @bitrate.setter
     def bitrate(self, value):
         try:
-            self.__dict__['bitrate'] = \
-                self._BITRATES[int(self.version)-1][self.layer-1].index(value) + 1
+            self._set_field('bitrate', \
+                self._BITRATES[int(self.version)-1][self.layer-1].index(value) + 1)
         except ValueError:
             raise MP3FrameHeaderError('invalid bitrate: %d' % value)
 
     @property
     def samplingrate(self):
         """Frame's samplingrate."""
-        samplingrate = self.__dict__['samplingrate']
+        samplingrate = self._get_field('samplingrate')
         version = self.version
 
         if samplingrate == 3:
@@ -646,12 +1746,141 @@ class Header(object):
             value *= 2
 
         try:
-            self.__dict__['samplingrate'] = \
-                self._SAMPLINGRATES[int(version)-1].index(value)
+            self._set_field('samplingrate', \
+                self._SAMPLINGRATES[int(version)-1].index(value))
         except ValueError:
             if version == 2.5: value /= 2
             raise MP3FrameHeaderError('invalid sampling-rate: %d' % value)
 
+class Header(_HeaderBase):
+    """Represents an MPEG frame header."""
+
+    _crc16 = None
+    _side_info = None
+    _crc_data = None
+    # Position of the frame in the stream, if known
+    offset = None
+    _info = None
+
+    def __init__(self, buf, offset = 0):
+        """__init__(buf, offset = 0)
+        
+        Read an MPEG frame header from buf at position offset. Raises
+        an MP3FrameHeaderError if no valid header can be found.
+        """
+        if buf is None:
+            self.__dict__.update(dict.fromkeys(self._FIELDS))
+        else:
+            try:
+                word, = buf.unpack('>I', offset)
+            except struct.error:
+                raise MP3FrameHeaderError('need at least 4 bytes of data')
+
+            self._info = info = self._decode(word)
+            self.__dict__.update(info.fields)
+            self.update(buf, offset)
+
+    def _get_field(self, name):
+        return self.__dict__[name]
+
+    def _set_field(self, name, value):
+        self.__dict__[name] = value
+
+def _field_layout(header_format):
+    """Returns the bit position, mask and boolean flag of each header field,
+    by name, for decoding fields from a whole header word."""
+    layout = {}
+    shift = 32
+    for fmt, name in header_format:
+        width = ':' in fmt and int(fmt.split(':')[1].split('=')[0]) or 1
+        shift -= width
+        layout[name] = (shift, (1 << width) - 1, fmt == 'b')
+    return layout
+
+def _field_property(name):
+    return property(lambda self: self._get_field(name), \
+        lambda self, value: self._set_field(name, value))
+
+class CompactHeader(_HeaderBase):
+    """Represents an MPEG frame header, taking a fraction of the memory of
+    a Header.
+
+    Only the header word, the CRC and the offset are stored, in slots.
+    Fields are decoded from the word when they are read and written back to
+    it when they are set. Side info (and the bit allocation the CRC of Layer I
+    and II frames covers) is only kept once update() is called.
+    Otherwise CompactHeader works like Header, which makes it suitable for
+    keeping the headers of a whole file around.
+    """
+    __slots__ = ('_word', '_crc16', '_side_info', '_crc_data', 'offset')
+
+    _LAYOUT = _field_layout(_HeaderBase._HEADER)
+
+    sync = _field_property('sync')
+    padding = _field_property('padding')
+    private = _field_property('private')
+    channelmode = _field_property('channelmode')
+    modeextension = _field_property('modeextension')
+    copyright = _field_property('copyright')
+    original = _field_property('original')
+    emphasis = _field_property('emphasis')
+
+    def __init__(self, buf = None, offset = 0):
+        """__init__(buf = None, offset = 0)
+        
+        Read an MPEG frame header, and its CRC if present, from buf at
+        position offset. Raises an MP3FrameHeaderError if no valid header
+        can be found. If buf is None, all fields are 0.
+        """
+        self._word = 0
+        self._crc16 = None
+        self._side_info = None
+        self._crc_data = None
+        self.offset = None
+
+        if buf is None:
+            return
+
+        try:
+            word, = buf.unpack('>I', offset)
+        except struct.error:
+            raise MP3FrameHeaderError('need at least 4 bytes of data')
+
+        self._decode(word)
+        self._word = word
+
+        if self.crc and len(buf) >= offset + 6:
+            self._crc16, = buf.unpack('>H', offset + 4)
+
+    @classmethod
+    def from_header(cls, header):
+        """from_header(header) -> CompactHeader
+        
+        Returns a compact copy of header.
+        """
+        compact = cls()
+        for name in cls._FIELDS:
+            compact._set_field(name, header._get_field(name))
+
+        compact._crc16 = header._crc16
+        compact._side_info = header._side_info
+        compact._crc_data = header._crc_data
+        compact.offset = header.offset
+        return compact
+
+    @property
+    def _info(self):
+        return self._decode(self._word)
+
+    def _get_field(self, name):
+        shift, mask, is_bool = self._LAYOUT[name]
+        value = self._word >> shift & mask
+        return bool(value) if is_bool else value
+
+    def _set_field(self, name, value):
+        shift, mask, is_bool = self._LAYOUT[name]
+        self._word = self._word & ~(mask << shift) | (int(value) & mask) << shift
+
 ## OLD API
 
 class _HeaderWrapper(tuple):
@@ -668,7 +1897,7 @@ class _HeaderWrapper(tuple):
 
 def _unwrap(wrapper):
     if isinstance(wrapper, _HeaderWrapper):
-        return wrapper
+        return wrapper.header
 
     h = Header(None)
     h.version, h.layer, h.crc, h.bitrate, h.samplingrate, h.padding = wrapper
@@ -738,13 +1967,170 @@ def frames(f):
         emit_riff_frames=False):
         yield _HeaderWrapper(frame.header), frame
 
-def good_data(f):
-    """good_data(file) -> good-data-buffer generator
+def good_data(f, coalesce_frames = False):
+    """good_data(file, coalesce_frames = False) -> good-data-buffer generator
 
     Extract all MP3-frames and ID3-tags from a file-like object,
-    yielding their raw data buffers one at a time."""
+    yielding their raw data buffers one at a time. If coalesce_frames
+    is True, runs of frames that were contiguous in the file are
+    yielded as one memoryview instead (see coalesce())."""
+
+    # Coalescing needs frames that share read chunks, which would otherwise
+    # keep whole chunks alive for as long as a frame is kept
+    reader = Reader(f)
+    frames = reader.frames(skip_invalid_data = True, emit_meta_frames = True, \
+        emit_riff_frames = False, shared_buffers = coalesce_frames)
+
+    if coalesce_frames:
+        return coalesce(frames)
+    return frames
+
+def coalesce(frames):
+    """coalesce(frames) -> memoryview generator
+
+    Merges frames that are adjacent windows into the same data (as
+    produced by Reader.frames() with shared_buffers) into runs, yielding
+    a memoryview of each run."""
+
+    storage = None
+    start = end = 0
+    for frame in frames:
+        buf = frame._buffer
+        if buf._buffer is storage and buf._pos == end:
+            end = buf._len
+            continue
+
+        if storage is not None:
+            yield memoryview(storage)[start:end]
+        storage, start, end = buf._buffer, buf._pos, buf._len
+
+    if storage is not None:
+        yield memoryview(storage)[start:end]
+
+class FrameWriter(object):
+    """Writes frames to a file-like object with as few write calls as
+    possible. Frames that are adjacent windows into the same data are
+    written as one run, small runs and other data are collected until
+    there are buffer_size bytes. Call flush() when done."""
+
+    def __init__(self, fileobj, buffer_size = 256 * 1024):
+        self.fileobj = fileobj
+        self.buffer_size = buffer_size
+        self._pending = bytearray()
+        self._storage = None
+        self._start = self._end = 0
+
+    def write_frame(self, frame):
+        """write_frame(frame) -> nothing
+        
+        The frame must not be changed until the writer is flushed."""
+        buf = frame._buffer
+        if buf._buffer is self._storage and buf._pos == self._end:
+            self._end = buf._len
+            return
+
+        self._write_run()
+        self._storage, self._start, self._end = buf._buffer, buf._pos, buf._len
+
+    def write(self, data):
+        self._write_run()
+        self._write(data)
+
+    def flush(self):
+        self._write_run()
+        if self._pending:
+            self.fileobj.write(self._pending)
+            self._pending = bytearray()
+
+    def _write_run(self):
+        if self._storage is not None:
+            self._write(memoryview(self._storage)[self._start:self._end])
+            self._storage = None
+
+    def _write(self, data):
+        if len(data) >= self.buffer_size:
+            if self._pending:
+                self.fileobj.write(self._pending)
+                self._pending = bytearray()
+            self.fileobj.write(data)
+            return
+
+        self._pending += data
+        if len(self._pending) >= self.buffer_size:
+            self.fileobj.write(self._pending)
+            self._pending = bytearray()
+
+
+Duration = namedtuple('Duration', 'seconds method error')
+
+def duration(f):
+    """duration(file) -> Duration(seconds, method, error)
+
+    Determine the running time of an MP3 file in seconds, reading as
+    little of it as possible. method tells how it was determined:
+
+      'xing', 'vbri' -- from the frame count in a Xing or VBRI header
+      'cbr' -- extrapolated from the length of a CBR stream
+      'scan' -- by reading the header of every frame
+
+    error is an upper bound for the error in seconds. Samples the encoder
+    added at the beginning and end of the stream are not counted if a
+    LAME tag tells about them; without one, frame counts are only exact
+    to about a frame."""
 
     reader = Reader(f)
-    for frame in reader.frames(skip_invalid_data = True, emit_meta_frames = True, \
-        emit_riff_frames = False):
-        yield frame
\ No newline at end of file
+    reader._probe()
+    header = reader._first_header
+    if header is None:
+        return Duration(0.0, 'scan', 0.0)
+
+    vbr_frame = reader._vbr_frame
+    total_frames = getattr(vbr_frame, 'total_frames', 0)
+    if total_frames:
+        samples = total_frames * header.samples() - \
+            vbr_frame.encoder_delay - vbr_frame.encoder_padding
+        method = isinstance(vbr_frame, XingFrame) and 'xing' or 'vbri'
+        # VBRI frames only tell the encoder delay, not the padding
+        error = getattr(vbr_frame, 'encoder', None) is None and header.time() or 0.0
+        return Duration(max(samples, 0) / float(header.samplingrate), method, error)
+
+    if reader._is_cbr:
+        frame_size = header.samples() * header.bitrate * 1000 / 8.0 / header.samplingrate
+        end = reader._audio_end()
+
+        # Make sure the stream is still CBR towards its end
+        reader._set_position(max(reader._audio_start, int(end - 3 * frame_size)), True)
+        tail = list(islice(reader.headers(), 2))
+        if tail and all(tail_header.bitrate == header.bitrate for tail_header in tail):
+            frames = (end - reader._audio_start) / frame_size
+            return Duration(frames * header.time(), 'cbr', header.time())
+
+    # Count samples per sampling rate, summing up times accumulates errors
+    reader._set_position(reader._audio_start)
+    samples = {}
+    for scan_header in reader.headers():
+        rate = scan_header.samplingrate
+        samples[rate] = samples.get(rate, 0) + scan_header.samples()
+
+    seconds = sum(float(count) / rate for rate, count in samples.items())
+    return Duration(seconds, 'scan', 0.0)
+
+def audio_digest(f, name = 'sha1'):
+    """audio_digest(file, name = 'sha1') -> hex digest
+
+    Hashes the MPEG frames (including Xing and VBRI frames) of an MP3 file,
+    leaving out ID3, APE and RIFF data, so that the digest does not change
+    when the file is retagged. name is a hashlib algorithm. Regular files
+    are memory-mapped and hashed without copying frames."""
+
+    digest = hashlib.new(name)
+    with Reader(f, use_mmap = True) as reader:
+        frames = reader.frames(emit_meta_frames = False, emit_riff_frames = False, \
+            emit_id3_frames = False, emit_ape_frames = False, shared_buffers = True)
+        for frame in frames:
+            digest.update(frame.view)
+
+    return digest.hexdigest()
+
+# Needs the classes above, hence imported last
+from table import FrameTable
@@ -18,6 +18,7 @@
 #
 
 import math
+import struct
 import collections
 
 _BITPACK_TYPES = {
@@ -25,6 +26,9 @@ _BITPACK_TYPES = {
     'b' : bool
 }
 
+# struct codes used to move whole bytes in and out of a buffer, largest first
+_STRUCT_CODES = (('Q', 8), ('I', 4), ('H', 2), ('B', 1))
+
 class error(Exception):
     pass
 
@@ -42,9 +46,16 @@ class formatstr(object):
     The following types are recognized:
      - int ('i:n'): integer of length n bits
      - boolean ('b'): boolean of length 1 bit
+
+    Each format is compiled into a pair of functions, unpack_from(buffer, offset) and
+    pack_into(buffer, offset, *values), which read or write all of the format's bytes
+    at once and get the fields in and out with constant shifts and masks. They don't
+    check the buffer's length, use bitunpack_from() and bitpack_into() for that.
     """
     format = None
     length = None
+    unpack_from = None
+    pack_into = None
 
     def __init__(self, fmt):
         """__init__(self, fmt) -> new instance
@@ -57,8 +68,10 @@ class formatstr(object):
             raise error('Format needs to be string or Iterable')
 
         self.format = list(self._parse(fmt))
-        self.length = reduce(self._sum, self.format, 0)
-        self.length = int(math.ceil(self.length / 8.0))
+        self.bits = reduce(self._sum, self.format, 0)
+        self.length = int(math.ceil(self.bits / 8.0))
+
+        self._compile()
 
     def __iter__(self):
         for t in self.format:
@@ -92,83 +105,88 @@ class formatstr(object):
 
             yield _BITPACK_TYPES[type], length, default
 
+    def _compile(self):
+        """Generates the source of unpack_from and pack_into and compiles it."""
+        # Split the format's bytes into struct codes, and remember each
+        # code's bit position in the word made up of all bytes
+        codes, shifts = '>', []
+        remaining = self.length
+        for code, size in _STRUCT_CODES:
+            while remaining >= size:
+                codes += code
+                remaining -= size
+                shifts.append((remaining * 8, size * 8))
+
+        names = ['v%d' % i for i in xrange(len(self.format))]
+        parts = ['p%d' % i for i in xrange(len(shifts))]
+        word_bits = self.length * 8
+        is_long = word_bits > 62
+
+        if parts:
+            read = '%s, = _struct.unpack_from(buffer, offset)' % ', '.join(parts)
+            word = ' | '.join('%s << %d' % (part, shift) \
+                for part, (shift, _) in zip(parts, shifts))
+        else:
+            read, word = 'pass', '0'
+
+        unpack = ['def unpack_from(buffer, offset = 0):', '    ' + read, \
+            '    word = %s' % word]
+        pack = ['def pack_into(buffer, offset, %s):' % ', '.join(names + ['*_'])]
+        packed = []
+
+        pos = 0
+        for name, (type, length, default) in zip(names, self.format):
+            shift = word_bits - pos - length
+            mask = (1 << length) - 1
+            pos += length
+
+            if type is bool:
+                unpack.append('    %s = word & 0x%x != 0' % (name, mask << shift))
+                packed.append('(bool(%s) & 0x%x) << %d' % (name, mask, shift))
+            else:
+                value = '(word >> %d) & 0x%x' % (shift, mask)
+                unpack.append('    %s = %s' % (name, is_long and 'int(%s)' % value or value))
+                packed.append('(int(%s) & 0x%x) << %d' % (name, mask, shift))
+
+            if not default is None:
+                unpack.append('    if %s != %d:' % (name, default))
+                unpack.append('        raise invalid_input_error(' \
+                    '\'Parsed value does not match expected default\')')
+
+        unpack.append('    return [%s]' % ', '.join(names))
+
+        # Bits after the format's end are left as they are
+        keep = (1 << (word_bits - self.bits)) - 1
+        pack.append('    word = %s' % (' | '.join(packed) or '0'))
+        if keep:
+            pack.append('    ' + read)
+            pack.append('    word |= (%s) & 0x%x' % (word, keep))
+        if parts:
+            pack.append('    _struct.pack_into(buffer, offset, %s)' % ', '.join( \
+                '(word >> %d) & 0x%x' % (shift, (1 << size) - 1) for shift, size in shifts))
+
+        namespace = {
+            '_struct': struct.Struct(codes),
+            'invalid_input_error': invalid_input_error,
+        }
+        source = '\n'.join(unpack + pack) + '\n'
+        exec compile(source, '<bitpack %r>' % self.format, 'exec') in namespace
+
+        self.unpack_from = namespace['unpack_from']
+        self.pack_into = namespace['pack_into']
+
 def bitpack_into(fmt, buffer, offset, *values):
     fmt = isinstance(fmt, formatstr) and fmt or formatstr(fmt)
 
     if fmt.length > len(buffer) - offset:
         raise error('bitpack_into requires a buffer of at least %d bytes' % fmt.length)
 
-    i = bit_offset = 0
-    for type, length, _ in fmt:
-        bitmask = pow(2, length) - 1
-        value = type(values[i]) & bitmask
-
-        while length > 0:
-            # number of bits of the current value in this byte
-            num_bits = min(8 - bit_offset, length)
-            # number of bits of the current value remaining
-            num_remaining_bits = max(0, length - num_bits)
-            # number of bits of the current byte remaining empty
-            num_empty_bits = 8 - bit_offset - num_bits
-
-            # create bitmask for the leftmost remaining bits
-            bitmask = pow(2, num_bits) - 1 << num_remaining_bits
-            # get bits and right align them
-            bits = (value & bitmask) >> num_remaining_bits
-            # align bits within current byte
-            bits <<= num_empty_bits
-
-            # mask already packed bits on the left
-            bitmask = (pow(2, bit_offset) - 1) << 8 - bit_offset
-            # mask 'unused' bits on the right, if any
-            bitmask |= (pow(2, num_empty_bits)) - 1
-
-            # write value
-            buffer[offset] = (buffer[offset] & bitmask) | bits
-
-            bit_offset = (bit_offset + num_bits) % 8
-            if bit_offset == 0: offset += 1
-            length -= num_bits
-
-        i += 1
-
-#@profile
+    fmt.pack_into(buffer, offset, *values)
+
 def bitunpack_from(fmt, buffer, offset = 0):
     fmt = isinstance(fmt, formatstr) and fmt or formatstr(fmt)
 
     if fmt.length > len(buffer) - offset:
         raise error('bitunpack_from requires a buffer of at least %d bytes' % fmt.length)
 
-    values = []
-    i = bit_offset = 0
-    for type, length, default in fmt:
-        value = 0
-        while length > 0:
-            # number of bits of the current value in this byte
-            num_bits = min(8 - bit_offset, length)
-            # number of bits of the current value remaining
-            num_remaining_bits = max(0, length - num_bits)
-            # number of bits of the current byte remaining empty
-            num_empty_bits = 8 - bit_offset - num_bits
-
-            # create bitmask for bytes interesting to us
-            bitmask = pow(2, num_bits) - 1 << num_empty_bits
-            # read bits and right justify
-            bits = (buffer[offset] & bitmask) >> num_empty_bits
-
-            # merge bits and already read value
-            value |= bits << num_remaining_bits
-
-            bit_offset = (bit_offset + num_bits) % 8
-            if bit_offset == 0: offset += 1
-            length -= num_bits
-
-        i += 1
-        value = type(value)
-        
-        if not default is None and value != default:
-            raise invalid_input_error('Parsed value does not match expected default')
-        
-        values.append(value)
-
-    return values
\ No newline at end of file
+    return fmt.unpack_from(buffer, offset)
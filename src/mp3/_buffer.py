@@ -18,26 +18,58 @@
 #
 
 import struct
+import ctypes
 import _bitpack
 
 class Error(Exception):
     pass
 
+def storage(data):
+    '''
+    storage(data) -> bytearray or ctypes array
+    
+    Returns writeable storage for data, which has to support the buffer
+    protocol. bytearrays, ctypes arrays and writeable objects (e.g. an mmap
+    opened with ACCESS_WRITE or ACCESS_COPY) are used in place. Read-only
+    objects like strings or mmaps opened with ACCESS_READ are copied, and
+    so are memoryviews, as Python 2 does not give access to the object
+    they refer to.
+    '''
+    if isinstance(data, (bytearray, ctypes.Array)):
+        return data
+    if isinstance(data, memoryview):
+        return bytearray(data)
+    
+    try:
+        return (ctypes.c_ubyte * len(data)).from_buffer(data)
+    except TypeError:
+        return bytearray(data)
+
 class ZeroCopyBuffer(object):
     '''
     Implements a buffer object that facilitates zero copy design.
     '''
+    
+    _exported = False
+    # Stream position of the first byte in _buffer
+    _offset = 0
+    # Optional mp3.ReaderStats, counting reads and bytes moved
+    stats = None
 
     def __init__(self, size, fileobj = None, _buffer = None):
         '''
         __init__(size) -> ZeroCopyBuffer object
         
-        Initializes a buffer of specified size.
+        Initializes a buffer of specified size. If _buffer is a bytearray
+        it is used as the buffer's memory as is, anything else is copied.
         '''
         
         self._size = _buffer and len(_buffer) or size
         self._len = _buffer and self._size or 0
-        self._buffer = _buffer and bytearray(_buffer) or bytearray(size)
+        if isinstance(_buffer, bytearray):
+            self._buffer = _buffer
+        else:
+            self._buffer = _buffer and bytearray(_buffer) or bytearray(size)
         self._fileobj = fileobj
         self._has_readinto = hasattr(fileobj, 'readinto')
         self._pos = 0
@@ -87,9 +119,11 @@ class ZeroCopyBuffer(object):
         Pass in None for length if you want all available data. Use this if you need direct
         access to the buffer's contents.
         '''
-        offset = max(0, offset)
-        length = length and self._pos + offset + length or self._len
-        return memoryview(self._buffer)[self._pos + offset:length]
+        start = self._pos + max(0, offset)
+        end = self._len
+        if not length is None:
+            end = min(end, start + length)
+        return memoryview(self._buffer)[start:end]
     
     def fill(self, fileobj = None, completely = False, at_least = None):
         '''
@@ -119,6 +153,10 @@ class ZeroCopyBuffer(object):
             m[:length] = buf
 
         if length: self._len += length
+
+        if self.stats is not None:
+            self.stats.fill_calls += 1
+            self.stats.bytes_read += length or 0
         
         if completely and self._len != self._size:
             raise EOFError
@@ -147,6 +185,23 @@ class ZeroCopyBuffer(object):
         
         return length
     
+    def tell(self):
+        '''tell() -> position in stream
+        
+        Returns the position of the buffer's first byte in the stream it is
+        read from.
+        '''
+        return self._offset + self._pos
+    
+    def discard(self, position):
+        '''discard(position) -> nothing
+        
+        Empties the buffer after its file object has been moved to position
+        behind its back.
+        '''
+        self._pos = self._len
+        self._offset = position - self._pos
+    
     def delete(self, num):
         '''delete(num) -> nothing
         
@@ -194,17 +249,32 @@ class ZeroCopyBuffer(object):
         fmt = isinstance(fmt, _bitpack.formatstr) and fmt or _bitpack.formatstr(fmt)
         self._bitpack_check_length(fmt, offset)
         
-        return _bitpack.bitunpack_from(fmt, self._buffer, self._pos + offset)
+        return fmt.unpack_from(self._buffer, self._pos + offset)
     
     def bitpack(self, fmt, offset = 0, *vals):
         fmt = isinstance(fmt, _bitpack.formatstr) and fmt or _bitpack.formatstr(fmt)
         self._bitpack_check_length(fmt, offset)
         
-        return _bitpack.bitpack_into(fmt, self._buffer, self._pos + offset, *vals)
+        return fmt.pack_into(self._buffer, self._pos + offset, *vals)
         
     def _shift_buffer(self):
         length = len(self)
+        if self._exported and self._pos != 0:
+            # Windows still point into the current memory, which is kept
+            # alive by them. Continue in a fresh one instead of overwriting it.
+            buf = bytearray(self._size)
+            buf[0:length] = self.view()
+            if self.stats is not None:
+                self.stats.bytes_shifted += length
+            self._buffer = buf
+            self._exported = False
+            self._offset += self._pos
+            self._pos = 0
+            self._len = length
+            return
+        
         if length == 0:
+            self._offset += self._pos
             self._pos = 0
             self._len = 0
             return
@@ -215,6 +285,9 @@ class ZeroCopyBuffer(object):
         
         source = self.view()
         memoryview(self._buffer)[0:length] = source
+        if self.stats is not None:
+            self.stats.bytes_shifted += length
+        self._offset += self._pos
         self._pos = 0
         self._len = length
         
@@ -227,4 +300,89 @@ class ZeroCopyBuffer(object):
         '''
         pos = min(self._len, self._pos + offset)
         return self._buffer.startswith(prefix, pos, self._len)
+
+    def search(self, pattern, offset = 0):
+        '''
+        search(pattern, offset = 0) -> offset of the first match or -1
+        
+        Searches the buffer for a compiled regular expression, starting at
+        the specified offset.
+        '''
+        match = pattern.search(self._buffer, self._pos + max(0, offset), self._len)
+        if match is None:
+            return -1
+        return match.start() - self._pos
+    
+    def match(self, pattern, offset = 0):
+        '''
+        match(pattern, offset = 0) -> bool
+        
+        Tests if a compiled regular expression matches at the specified offset.
+        '''
+        return pattern.match(self._buffer, self._pos + max(0, offset), self._len) is not None
+    
+    def window(self, offset = 0, length = None):
+        '''
+        window(offset = 0, length = None) -> MappedBuffer
+        
+        Returns a buffer sharing this buffer's memory, from the specified offset
+        and of specified length. Pass in None for length if you want all available
+        data. No data is copied, so writes to the window are visible here and
+        vice versa. The memory is not reused by fill() as long as the window
+        is alive.
+        '''
+        start = min(self._len, self._pos + max(0, offset))
+        end = self._len
+        if not length is None:
+            end = min(end, start + length)
+        
+        window = MappedBuffer.__new__(MappedBuffer)
+        window._init_storage(self._buffer, start, end)
+        window._offset = self._offset
+        self._exported = True
+        return window
+
+class MappedBuffer(ZeroCopyBuffer):
+    '''
+    Implements a ZeroCopyBuffer over data that is already in memory, like an
+    mmap or a bytearray. The data is never copied or moved around, which makes
+    fill() a no-op.
+    '''
+    
+    def __init__(self, data):
+        '''
+        __init__(data) -> MappedBuffer object
+        
+        Wraps data, which is used in place or copied as storage() does.
+        Objects that are parsed repeatedly should be passed through
+        storage() once, so that they are only copied once.
+        '''
+        self._init_storage(storage(data), 0, len(data))
+    
+    def _init_storage(self, storage, start, end):
+        self._buffer = storage
+        self._pos = start
+        self._len = self._size = end
+        self._fileobj = None
+        self._has_readinto = False
+    
+    def fill(self, fileobj = None, completely = False, at_least = None):
+        '''
+        fill(fileobj = None) -> nothing
+        
+        All data is available right away, so this only raises an EOFError
+        if the buffer does not have at_least bytes.
+        '''
+        if not at_least is None and len(self) < at_least:
+            raise EOFError
+    
+    def extend(self, buf):
+        raise Error('can not extend a mapped buffer')
+    
+    def _shift_buffer(self):
+        pass
+    
+    def startswith(self, prefix, offset = 0):
+        pos = min(self._len, self._pos + offset)
+        return memoryview(self._buffer)[pos:pos + len(prefix)] == prefix
     
\ No newline at end of file
@@ -36,13 +36,24 @@ _CRC16_TABLE = [
     0x8213, 0x0216, 0x021c, 0x8219, 0x0208, 0x820d, 0x8207, 0x0202
 ]
 
-def crc16(data):
+def crc16(data, bits = None):
     """Calculate CRC16 using the given table.
     `data`      - data for calculating CRC, must be a memoryview
+    `bits`      - number of leading bits of data to use, default: all of it
     Return calculated value of CRC
     """
     crc = 0xffff
 
+    if bits is not None:
+        bits, data = bits % 8, data[:bits / 8 + (bits % 8 and 1)]
+        if bits:
+            data, last = data[:-1], ord(data[-1])
+
     for byte in data:
         crc = ((crc<<8)&0xff00) ^ _CRC16_TABLE[((crc>>8)&0xff)^ord(byte)]
+
+    # Trailing bits, one at a time
+    for shift in xrange(7, 7 - (bits or 0), -1):
+        bit = (crc >> 15 ^ last >> shift) & 1
+        crc = (crc << 1) & 0xffff ^ (bit and 0x8005)
     return crc & 0xffff
\ No newline at end of file
@@ -0,0 +1,232 @@
+#
+# duplicates.py -- Finding MP3 files with identical audio
+# Copyright (C) 2012 Lorenz Bauer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Finding MP3 files with identical audio.
+
+Two files are duplicates if their MPEG frames are the same, whatever their
+tags. Candidates are narrowed down in four steps, each one more expensive
+than the one before but only applied to the files left over by it:
+
+  1. the Xing or VBRI frame, or else the length of the audio, as told by
+     the first frames and the tags at the end (audio_span()),
+  2. the number and total size of the audio frames (audio_profile()),
+  3. a hash of the first and last few audio frames (partial_digest()),
+  4. a hash of all audio frames (mp3.audio_digest()).
+
+What is found out about a file in each step can be kept in a DigestCache,
+so that unchanged files are not read again the next time.
+"""
+
+import os
+import sqlite3
+import hashlib
+from itertools import islice
+from collections import deque
+
+from mp3 import Reader, audio_digest
+
+__all__ = ['DigestCache', 'audio_profile', 'audio_span', 'find_duplicates', 'partial_digest']
+
+# Audio frames partial_digest() hashes at the beginning and the end of a file
+PARTIAL_FRAMES = 16
+# Longest possible MPEG frame (MPEG-2.5 Layer II, 160 kbit/s, 8 kHz, padded)
+_MAX_FRAME_LENGTH = 2881
+
+def _audio_frames(reader, fields):
+    return reader.frames(emit_meta_frames = False, emit_riff_frames = False, \
+        emit_id3_frames = False, emit_ape_frames = False, fields = fields)
+
+def audio_span(fileobj):
+    """audio_span(fileobj) -> key or None
+
+    Returns what the first frames and the tags at the end of a file tell
+    about its audio: its Xing or VBRI frame if it has one, else its first
+    audio frame header and the number of bytes from there to the tags.
+    Files with the same audio have the same span, unless it is surrounded
+    by other data than ID3, APE and RIFF frames. Returns None for files
+    without audio frames.
+    """
+    reader = Reader(fileobj)
+    reader._probe()
+    header = reader._first_header
+    if header is None:
+        return None
+
+    if reader._vbr_frame is not None:
+        return str(reader._vbr_frame.bytes())
+    return str(reader._read_at(header.offset, 4)), reader._audio_end() - reader._audio_start
+
+def audio_profile(fileobj):
+    """audio_profile(fileobj) -> (frames, size)
+
+    Returns the number of audio frames in a file and their total size in
+    bytes. Only the frame headers are decoded.
+    """
+    frames = size = 0
+    with Reader(fileobj, use_mmap = True) as reader:
+        for length, in _audio_frames(reader, ('length',)):
+            frames += 1
+            size += length
+    return frames, size
+
+def partial_digest(fileobj, frames = PARTIAL_FRAMES, name = 'sha1'):
+    """partial_digest(fileobj, frames = PARTIAL_FRAMES, name = 'sha1') -> hex digest
+
+    Hashes the first and the last few audio frames of a file, see
+    mp3.audio_digest(). The last frames are searched for from where that
+    many frames of the longest possible size would start before the tags
+    at the end, so that the rest of the file is not read. Files with the
+    same audio_span() and the same audio have the same partial digest.
+    """
+    digest = hashlib.new(name)
+    with Reader(fileobj, use_mmap = True) as reader:
+        reader._probe()
+        reader._set_position(reader._start)
+        head = list(islice(_audio_frames(reader, ('offset', 'length', 'data')), frames))
+
+        tail = []
+        if len(head) == frames:
+            start = head[-1].offset + head[-1].length
+            position = max(start, reader._audio_end() - frames * _MAX_FRAME_LENGTH)
+            reader._set_position(position, position != start)
+            tail = deque(_audio_frames(reader, ('offset', 'length', 'data')), maxlen = frames)
+
+        # The frames are windows into the mapped file
+        for frame in head + list(tail):
+            digest.update(frame.data)
+    return digest.hexdigest()
+
+class DigestCache(object):
+    """Remembers the profiles and digests of files, as long as their size
+    and modification time don't change."""
+
+    _COLUMNS = ('frames', 'size', 'partial_frames', 'partial', 'digest', 'span')
+
+    def __init__(self, path = ':memory:'):
+        self._db = sqlite3.connect(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, '
+            'file_size INTEGER, mtime REAL, frames INTEGER, size INTEGER, '
+            'partial_frames INTEGER, partial TEXT, digest TEXT, span TEXT)')
+        # Caches written before spans were kept
+        columns = [row[1] for row in self._db.execute('PRAGMA table_info(files)')]
+        if 'span' not in columns:
+            self._db.execute('ALTER TABLE files ADD COLUMN span TEXT')
+        self._db.commit()
+
+    def get(self, path):
+        """get(path) -> dict
+
+        Returns what is known about the file at path, an empty dict if it
+        is not in the cache or has changed since.
+        """
+        path = os.path.abspath(path)
+        entry = self._db.execute('SELECT file_size, mtime, %s FROM files WHERE path = ?' % \
+            ', '.join(self._COLUMNS), (path,)).fetchone()
+        if entry is None:
+            return {}
+
+        stat = os.stat(path)
+        if tuple(entry[:2]) != (stat.st_size, stat.st_mtime):
+            return {}
+
+        return dict((name, value) for name, value in zip(self._COLUMNS, entry[2:]) \
+            if value is not None)
+
+    def update(self, path, **values):
+        """update(path, **values) -> nothing
+
+        Records values (frames, size, partial_frames, partial, digest or
+        span) for the file at path, in addition to what is known about it.
+        """
+        entry = self.get(path)
+        entry.update(values)
+
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', \
+            (path, stat.st_size, stat.st_mtime) + \
+            tuple(entry.get(name) for name in self._COLUMNS))
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+def _group(paths, key):
+    """Groups paths by key(path), leaving out groups of one, paths key()
+    returns None for and paths that can't be read."""
+    groups = {}
+    for path in paths:
+        try:
+            value = key(path)
+        except EnvironmentError:
+            continue
+        if value is not None:
+            groups.setdefault(value, []).append(path)
+    return [group for group in groups.values() if len(group) > 1]
+
+def find_duplicates(paths, cache = None, frames = PARTIAL_FRAMES):
+    """find_duplicates(paths, cache = None, frames = PARTIAL_FRAMES) -> list of lists of paths
+
+    Returns the groups of files among paths that have the same audio, see
+    partial_digest() for frames. cache is an optional DigestCache. Files
+    without audio frames are ignored.
+    """
+    cache = cache or DigestCache()
+
+    def span(path):
+        # Spans hold binary data, only a digest of them is kept
+        entry = cache.get(path)
+        if 'span' not in entry:
+            with open(path, 'rb') as f:
+                value = audio_span(f)
+            entry['span'] = value is not None and hashlib.sha1(repr(value)).hexdigest() or ''
+            cache.update(path, span = entry['span'])
+        return entry['span'] or None
+
+    def profile(path):
+        entry = cache.get(path)
+        if 'frames' not in entry:
+            with open(path, 'rb') as f:
+                entry['frames'], entry['size'] = audio_profile(f)
+            cache.update(path, frames = entry['frames'], size = entry['size'])
+        return entry['frames'] and (entry['frames'], entry['size']) or None
+
+    def partial(path):
+        entry = cache.get(path)
+        if 'partial' not in entry or entry.get('partial_frames') != frames:
+            with open(path, 'rb') as f:
+                entry['partial'] = partial_digest(f, frames)
+            cache.update(path, partial = entry['partial'], partial_frames = frames)
+        return entry['partial']
+
+    def digest(path):
+        entry = cache.get(path)
+        if 'digest' not in entry:
+            with open(path, 'rb') as f:
+                entry['digest'] = audio_digest(f)
+            cache.update(path, digest = entry['digest'])
+        return entry['digest']
+
+    duplicates = []
+    for spans in _group(paths, span):
+        for candidates in _group(spans, profile):
+            for group in _group(candidates, partial):
+                duplicates.extend(_group(group, digest))
+
+    return sorted(sorted(group) for group in duplicates)
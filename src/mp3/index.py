@@ -0,0 +1,335 @@
+#
+# index.py -- Persistent frame indexes for MP3 files
+# Copyright (C) 2012 Lorenz Bauer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Frame indexes for MP3 files.
+
+An index lists the byte offset, size and cumulative sample count of every
+audio frame in a file. It is built in one pass over the file and can be
+stored in a sidecar file next to it (or in a cache directory), so that
+seeking and computing the duration of a file don't require a rescan the
+next time it is opened.
+
+Sidecar files are keyed by the size, modification time and a hash of the
+head and tail of the file they describe; stale indexes are ignored.
+"""
+
+import os
+import struct
+import hashlib
+from array import array
+from bisect import bisect_right
+
+from mp3 import Reader
+
+__all__ = ['FrameIndex', 'build', 'dumps', 'file_key', 'load', 'load_or_build', 'loads', \
+    'save', 'sidecar_path']
+
+SUFFIX = '.mp3idx'
+
+_MAGIC = 'MP3IDX'
+_VERSION = 1
+# magic, version, file size, mtime, head/tail digest, samplingrate, frame count
+_HEADER = struct.Struct('>6sBQd20sII')
+# Bytes hashed at the beginning and the end of a file
+_KEY_BLOCK_SIZE = 64 * 1024
+
+def _typecode():
+    """Returns an unsigned 64 bit array typecode. 'L' is only 32 bits wide
+    on Windows and 32 bit builds, and 'Q' is missing before Python 3.3;
+    without either, values past 4 GiB are rejected by FrameIndex.append()."""
+    for code in ('L', 'Q'):
+        try:
+            if array(code).itemsize >= 8:
+                return code
+        except ValueError:
+            pass
+    return 'L'
+
+_TYPECODE = _typecode()
+
+class FrameIndex(object):
+    """Byte offsets, sizes and cumulative sample counts of audio frames."""
+
+    key = None
+    samplingrate = 0
+
+    def __init__(self, key = None, samplingrate = 0):
+        self.key = key
+        self.samplingrate = samplingrate
+        self.offsets = array(_TYPECODE)
+        self.sizes = array(_TYPECODE)
+        # Samples up to and including the frame
+        self.samples = array(_TYPECODE)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, offset, size, samples):
+        total = self.total_samples + samples
+        limit = 1 << (8 * self.offsets.itemsize)
+        if offset + size > limit or total >= limit:
+            raise ValueError, 'files past %d bytes or samples can\'t be indexed ' \
+                'on this platform' % limit
+
+        self.offsets.append(offset)
+        self.sizes.append(size)
+        self.samples.append(total)
+
+    @property
+    def total_samples(self):
+        return self.samples[-1] if self.samples else 0
+
+    @property
+    def duration(self):
+        """Running time in seconds."""
+        if not self.samplingrate:
+            return 0.0
+        return float(self.total_samples) / self.samplingrate
+
+    def find_sample(self, sample):
+        """find_sample(sample) -> frame number
+
+        Returns the number of the frame containing sample, or len(index)
+        if sample lies beyond the end of the file.
+        """
+        return bisect_right(self.samples, max(sample, 0))
+
+    def find_time(self, seconds):
+        """find_time(seconds) -> frame number
+
+        Returns the number of the frame playing at the given time.
+        """
+        return self.find_sample(int(seconds * self.samplingrate))
+
+    def __eq__(self, other):
+        return isinstance(other, FrameIndex) and \
+            (self.key, self.samplingrate, self.offsets, self.sizes, self.samples) == \
+            (other.key, other.samplingrate, other.offsets, other.sizes, other.samples)
+
+    def __ne__(self, other):
+        return not self == other
+
+def _encode_varint(out, value):
+    while value > 0x7f:
+        out.append(0x80 | (value & 0x7f))
+        value >>= 7
+    out.append(value)
+
+def _zigzag(value):
+    return (value << 1) if value >= 0 else ((-value << 1) - 1)
+
+def _unzigzag(value):
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1)
+
+def _decode_varints(data, offset = 0):
+    value = 0
+    shift = 0
+    for i in xrange(offset, len(data)):
+        byte = data[i]
+        if byte < 0x80:
+            yield value | (byte << shift)
+            value = 0
+            shift = 0
+        else:
+            value |= (byte & 0x7f) << shift
+            shift += 7
+
+    if shift:
+        raise ValueError, 'truncated varint'
+
+def file_key(fileobj):
+    """file_key(fileobj) -> (size, mtime, digest)
+
+    Identifies the contents of a file without reading all of it. The file
+    position is preserved.
+    """
+    position = fileobj.tell()
+    try:
+        try:
+            mtime = os.fstat(fileobj.fileno()).st_mtime
+        except (AttributeError, EnvironmentError):
+            mtime = 0.0
+
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell()
+
+        digest = hashlib.sha1()
+        fileobj.seek(0)
+        digest.update(fileobj.read(_KEY_BLOCK_SIZE))
+        if size > _KEY_BLOCK_SIZE:
+            fileobj.seek(max(size - _KEY_BLOCK_SIZE, _KEY_BLOCK_SIZE))
+            digest.update(fileobj.read(_KEY_BLOCK_SIZE))
+    finally:
+        fileobj.seek(position)
+
+    return (size, mtime, digest.digest())
+
+def build(fileobj):
+    """build(fileobj) -> FrameIndex
+
+    Builds the index of a file-like object in one pass, starting at its
+    beginning. Raises ValueError if the file is too large to be indexed on
+    this platform, see FrameIndex.append().
+    """
+    index = FrameIndex(file_key(fileobj))
+
+    fileobj.seek(0)
+    with Reader(fileobj, use_mmap = True) as reader:
+        for header in reader.headers():
+            if not index.samplingrate:
+                index.samplingrate = header.samplingrate
+            index.append(header.offset, header.frame_length(), header.samples())
+
+    return index
+
+def dumps(index):
+    """dumps(index) -> str
+
+    Serializes an index. Offsets are stored as the gap to the end of the
+    previous frame, sizes and sample counts as the difference to the
+    previous frame; all of them as varints.
+    """
+    size, mtime, digest = index.key
+    out = bytearray(_HEADER.pack(_MAGIC, _VERSION, size, mtime, digest,
+        index.samplingrate, len(index)))
+
+    end = 0
+    last_length = 0
+    last_samples = 0
+    total = 0
+    for offset, length, cumulative in zip(index.offsets, index.sizes, index.samples):
+        samples = cumulative - total
+        _encode_varint(out, offset - end)
+        _encode_varint(out, _zigzag(length - last_length))
+        _encode_varint(out, _zigzag(samples - last_samples))
+
+        end = offset + length
+        last_length = length
+        last_samples = samples
+        total = cumulative
+
+    return str(out)
+
+def loads(data):
+    """loads(data) -> FrameIndex
+
+    Deserializes an index, raises ValueError if data is not a valid index.
+    """
+    if len(data) < _HEADER.size:
+        raise ValueError, 'truncated index'
+
+    magic, version, size, mtime, digest, samplingrate, count = \
+        _HEADER.unpack_from(data)
+
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError, 'not an index or unsupported version'
+
+    index = FrameIndex((size, mtime, digest), samplingrate)
+
+    values = _decode_varints(bytearray(data), _HEADER.size)
+    offsets = index.offsets
+    sizes = index.sizes
+    cumulative = index.samples
+
+    end = 0
+    length = 0
+    samples = 0
+    total = 0
+    try:
+        for i in xrange(count):
+            offset = end + values.next()
+            length += _unzigzag(values.next())
+            samples += _unzigzag(values.next())
+            total += samples
+
+            offsets.append(offset)
+            sizes.append(length)
+            cumulative.append(total)
+            end = offset + length
+    except (StopIteration, OverflowError):
+        raise ValueError, 'truncated index'
+
+    for value in values:
+        raise ValueError, 'trailing data in index'
+
+    return index
+
+def sidecar_path(path, cache_dir = None):
+    """sidecar_path(path, cache_dir = None) -> path
+
+    Returns where the index of the file at path is stored; next to it or,
+    if cache_dir is given, in cache_dir under a name derived from path.
+    """
+    if cache_dir is None:
+        return path + SUFFIX
+
+    name = hashlib.sha1(os.path.abspath(path)).hexdigest()
+    return os.path.join(cache_dir, name + SUFFIX)
+
+def save(index, path, cache_dir = None):
+    """save(index, path, cache_dir = None)
+
+    Writes the index of the file at path to its sidecar file.
+    """
+    target = sidecar_path(path, cache_dir)
+    temp = target + '.tmp'
+
+    with open(temp, 'wb') as f:
+        f.write(dumps(index))
+    os.rename(temp, target)
+
+def load(path, cache_dir = None):
+    """load(path, cache_dir = None) -> FrameIndex or None
+
+    Reads the index of the file at path from its sidecar file. Returns None
+    if there is no index, or if it is corrupt or stale.
+    """
+    try:
+        with open(sidecar_path(path, cache_dir), 'rb') as f:
+            index = loads(f.read())
+
+        with open(path, 'rb') as f:
+            key = file_key(f)
+    except (EnvironmentError, ValueError, struct.error):
+        return None
+
+    if index.key != key:
+        return None
+
+    return index
+
+def load_or_build(path, cache_dir = None):
+    """load_or_build(path, cache_dir = None) -> FrameIndex
+
+    Loads the index of the file at path, or builds and saves it if there is
+    no valid index yet. Failure to save the index is not an error.
+    """
+    index = load(path, cache_dir)
+    if index is not None:
+        return index
+
+    with open(path, 'rb') as f:
+        index = build(f)
+
+    try:
+        save(index, path, cache_dir)
+    except EnvironmentError:
+        pass
+
+    return index
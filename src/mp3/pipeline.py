@@ -0,0 +1,236 @@
+#
+# pipeline.py -- Single pass frame processing pipelines
+# Copyright (C) 2012 Lorenz Bauer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Frame processing pipelines.
+
+A pipeline passes the frames of a single Reader.frames() pass through a
+list of stages and hands the result to any number of sinks, so that e.g.
+writing a sanitized file, hashing it and gathering statistics only takes
+one read of the input.
+
+Stages are callables taking a frame and returning it (possibly modified),
+or None to drop it. Sinks have a write(frame) and a close() method.
+"""
+
+import mmap
+import hashlib
+from random import getrandbits
+
+from mp3 import Reader, MPEGFrame, XingFrame, VBRIFrame, ID3Frame, APEFrame, FrameWriter
+from mp3.index import FrameIndex, file_key, save
+
+__all__ = ['Pipeline', 'DropFrames', 'MangleHeaders', 'FixCRC', 'FileSink', 'DigestSink', \
+           'StatsSink', 'IndexSink', 'run_in_place']
+
+class Pipeline(object):
+    """Passes frames through stages and on to sinks."""
+
+    def __init__(self, stages = (), sinks = ()):
+        self.stages = list(stages)
+        self.sinks = list(sinks)
+
+    def run(self, frames, abort = None):
+        """run(frames, abort = None) -> bool
+
+        Processes an iterable of frames, usually Reader.frames(), and closes
+        all sinks. abort is called after every frame, processing stops if it
+        returns True. Returns False if processing was aborted.
+        """
+        stages = self.stages
+        writers = [sink.write for sink in self.sinks]
+
+        try:
+            for frame in frames:
+                for stage in stages:
+                    frame = stage(frame)
+                    if frame is None:
+                        break
+                else:
+                    for write in writers:
+                        write(frame)
+
+                if abort and abort():
+                    return False
+        finally:
+            for sink in self.sinks:
+                sink.close()
+
+        return True
+
+def run_in_place(fileobj, stages, abort = None, stats = None):
+    """run_in_place(fileobj, stages, abort = None, stats = None) -> bool
+
+    Runs stages over the frames of a file opened for reading and writing,
+    changing it in place. The file is memory-mapped and frames are windows
+    into it, so changes a stage makes to a frame (e.g. through
+    MPEGFrame.commit_header()) end up in the file without anything else
+    being written. Stages must not drop frames, nor keep them: the mapping
+    is closed before returning. Returns False if processing was aborted.
+    stats is an optional mp3.ReaderStats for the Reader.
+    """
+    data = mmap.mmap(fileobj.fileno(), 0, access = mmap.ACCESS_WRITE)
+    try:
+        frames = Reader(data, stats = stats).frames(skip_invalid_data = True)
+        try:
+            completed = Pipeline(stages).run(frames, abort)
+        finally:
+            frames.close()
+        data.flush()
+    finally:
+        data.close()
+
+    return completed
+
+class DropFrames(object):
+    """Stage dropping frames of the given types."""
+
+    def __init__(self, *frame_types):
+        self.frame_types = frame_types
+
+    def __call__(self, frame):
+        if isinstance(frame, self.frame_types):
+            return None
+        return frame
+
+class MangleHeaders(object):
+    """Stage randomizing the private and original bits of MPEG headers,
+    which changes a file's hash without changing its audio."""
+
+    def __init__(self, randbits = getrandbits):
+        self.randbits = randbits
+
+    def __call__(self, frame):
+        if isinstance(frame, MPEGFrame):
+            frame.header.private = self.randbits(1)
+            frame.header.original = self.randbits(1)
+            frame.commit_header()
+        return frame
+
+class FixCRC(object):
+    """Stage correcting the CRC of MPEG frames that carry a wrong one."""
+
+    fixed = 0
+
+    def __call__(self, frame):
+        header = isinstance(frame, MPEGFrame) and frame.header
+        if header and header.crc and not header.valid():
+            frame.commit_header()
+            header._crc16 = header.calculate_crc()
+            self.fixed += 1
+        return frame
+
+class FileSink(object):
+    """Sink writing frames to a file-like object, batching them into large
+    writes (see mp3.FrameWriter)."""
+
+    def __init__(self, fileobj, close = False, buffer_size = 256 * 1024):
+        self.fileobj = fileobj
+        self._close = close
+        self._writer = FrameWriter(fileobj, buffer_size)
+        self.write = self._writer.write_frame
+
+    def close(self):
+        self._writer.flush()
+        if self._close:
+            self.fileobj.close()
+
+class DigestSink(object):
+    """Sink hashing the frames' data."""
+
+    def __init__(self, name = 'sha1'):
+        self._hash = hashlib.new(name)
+
+    def write(self, frame):
+        self._hash.update(frame.view)
+
+    def close(self):
+        pass
+
+    def digest(self):
+        return self._hash.digest()
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+class StatsSink(object):
+    """Sink collecting statistics about the frames."""
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.meta_frames = 0
+        self.audio_frames = 0
+        self.duration = 0.0
+        # Number of audio frames by bitrate
+        self.bitrates = {}
+
+    def write(self, frame):
+        self.frames += 1
+        self.bytes += frame.length
+
+        if isinstance(frame, MPEGFrame):
+            if isinstance(frame, (XingFrame, VBRIFrame)):
+                return
+
+            header = frame.header
+            self.audio_frames += 1
+            self.duration += header.time()
+            self.bitrates[header.bitrate] = self.bitrates.get(header.bitrate, 0) + 1
+        elif isinstance(frame, (ID3Frame, APEFrame)):
+            self.meta_frames += 1
+
+    def close(self):
+        pass
+
+    @property
+    def average_bitrate(self):
+        """Average bitrate of the audio frames in kbit/s."""
+        if not self.audio_frames:
+            return 0.0
+        return sum(bitrate * count for bitrate, count in self.bitrates.items()) / \
+            float(self.audio_frames)
+
+class IndexSink(object):
+    """Sink building a frame index (see mp3.index) of the frames as they
+    are written, i.e. with offsets relative to the output."""
+
+    def __init__(self):
+        self.index = FrameIndex()
+        self._position = 0
+
+    def write(self, frame):
+        if isinstance(frame, MPEGFrame) and not isinstance(frame, (XingFrame, VBRIFrame)):
+            header = frame.header
+            if not self.index.samplingrate:
+                self.index.samplingrate = header.samplingrate
+            self.index.append(self._position, frame.length, header.samples())
+
+        self._position += frame.length
+
+    def close(self):
+        pass
+
+    def save(self, path, cache_dir = None):
+        """save(path, cache_dir = None) -> nothing
+
+        Saves the index as the index of the (finished) file at path.
+        """
+        with open(path, 'rb') as f:
+            self.index.key = file_key(f)
+        save(self.index, path, cache_dir)
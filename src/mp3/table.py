@@ -0,0 +1,325 @@
+#
+# table.py -- Column-oriented frame tables for MP3 files
+# Copyright (C) 2012 Lorenz Bauer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Frame tables for MP3 files.
+
+A FrameTable holds the properties of every audio frame of a file as NumPy
+arrays, one per property, instead of one Header object per frame. Tables
+are built without parsing frames one by one: sync candidates are found and
+their headers decoded with array operations over the memory-mapped file,
+and the frames are then picked out by following frame lengths from one
+candidate to the next.
+
+NumPy is an optional dependency (pip install "MP3 Tools[table]"), the rest
+of the package works without it.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from mp3 import Reader, Header, MP3FrameHeaderError
+
+__all__ = ['FrameTable']
+
+# Bytes searched for sync candidates at a time, bounds temporary arrays
+_BLOCK_SIZE = 16 * 1024 * 1024
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError, 'FrameTable requires NumPy'
+
+class FrameTable(object):
+    """Byte offsets, lengths and header fields of audio frames, stored as
+    columns of NumPy arrays."""
+
+    COLUMNS = (
+        ('offset',       'i8'),
+        ('length',       'i4'),
+        ('bitrate',      'i2'),
+        ('samplingrate', 'i4'),
+        ('channelmode',  'u1'),
+        ('padding',      '?'),
+        ('crc',          '?'),
+    )
+
+    # Frame length, bitrate and samplingrate by the header bits they depend
+    # on, see _header_tables()
+    _TABLES = None
+
+    def __init__(self, **columns):
+        """__init__(**columns)
+
+        Creates a table from arrays (or sequences) named after COLUMNS.
+        Missing columns are empty.
+        """
+        _require_numpy()
+
+        for name, dtype in self.COLUMNS:
+            setattr(self, name, numpy.asarray(columns.get(name, ()), dtype = dtype))
+
+    def __len__(self):
+        return len(self.offset)
+
+    def __eq__(self, other):
+        return isinstance(other, FrameTable) and \
+            all(numpy.array_equal(getattr(self, name), getattr(other, name)) \
+                for name, dtype in self.COLUMNS)
+
+    def __ne__(self, other):
+        return not self == other
+
+    @classmethod
+    def build(cls, fileobj):
+        """build(fileobj) -> FrameTable
+
+        Builds the table of a file-like object, starting at its current
+        position. Regular files are memory-mapped, anything else is read
+        into memory first; either way, offsets are from the beginning of
+        the file. Tags and Xing or VBRI frames are not part of the table.
+        """
+        _require_numpy()
+
+        # Where the data read into memory starts in the file
+        start = 0
+        reader = Reader(fileobj, use_mmap = True)
+        if reader._data is None:
+            try:
+                start = fileobj.tell()
+            except (AttributeError, EnvironmentError):
+                pass
+            reader = Reader(bytearray(fileobj.read()))
+
+        with reader:
+            reader._probe()
+            if reader._audio_start is None:
+                return cls()
+
+            data = numpy.frombuffer(reader._data, dtype = numpy.uint8)
+            table = cls._from_array(data, reader._audio_start, reader._audio_end())
+
+        table.offset += start
+        return table
+
+    @classmethod
+    def _from_array(cls, data, start, end):
+        lengths, bitrates, samplingrates = cls._header_tables()
+
+        offsets, keys = _candidates(data, start, end)
+        frame_lengths = lengths[keys]
+
+        # Only keep candidates with a valid header that fit into the data
+        valid = (frame_lengths > 0) & (offsets + frame_lengths <= end)
+        offsets, keys, frame_lengths = offsets[valid], keys[valid], frame_lengths[valid]
+
+        selected = _chain(offsets, frame_lengths, start, end)
+        offsets, keys = offsets[selected], keys[selected]
+
+        return cls(offset = offsets,
+            length = frame_lengths[selected],
+            bitrate = bitrates[keys],
+            samplingrate = samplingrates[keys],
+            channelmode = data[offsets + 3] >> 6,
+            padding = keys & 0x2,
+            crc = ~keys & 0x100)
+
+    @classmethod
+    def _header_tables(cls):
+        """_header_tables() -> (lengths, bitrates, samplingrates)
+
+        Returns lookup tables indexed by the second and third byte of a frame
+        header, minus the sync bits. Invalid headers have a length of 0.
+        """
+        if cls._TABLES is not None:
+            return cls._TABLES
+
+        lengths = numpy.zeros(1 << 13, dtype = numpy.int32)
+        bitrates = numpy.zeros(1 << 13, dtype = numpy.int16)
+        samplingrates = numpy.zeros(1 << 13, dtype = numpy.int32)
+
+        for key in xrange(1 << 13):
+            info = Header._decode_uncached(0xffe00000 | key << 8)
+            if isinstance(info, MP3FrameHeaderError):
+                continue
+
+            header = Header(None)
+            header.__dict__.update(info.fields)
+            lengths[key] = info.frame_length
+            bitrates[key] = header.bitrate
+            samplingrates[key] = header.samplingrate
+
+        FrameTable._TABLES = (lengths, bitrates, samplingrates)
+        return FrameTable._TABLES
+
+    def to_records(self):
+        """to_records() -> structured NumPy array
+
+        Returns the table as one record per frame.
+        """
+        records = numpy.empty(len(self), dtype = list(self.COLUMNS))
+        for name, dtype in self.COLUMNS:
+            records[name] = getattr(self, name)
+        return records
+
+    @classmethod
+    def from_records(cls, records):
+        """from_records(records) -> FrameTable
+
+        Creates a table from a structured array as returned by to_records().
+        """
+        return cls(**dict((name, records[name]) for name, dtype in cls.COLUMNS))
+
+    def save(self, path):
+        """save(path) -> nothing
+
+        Writes the table to path, as one array per column if path ends in
+        .npz, or as a single structured array (.npy) otherwise.
+        """
+        if path.endswith('.npz'):
+            numpy.savez(path, **dict((name, getattr(self, name)) \
+                for name, dtype in self.COLUMNS))
+        else:
+            numpy.save(path, self.to_records())
+
+    @classmethod
+    def load(cls, path):
+        """load(path) -> FrameTable
+
+        Reads a table written by save().
+        """
+        _require_numpy()
+
+        data = numpy.load(path)
+        if path.endswith('.npz'):
+            try:
+                return cls(**dict(data.items()))
+            finally:
+                data.close()
+
+        return cls.from_records(data)
+
+def _candidates(data, start, end):
+    """_candidates(data, start, end) -> (offsets, keys)
+
+    Finds the positions of frame sync words between start and end, and the
+    13 header bits following the sync bits (see FrameTable._header_tables()).
+    """
+    offsets = []
+    keys = []
+
+    for position in xrange(start, max(start, end - 3), _BLOCK_SIZE):
+        stop = min(position + _BLOCK_SIZE, end - 3)
+        first = data[position:stop]
+        second = data[position + 1:stop + 1]
+
+        found = numpy.flatnonzero((first == 0xff) & (second >= 0xe0)) + position
+        offsets.append(found)
+        keys.append((data[found + 1].astype(numpy.int32) & 0x1f) << 8 | data[found + 2])
+
+    if not offsets:
+        return numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.int32)
+
+    return numpy.concatenate(offsets).astype(numpy.int64), numpy.concatenate(keys)
+
+def _chain(offsets, lengths, start, end):
+    """_chain(offsets, lengths, start, end) -> indices
+
+    Picks the frames out of the candidates at offsets, like Reader.frames():
+    starting at start, each frame is followed by the one its length points
+    to. If there is none, the next candidate followed by
+    Reader._SYNC_FRAMES valid frames (or the end) starts a new chain.
+    """
+    count = len(offsets)
+    if not count:
+        return numpy.zeros(0, numpy.int64)
+
+    # Index of the candidate following each candidate, count if there is none
+    following = offsets + lengths
+    successor = numpy.searchsorted(offsets, following)
+    found = numpy.zeros(count, dtype = bool)
+    inside = successor < count
+    found[inside] = offsets[successor[inside]] == following[inside]
+    successor[~found] = count
+
+    # Candidates that are good places to regain sync
+    reaches_end = numpy.append(following == end, False)
+    successor = numpy.append(successor, count)
+    synced = reaches_end[:-1].copy()
+    step = numpy.arange(count)
+    for i in xrange(Reader._SYNC_FRAMES):
+        step = successor[step]
+        synced |= reaches_end[step]
+    synced = numpy.flatnonzero(synced | (step < count))
+
+    jumps = _Jumps(successor)
+    chains = []
+    position = start
+    while True:
+        first = numpy.searchsorted(offsets, position)
+        if first == count:
+            break
+
+        if offsets[first] != position:
+            # Out of sync
+            next_synced = numpy.searchsorted(synced, first)
+            if next_synced == len(synced):
+                break
+            first = synced[next_synced]
+
+        chain = jumps.follow(first)
+        chains.append(chain)
+        last = chain[-1]
+        position = offsets[last] + lengths[last]
+
+    return numpy.concatenate(chains) if chains else numpy.zeros(0, numpy.int64)
+
+class _Jumps(object):
+    """Follows successor pointers, with one table per power of two of the
+    number of steps taken. The tables are shared by all chains and only
+    built up to the longest chain followed so far."""
+
+    def __init__(self, successor):
+        # successor points to the end (its last index) from the end itself
+        self.end = len(successor) - 1
+        self.tables = [successor]
+
+    def follow(self, first):
+        """follow(first) -> indices
+
+        Returns the indices visited by following successor from first until
+        it points to the end. Takes a logarithmic number of array operations
+        on the chain by doubling the distance jumped in every round.
+        """
+        path = numpy.array([first], dtype = numpy.int64)
+
+        level = 0
+        while True:
+            # path holds the first 2**level steps, the table jumps as far
+            if level == len(self.tables):
+                table = self.tables[-1]
+                self.tables.append(table[table])
+
+            ahead = self.tables[level][path]
+            ahead = ahead[ahead != self.end]
+            if not len(ahead):
+                return path
+
+            path = numpy.concatenate((path, ahead))
+            level += 1
@@ -1,7 +1,34 @@
 import StringIO
+import io
 import unittest
 import struct
+import tempfile
+import random
 import mp3
+from mp3 import _bitpack
+from mp3 import index as mp3index
+from mp3 import pipeline
+import hashlib
+import os
+import sys
+import shutil
+import re
+import zlib
+import sqlite3
+import subprocess
+import imp
+import argparse
+import mmap
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import xattr
+except ImportError:
+    xattr = None
 
 stringio = StringIO.StringIO
 
@@ -179,9 +206,1659 @@ class GoodDataTestCase(unittest.TestCase):
         self.assertEquals([ good_frame_new, good_id3v1_tag ],
                           list(mp3.Reader(stringio(good_frame_data + good_id3v1_tag + '\x00')).frames()))
 
+class MappedTestCase(unittest.TestCase):
+    def testInMemory(self):
+        data = good_frame_data + good_id3v1_tag
+
+        for obj in (bytearray(data), buffer(data), memoryview(data)):
+            l = list(mp3.Reader(obj).frames())
+            self.assertEquals(l, [ good_frame_new, good_id3v1_tag ])
+
+        # Strings might be paths
+        for obj in (str(data), 'a.mp3', u'a.mp3'):
+            self.assertRaises(TypeError, mp3.Reader, obj)
+
+    def testNoCopy(self):
+        data = bytearray(good_frame_data + good_frame_data)
+        l = list(mp3.Reader(data).frames())
+        self.assertEquals(l, [ good_frame_new, good_frame_new ])
+
+        # Frames are windows into the data they were read from
+        l[1].view[-1] = '\x00'
+        self.assertEquals(data[-1], 0)
+        self.assertEquals(l[0], good_frame_new)
+
+    def testMmap(self):
+        f = tempfile.TemporaryFile()
+        f.write(good_id3v1_tag + good_frame_data + good_frame_data)
+        f.seek(len(good_id3v1_tag))
+
+        l = list(mp3.Reader(f, use_mmap=True).frames())
+        self.assertEquals(l, [ good_frame_new, good_frame_new ])
+
+        # Changes to frames must not end up in the file
+        l[0].header.private = 1
+        l[0].commit_header()
+        f.seek(len(good_id3v1_tag))
+        self.assertEquals(f.read(len(good_frame_data)), good_frame_data)
+
+    def testStorage(self):
+        data = good_frame_data + good_id3v1_tag
+        f = tempfile.TemporaryFile()
+        f.write(data)
+        f.flush()
+
+        # Data that has to be copied is copied once, not on every pass
+        source = bytearray(data)
+        for obj in (source, memoryview(source), buffer(data), \
+            mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)):
+            reader = mp3.Reader(obj)
+            for i in xrange(2):
+                buf = reader._open_buffer()
+                self.assertTrue(buf._buffer is reader._data)
+                self.assertEquals(list(reader.frames()), [ good_frame_new, good_id3v1_tag ])
+        self.assertTrue(mp3.Reader(source)._data is source)
+
+    def testClose(self):
+        f = tempfile.TemporaryFile()
+        f.write(good_frame_data + good_frame_data)
+        f.seek(0)
+
+        with mp3.Reader(f, use_mmap = True) as reader:
+            self.assertEquals(len(list(reader.headers())), 2)
+            data = reader._map
+        self.assertRaises(ValueError, data.read, 1)
+        self.assertFalse(f.closed)
+
+    def testTruncated(self):
+        self.assertRaises(mp3.MP3Error, list,
+            mp3.Reader(good_frame_data[:-1]).frames(skip_invalid_data = False))
+
+class SharedBuffersTestCase(unittest.TestCase):
+    def testSharedChunk(self):
+        f = stringio(good_frame_data + good_frame_data + good_id3v1_tag)
+        l = list(mp3.Reader(f).frames(shared_buffers = True))
+        self.assertEquals(l, [ good_frame_new, good_frame_new, good_id3v1_tag ])
+
+        chunk = l[0]._buffer._buffer
+        for frame in l:
+            self.assertTrue(frame._buffer._buffer is chunk)
+
+    def testChunkTurnover(self):
+        # Frames have to stay intact when the reader moves on to new chunks
+        data = '\x00' + (good_frame_data + good_id3v1_tag) * 50
+        reader = mp3.Reader(stringio(data), buffer_size = 1000)
+        reader._SHARED_BUFFER_SIZE = 1000
+
+        l = list(reader.frames(shared_buffers = True))
+        self.assertEquals(l, [ good_frame_new, good_id3v1_tag ] * 50)
+
+        # Big frames that don't fit into a chunk are copied
+        reader = mp3.Reader(stringio(data), buffer_size = 200)
+        reader._SHARED_BUFFER_SIZE = 200
+        self.assertEquals(list(reader.frames(shared_buffers = True)),
+                          [ good_frame_new, good_id3v1_tag ] * 50)
+
+# Tables from ISO/IEC 11172-3 and 13818-3, indexed by the raw header bits
+spec_versions = { 3: 1, 2: 2, 0: 2.5 }
+spec_bitrates = {
+    (1, 1): [32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+spec_samplingrates = {
+    1: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    2.5: [11025, 12000, 8000],
+}
+spec_samples = {
+    (1, 1): 384, (1, 2): 1152, (1, 3): 1152,
+    (2, 1): 384, (2, 2): 1152, (2, 3): 576,
+}
+
+def make_header(version, layer, bitrate, samplingrate, padding = 0, \
+    channelmode = 0, crc = 0):
+    """Packs raw header bits into a 4 byte header."""
+    word = 0x7ff << 21 | version << 19 | layer << 17 | (not crc) << 16 | \
+        bitrate << 12 | samplingrate << 10 | padding << 9 | channelmode << 6
+    return bytearray(struct.pack('>I', word))
+
+class HeaderTestCase(unittest.TestCase):
+    def testSpecTables(self):
+        for version_bits, version in spec_versions.items():
+            spec_version = int(version == 1) or 2
+            for layer_bits in (3, 2, 1):
+                layer = 4 - layer_bits
+                for bitrate_bits in range(1, 15):
+                    bitrate = spec_bitrates[spec_version, layer][bitrate_bits - 1]
+                    for samplingrate_bits in range(3):
+                        samplingrate = spec_samplingrates[version][samplingrate_bits]
+                        for padding in (0, 1):
+                            for channelmode in range(4):
+                                data = make_header(version_bits, layer_bits, \
+                                    bitrate_bits, samplingrate_bits, padding, channelmode)
+                                buf = mp3.ZeroCopyBuffer(None, _buffer=data)
+                                frame = mp3.MPEGFrame(buf)
+                                header = frame.header
+
+                                self.assertEquals(header.version, version)
+                                self.assertEquals(header.layer, layer)
+                                self.assertEquals(header.bitrate, bitrate)
+                                self.assertEquals(header.samplingrate, samplingrate)
+                                self.assertEquals(header.padding, padding)
+                                self.assertEquals(header.channelmode, channelmode)
+
+                                samples = spec_samples[spec_version, layer]
+                                if layer == 1:
+                                    length = (12 * bitrate * 1000 / samplingrate + padding) * 4
+                                else:
+                                    length = samples / 8 * bitrate * 1000 / samplingrate + padding
+                                self.assertEquals(frame.length, length)
+                                self.assertEquals(mp3.framelen(mp3._HeaderWrapper(header)), length)
+                                self.assertEquals(header._info.samples, samples)
+
+                                side_info = 0
+                                if layer == 3:
+                                    mono = channelmode == mp3.Channelmode.MONO
+                                    side_info = version == 1 and (mono and 17 or 32) or \
+                                        (mono and 9 or 17)
+                                self.assertEquals(header.side_info_size(), side_info)
+
+    def testFrameLengths(self):
+        for args, length in [
+            ((3, 3, 4, 0, 0), 136),  # MPEG-1 Layer I, 128 kbit/s, 44.1 kHz
+            ((3, 3, 4, 0, 1), 140),  # ... padded
+            ((3, 3, 14, 1, 0), 448), # MPEG-1 Layer I, 448 kbit/s, 48 kHz
+            ((3, 1, 9, 0, 0), 417),  # MPEG-1 Layer III, 128 kbit/s, 44.1 kHz
+            ((3, 1, 9, 0, 1), 418),  # ... padded
+            ((2, 2, 1, 2, 0), 72),   # MPEG-2 Layer II, 8 kbit/s, 16 kHz
+            ((2, 1, 1, 2, 0), 36),   # MPEG-2 Layer III, 8 kbit/s, 16 kHz
+            ((0, 1, 1, 2, 0), 72),   # MPEG-2.5 Layer III, 8 kbit/s, 8 kHz
+            ]:
+            buf = mp3.ZeroCopyBuffer(None, _buffer=make_header(*args))
+            self.assertEquals(mp3.MPEGFrame(buf).length, length)
+
+    def testInvalid(self):
+        for args in [
+            (1, 1, 9, 0), # reserved version
+            (3, 0, 9, 0), # reserved layer
+            (3, 1, 0, 0), # free format bitrate
+            (3, 1, 15, 0), # bad bitrate
+            (3, 1, 9, 3), # reserved sampling rate
+            ]:
+            # Twice, to hit the cache
+            for i in range(2):
+                buf = mp3.ZeroCopyBuffer(None, _buffer=make_header(*args))
+                self.assertRaises(mp3.MP3FrameHeaderError, mp3.Header, buf)
+
+        buf = mp3.ZeroCopyBuffer(None, _buffer=bytearray('\x00\x00\x00\x00'))
+        self.assertRaises(mp3.MP3FrameHeaderError, mp3.Header, buf)
+
+    def testLayer12CRC(self):
+        def reference_crc(data, bits):
+            crc = 0xffff
+            for i in xrange(bits):
+                bit = data[i / 8] >> (7 - i % 8) & 1
+                crc = (crc << 1) & 0xffff ^ (((crc >> 15) ^ bit) and 0x8005)
+            return crc
+
+        # The CRC covers header bytes 2 and 3 and then this many bits
+        for args, modeextension, length, bits in [
+            ((3, 3, 4, 0, 0, 1), 1, 136, 160),  # Layer I, joint stereo bound 8
+            ((3, 3, 4, 0, 0, 3), 0, 136, 128),  # Layer I, mono
+            ((3, 2, 8, 0, 0, 0), 0, 417, 284),  # Layer II, 27 subbands
+            ((3, 2, 2, 2, 0, 3), 0, 216, 62),   # Layer II, 12 subbands, mono
+            ((2, 2, 8, 0, 0, 1), 0, 417, 211),  # MPEG-2 Layer II, bound 4
+            ]:
+            frame = make_header(*args, crc = 1) + '\x00\x00' + '\xff' * (length - 6)
+            frame[3] |= modeextension << 4
+            struct.pack_into('>H', frame, 4, reference_crc(frame[2:4] + frame[6:], 16 + bits))
+
+            header = mp3.Header(mp3.MappedBuffer(frame))
+            self.assertTrue(header.valid())
+            self.assertEquals(header.bytes(), frame[:6])
+
+            for bit, valid in ((bits - 1, False), (bits, True)):
+                changed = bytearray(frame)
+                changed[6 + bit / 8] ^= 0x80 >> bit % 8
+                header = mp3.Header(mp3.MappedBuffer(changed))
+                self.assertEquals(header.valid(), valid)
+
+class CompactHeaderTestCase(unittest.TestCase):
+    fields = ('sync', 'version', 'layer', 'crc', 'bitrate', 'samplingrate', 'padding', \
+        'private', 'channelmode', 'modeextension', 'copyright', 'original', 'emphasis')
+
+    def assertSameHeader(self, compact, header):
+        for name in self.fields:
+            self.assertEquals(getattr(compact, name), getattr(header, name), name)
+        for method in ('frame_length', 'samples', 'time', 'side_info_size', 'length'):
+            self.assertEquals(getattr(compact, method)(), getattr(header, method)(), method)
+
+    def testFields(self):
+        buf = mp3.ZeroCopyBuffer(None, _buffer=good_frame_data)
+        header = mp3.Header(buf)
+        compact = mp3.CompactHeader(buf)
+        self.assertSameHeader(compact, header)
+        self.assertEquals(compact._info, header._info)
+        self.assertFalse(hasattr(compact, '__dict__'))
+
+        # Side info is only read on request
+        self.assertEquals(compact._side_info, None)
+        compact.update(buf)
+        self.assertEquals(compact.bytes(), header.bytes())
+        self.assertTrue(compact.valid())
+
+        for args in [(2, 2, 1, 2, 0, 3, 1), (0, 1, 14, 1, 1, 2, 0), (3, 3, 4, 0, 1, 0, 1)]:
+            buf = mp3.ZeroCopyBuffer(None, _buffer=make_header(*args) + bytearray(40))
+            self.assertSameHeader(mp3.CompactHeader(buf), mp3.Header(buf))
+
+        buf = mp3.ZeroCopyBuffer(None, _buffer=make_header(3, 1, 15, 0))
+        self.assertRaises(mp3.MP3FrameHeaderError, mp3.CompactHeader, buf)
+
+    def testSetters(self):
+        buf = mp3.ZeroCopyBuffer(None, _buffer=good_frame_data)
+        header = mp3.Header(buf)
+        compact = mp3.CompactHeader.from_header(header)
+        self.assertSameHeader(compact, header)
+        self.assertEquals(compact.bytes(), header.bytes())
+
+        for h in (header, compact):
+            h.version = 2
+            h.bitrate = 64
+            h.samplingrate = 16000
+            h.padding = True
+            h.private = True
+            h.channelmode = mp3.Channelmode.MONO
+            h.crc = False
+        self.assertSameHeader(compact, header)
+        self.assertEquals(compact.bytes(), header.bytes())
+
+        self.assertRaises(mp3.MP3FrameHeaderError, setattr, compact, 'bitrate', 1000)
+        self.assertRaises(mp3.MP3FrameHeaderError, setattr, compact, 'version', 3)
+
+    def testHeaders(self):
+        data, offsets = make_stream([9, 14, 5] * 10)
+        headers = list(mp3.Reader(stringio(str(data))).headers(compact = True))
+        self.assertTrue(all(isinstance(header, mp3.CompactHeader) for header in headers))
+        self.assertEquals([header.offset for header in headers], offsets)
+        self.assertEquals([(header.bitrate, header.padding) for header in headers],
+            [(header.bitrate, header.padding) \
+                for header in mp3.Reader(stringio(str(data))).headers()])
+
+class BitpackTestCase(unittest.TestCase):
+    def testHeader(self):
+        fmt = mp3.Header._FORMAT
+        values = _bitpack.bitunpack_from(fmt, good_frame_data)
+        self.assertEquals(values, [0x7ff, 3, 1, True, 9, 0, False, False, 1, 2, False, True, 0])
+
+        buf = bytearray(4)
+        _bitpack.bitpack_into(fmt, buf, 0, *values)
+        self.assertEquals(buf, good_frame_data[:4])
+
+    def testUnaligned(self):
+        # 21 bits, the remaining 3 bits of the last byte are left alone
+        fmt = _bitpack.formatstr('i:3,i:17,b')
+        buf = bytearray('\x00\x00\x00\x07')
+        _bitpack.bitpack_into(fmt, buf, 1, 5, 0x1abcd, True)
+        self.assertEquals(buf, bytearray('\x00\xba\xbc\xdf'))
+        self.assertEquals(_bitpack.bitunpack_from(fmt, buf, 1), [5, 0x1abcd, True])
+
+        # Values are truncated to their field's size
+        _bitpack.bitpack_into(fmt, buf, 1, 0xd, 0, 0)
+        self.assertEquals(_bitpack.bitunpack_from(fmt, buf, 1), [5, 0, False])
+
+    def testLong(self):
+        fmt = _bitpack.formatstr(['i:40', 'i:30', 'b', 'i:1=1'])
+        self.assertEquals(fmt.length, 9)
+
+        buf = bytearray(9)
+        _bitpack.bitpack_into(fmt, buf, 0, 2**40 - 3, 12345, 1, 1)
+        self.assertEquals(_bitpack.bitunpack_from(fmt, buf), [2**40 - 3, 12345, True, 1])
+
+    def testErrors(self):
+        fmt = _bitpack.formatstr('i:4=0xa,i:4')
+        self.assertEquals(_bitpack.bitunpack_from(fmt, '\xa5'), [0xa, 5])
+        self.assertRaises(_bitpack.invalid_input_error, _bitpack.bitunpack_from, fmt, '\xb5')
+        self.assertRaises(_bitpack.error, _bitpack.bitunpack_from, fmt, '\xa5', 1)
+        self.assertRaises(_bitpack.error, _bitpack.formatstr, 'x:4')
+        self.assertRaises(_bitpack.error, _bitpack.formatstr, 'i:four')
+
+class ResyncTestCase(unittest.TestCase):
+    def testGarbage(self):
+        rand = random.Random(0)
+        garbage = [
+            ''.join(chr(rand.getrandbits(8)) for i in xrange(5000)),
+            '\xff' * 5000,
+            '\xff\xfb\x90\x64' * 1000,
+            'TAG' * 1000,
+            'ID3\x03\x00\x00\x00\x00\x01\x00' * 100,
+            'APETAGEX\xd0\x07\x00\x00\x10\x00\x00\x00\x00' * 100,
+        ]
+
+        for data in garbage:
+            # Anything valid right after a frame is in sync and accepted,
+            # so start the garbage with something invalid
+            stream = good_frame_data * 3 + '\x00' + data + good_frame_data * 3
+            for reader in (mp3.Reader(stringio(stream)), mp3.Reader(stream)):
+                self.assertEquals(list(reader.frames()), [ good_frame_new ] * 6)
+
+    def testSyncFrames(self):
+        # A frame found while out of sync needs two valid frames after it
+        stream = '\x00' + good_frame_data * 2 + '\x00' * 100 + good_frame_data * 3
+        self.assertEquals(list(mp3.Reader(stringio(stream)).frames()),
+                          [ good_frame_new ] * 3)
+
+        # ... unless the stream ends before that
+        stream = '\x00' + good_frame_data * 2
+        self.assertEquals(list(mp3.Reader(stringio(stream)).frames()),
+                          [ good_frame_new ] * 2)
+
+class StatsTestCase(unittest.TestCase):
+    def testSync(self):
+        stream = good_frame_data * 3 + '\x00' * 50 + good_frame_data * 3
+        lost_at = len(good_frame_data) * 3
+
+        for reader, read in ((mp3.Reader(stringio(stream)), mp3.Reader.frames),
+                             (mp3.Reader(stream), mp3.Reader.frames),
+                             (mp3.Reader(stringio(stream)), mp3.Reader.headers)):
+            events = []
+            reader.stats = mp3.ReaderStats(lambda offset: events.append(offset),
+                lambda offset, skipped: events.append((offset, skipped)))
+            self.assertEquals(len(list(read(reader))), 6)
+
+            stats = reader.stats
+            self.assertEquals(stats.frames, {'MPEGFrame': 6})
+            self.assertEquals((stats.sync_losses, stats.bytes_skipped), (1, 50))
+            self.assertEquals((stats.resync_attempts, stats.resyncs), (1, 1))
+            self.assertEquals(events, [lost_at, (lost_at + 50, 50)])
+
+        stats = mp3.ReaderStats()
+        list(mp3.Reader(stringio(stream), stats = stats).frames())
+        self.assertEquals(stats.bytes_read, len(stream))
+        self.assertTrue(stats.fill_calls > 0)
+        self.assertEquals(sorted(stats.as_dict()), ['bytes_read', 'bytes_shifted', \
+            'bytes_skipped', 'crc_failures', 'fill_calls', 'frames', 'resync_attempts', \
+            'resync_seconds', 'resyncs', 'sync_losses'])
+
+    def testCRC(self):
+        from mp3.tests import corpus
+
+        good = corpus.frame(crc = True)
+        bad = corpus.frame(crc = True)
+        bad[10] ^= 0xff
+
+        stats = mp3.ReaderStats()
+        frames = mp3.Reader(good + bad + good, stats = stats).frames()
+        self.assertEquals(len(list(frames)), 3)
+        self.assertEquals(stats.crc_failures, 1)
+
+class IndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.mp3')
+        with open(self.path, 'wb') as f:
+            f.write(good_id3v1_tag + good_frame_data * 3 + '\x00' + good_frame_data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testBuild(self):
+        with open(self.path, 'rb') as f:
+            index = mp3index.build(f)
+
+        size = len(good_frame_data)
+        start = len(good_id3v1_tag)
+        self.assertEquals(list(index.offsets),
+            [start, start + size, start + 2 * size, start + 3 * size + 1])
+        self.assertEquals(list(index.sizes), [size] * 4)
+        self.assertEquals(list(index.samples), [1152, 2304, 3456, 4608])
+        self.assertEquals(index.samplingrate, 44100)
+        self.assertAlmostEquals(index.duration, 4608 / 44100.0)
+
+        self.assertEquals(index.find_sample(0), 0)
+        self.assertEquals(index.find_sample(1152), 1)
+        self.assertEquals(index.find_time(index.duration), 4)
+
+        self.assertEquals(mp3index.loads(mp3index.dumps(index)), index)
+
+    def testLargeFile(self):
+        # Offsets and sample counts past 4 GiB
+        index = mp3index.FrameIndex((1 << 33, 0.0, '\x00' * 20), 44100)
+        index.append((1 << 32) - 1, 417, 1152)
+        index.append((1 << 32) + 416, 417, (1 << 32) - 1152)
+        self.assertEquals(list(index.offsets), [(1 << 32) - 1, (1 << 32) + 416])
+        self.assertEquals(index.total_samples, 1 << 32)
+        self.assertEquals(mp3index.loads(mp3index.dumps(index)), index)
+
+        # Platforms without 64 bit arrays only take files up to 4 GiB
+        typecode = mp3index._TYPECODE
+        mp3index._TYPECODE = 'I'
+        try:
+            index = mp3index.FrameIndex()
+            index.append((1 << 32) - 417, 417, 1152)
+            self.assertRaises(ValueError, index.append, 1 << 32, 417, 1152)
+            self.assertRaises(ValueError, index.append, 0, 417, (1 << 32) - 1152)
+            self.assertEquals(len(index), 1)
+        finally:
+            mp3index._TYPECODE = typecode
+
+    def testFrameOffsets(self):
+        data = '\x00' + (good_frame_data + good_id3v1_tag) * 10
+        expected = [1 + i * (len(good_frame_data) + len(good_id3v1_tag)) + j
+                    for i in xrange(10) for j in (0, len(good_frame_data))]
+
+        for buffer_size in (200, 1000):
+            for shared_buffers in (False, True):
+                reader = mp3.Reader(stringio(data), buffer_size = buffer_size)
+                reader._SHARED_BUFFER_SIZE = buffer_size
+                frames = reader.frames(shared_buffers = shared_buffers)
+                self.assertEquals([frame.offset for frame in frames], expected)
+
+    def testSidecar(self):
+        self.assertEquals(mp3index.load(self.path), None)
+
+        index = mp3index.load_or_build(self.path)
+        self.assertTrue(os.path.exists(self.path + '.mp3idx'))
+        self.assertEquals(mp3index.load(self.path), index)
+
+        # Changing the file invalidates the index
+        with open(self.path, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write('\x01')
+        self.assertEquals(mp3index.load(self.path), None)
+
+        # Corrupt indexes are ignored
+        with open(self.path + '.mp3idx', 'r+b') as f:
+            f.truncate(40)
+        self.assertEquals(mp3index.load(self.path), None)
+
+    def testCacheDir(self):
+        cache = os.path.join(self.dir, 'cache')
+        os.mkdir(cache)
+
+        index = mp3index.load_or_build(self.path, cache)
+        self.assertFalse(os.path.exists(self.path + '.mp3idx'))
+        self.assertEquals(os.listdir(cache),
+            [os.path.basename(mp3index.sidecar_path(self.path, cache))])
+        self.assertEquals(mp3index.load(self.path, cache), index)
+
+class DuplicatesTestCase(unittest.TestCase):
+    def setUp(self):
+        from mp3.tests import corpus
+
+        self.dir = tempfile.mkdtemp()
+        audio = corpus.generate(100, bitrates = 'vbr', xing = True, seed = 1)
+        changed = bytearray(audio)
+        changed[len(audio) / 2] ^= 1
+
+        self.files = {
+            'a.mp3': audio,
+            'retagged.mp3': good_id3v1_tag + audio + corpus.generate(0, ape = True),
+            'other.mp3': corpus.generate(100, bitrates = 'vbr', xing = True, seed = 2),
+            'changed.mp3': str(changed),
+            'empty.mp3': '',
+            'tag.mp3': good_id3v1_tag,
+        }
+        for name, data in self.files.items():
+            with open(self.path(name), 'wb') as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def testAudioDigest(self):
+        digest = mp3.audio_digest(buffer(self.files['a.mp3']))
+        with open(self.path('retagged.mp3'), 'rb') as f:
+            self.assertEquals(mp3.audio_digest(f), digest)
+        self.assertNotEquals(mp3.audio_digest(buffer(self.files['changed.mp3'])), digest)
+        self.assertEquals(mp3.audio_digest(bytearray()), hashlib.sha1().hexdigest())
+
+    def testAudioSpan(self):
+        from mp3 import duplicates
+        from mp3.tests import corpus
+
+        def span(data):
+            return duplicates.audio_span(stringio(str(data)))
+
+        audio = corpus.generate(50, seed = 3)
+        self.assertEquals(span(audio), span(corpus.generate(0, id3v2 = True) + audio + \
+            corpus.generate(0, ape = True, id3v1 = True)))
+        self.assertNotEquals(span(audio), span(audio[:-1]))
+        self.assertNotEquals(span(self.files['a.mp3']), span(self.files['other.mp3']))
+        self.assertEquals(span(self.files['a.mp3']), span(self.files['retagged.mp3']))
+        self.assertEquals(span(good_id3v1_tag), None)
+
+        # Only the first frames and the end are read
+        data = str(corpus.generate(2000, id3v2 = True, id3v1 = True))
+        f = CountingFile(data)
+        self.assertNotEquals(duplicates.audio_span(f), None)
+        self.assertTrue(f.bytes_read < len(data) / 50, f.bytes_read)
+
+    def testPartialDigest(self):
+        from mp3 import duplicates
+        from mp3.tests import corpus
+
+        def partial(data, frames = 4):
+            return duplicates.partial_digest(stringio(str(data)), frames)
+
+        # The head and tail frames, whatever the tags
+        self.assertEquals(partial(self.files['a.mp3']), partial(self.files['retagged.mp3']))
+        self.assertEquals(partial(self.files['a.mp3'], 60), \
+            partial(self.files['retagged.mp3'], 60))
+        self.assertEquals(partial(self.files['a.mp3']), partial(self.files['changed.mp3']))
+        self.assertNotEquals(partial(self.files['a.mp3']), partial(self.files['other.mp3']))
+        self.assertNotEquals(partial(self.files['a.mp3']), partial(self.files['a.mp3'][:-1]))
+
+        # Only the head and the tail are read
+        data = str(corpus.generate(5000, bitrates = 'vbr', id3v1 = True))
+        f = CountingFile(data)
+        duplicates.partial_digest(f)
+        self.assertTrue(f.bytes_read < len(data) / 10, f.bytes_read)
+
+    def testFindDuplicates(self):
+        from mp3 import duplicates
+
+        paths = sorted(self.path(name) for name in self.files) + [self.path('missing.mp3')]
+        cache = duplicates.DigestCache(self.path('cache.db'))
+        expected = [[self.path('a.mp3'), self.path('retagged.mp3')]]
+        self.assertEquals(duplicates.find_duplicates(paths, cache, frames = 4), expected)
+
+        # Only candidates are hashed completely
+        entry = cache.get(self.path('changed.mp3'))
+        self.assertEquals(entry['frames'], 101)
+        self.assertEquals(entry['partial_frames'], 4)
+        self.assertTrue('digest' in entry)
+
+        # Files with a different Xing frame are not even scanned
+        self.assertEquals(cache.get(self.path('other.mp3')).keys(), ['span'])
+
+        # Cached results are used until a file changes
+        cache.update(self.path('changed.mp3'), digest = entry['digest'])
+        self.assertEquals(len(duplicates.find_duplicates(paths, cache, frames = 4)[0]), 2)
+        cache.update(self.path('changed.mp3'), digest = cache.get(self.path('a.mp3'))['digest'])
+        self.assertEquals(len(duplicates.find_duplicates(paths, cache, frames = 4)[0]), 3)
+
+        with open(self.path('changed.mp3'), 'ab') as f:
+            f.write(good_id3v1_tag)
+        os.utime(self.path('changed.mp3'), (0, 0))
+        self.assertEquals(cache.get(self.path('changed.mp3')), {})
+        self.assertEquals(duplicates.find_duplicates(paths, cache, frames = 4), expected)
+        cache.close()
+
+def make_stream(bitrates, padded = True):
+    """Returns MPEG-1 Layer III frames at 44.1 kHz with the given bitrate bits,
+    and their offsets. Each frame's payload starts with its number. If padded
+    is True, frames are padded like a CBR encoder would."""
+    data = bytearray()
+    offsets = []
+    exact = 0.0
+    for i, bitrate_bits in enumerate(bitrates):
+        bitrate = spec_bitrates[1, 3][bitrate_bits - 1]
+        exact += 1152 * bitrate * 1000 / 8.0 / 44100
+        length = 1152 / 8 * bitrate * 1000 / 44100
+        padding = int(padded and int(exact) - len(data) > length)
+
+        offsets.append(len(data))
+        frame = make_header(3, 1, bitrate_bits, 0, padding) + bytearray(32) + \
+            struct.pack('>I', i)
+        data += frame + bytearray(length + padding - len(frame))
+    return data, offsets
+
+def frame_number(frame):
+    return struct.unpack('>I', frame.view[36:40].tobytes())[0]
+
+def make_vbr_frame(tag, info):
+    """Returns a 417 byte frame holding a Xing or VBRI header."""
+    frame = make_header(3, 1, 9, 0) + bytearray(32) + tag + info
+    return frame + bytearray(417 - len(frame))
+
+class SeekTestCase(unittest.TestCase):
+    def assertSeeks(self, reader, n, tolerance = 0):
+        reader.seek_frame(n)
+        frame = reader.frames().next()
+        self.assertTrue(abs(frame_number(frame) - n) <= tolerance)
+        self.assertTrue(abs(frame_number(reader[n]) - n) <= tolerance)
+
+    def testCBR(self):
+        data, offsets = make_stream([9] * 500)
+        data = good_id3v1_tag + data
+
+        for obj in (data, stringio(str(data))):
+            reader = mp3.Reader(obj)
+            for n in (0, 1, 10, 250, 499):
+                self.assertSeeks(reader, n)
+
+            reader.seek_time(5.0)
+            self.assertEquals(frame_number(reader.frames().next()), int(5.0 * 44100 / 1152))
+            self.assertRaises(IndexError, reader.__getitem__, 500)
+
+    def testIndex(self):
+        random.seed(0)
+        data, offsets = make_stream([random.randint(1, 14) for i in xrange(300)], False)
+        f = stringio(str(data))
+        index = mp3index.build(f)
+
+        reader = mp3.Reader(f, index = index)
+        for n in (0, 7, 150, 299):
+            self.assertSeeks(reader, n)
+        self.assertEquals(frame_number(reader[-1]), 299)
+
+        reader.seek_time(index.duration / 2)
+        self.assertEquals(frame_number(reader.frames().next()), 150)
+
+    def testScan(self):
+        data, offsets = make_stream([9, 10, 11] * 50, False)
+        reader = mp3.Reader(data)
+        for n in (0, 7, 149):
+            self.assertSeeks(reader, n)
+        self.assertRaises(IndexError, reader.__getitem__, 150)
+        self.assertRaises(IndexError, reader.__getitem__, -1)
+
+    def testXing(self):
+        data, offsets = make_stream([9, 14] * 500, False)
+        size = len(data) + 417
+        toc = [int((417 + offsets[i * 10]) * 256.0 / size) for i in xrange(100)]
+        xing = make_vbr_frame('Xing', struct.pack('>III100B', 7, 1000, size, *toc))
+
+        reader = mp3.Reader(xing + data)
+        for n in (0, 5, 500, 999):
+            self.assertSeeks(reader, n)
+        self.assertEquals(frame_number(reader[-1]), 999)
+
+        # Seeking by time goes by the table of contents
+        reader.seek_time(500 * 1152 / 44100.0)
+        self.assertTrue(abs(frame_number(reader.frames().next()) - 500) <= 10)
+
+    def testVBRI(self):
+        data, offsets = make_stream([9, 14] * 500, False)
+        offsets.append(len(data))
+        toc = [417 + offsets[10]] + \
+            [offsets[(i + 1) * 10] - offsets[i * 10] for i in xrange(1, 100)]
+        vbri = make_vbr_frame('VBRI', struct.pack('>HHHIIHHHH100H', 1, 0, 0, \
+            len(data) + 417, 1000, 100, 1, 2, 10, *toc))
+
+        reader = mp3.Reader(vbri + data)
+        for n in (0, 5, 500, 999):
+            self.assertSeeks(reader, n)
+        self.assertEquals(reader._vbr_frame.total_frames, 1000)
+
+        reader.seek_time(500 * 1152 / 44100.0)
+        self.assertTrue(abs(frame_number(reader.frames().next()) - 500) <= 10)
+
+    def testCorpus(self):
+        from mp3.tests import corpus
+
+        # VBR streams with a Xing frame, CBR streams with an Info frame
+        for bitrates in ('vbr', 128):
+            data = corpus.generate(2000, bitrates = bitrates, xing = True)
+            frames = [frame for frame in mp3.Reader(bytearray(data)).frames() \
+                if type(frame) is mp3.MPEGFrame]
+
+            reader = mp3.Reader(stringio(data))
+            for n in (0, 1, 7, 500, 1999, -1):
+                self.assertEquals(reader[n].offset, frames[n].offset)
+            self.assertEquals(reader._is_cbr, bitrates == 128)
+
+class CountingFile(object):
+    """File-like object counting the reads and bytes read from it."""
+    def __init__(self, data):
+        self._file = stringio(data)
+        self.bytes_read = 0
+        self.reads = 0
+
+    def read(self, size = -1):
+        data = self._file.read(size)
+        self.bytes_read += len(data)
+        self.reads += 1
+        return data
+
+    def seek(self, *args):
+        self._file.seek(*args)
+
+    def tell(self):
+        return self._file.tell()
+
+class HeadersTestCase(unittest.TestCase):
+    def expected(self, data):
+        return [(frame.offset, frame.header.bitrate, frame.header.padding) for frame in
+                mp3.Reader(buffer(data)).frames() if type(frame) is mp3.MPEGFrame]
+
+    def headers(self, *args, **kwargs):
+        return [(header.offset, header.bitrate, header.padding) for header in
+                mp3.Reader(*args).headers(**kwargs)]
+
+    def testHeaders(self):
+        data, offsets = make_stream([9, 14, 1] * 100, False)
+        data = str(good_id3v1_tag + data + good_id3v1_tag)
+        expected = self.expected(data)
+        self.assertEquals(len(expected), 300)
+
+        # Read in chunks like frames() does, not frame by frame
+        f = CountingFile(data)
+        self.assertEquals(self.headers(f), expected)
+        frames_file = CountingFile(data)
+        list(mp3.Reader(frames_file).frames())
+        self.assertTrue(f.reads <= frames_file.reads)
+        self.assertTrue(f.reads < len(expected) / 10)
+
+        # What is not read yet of frames past a chunk is skipped
+        f = CountingFile(data)
+        self.assertEquals(self.headers(f, 128), expected)
+        self.assertTrue(f.bytes_read < len(data) / 3)
+
+        self.assertEquals(self.headers(buffer(data)), expected)
+        for f in (CountingFile(data), buffer(data)):
+            headers = list(mp3.Reader(f).headers(include_side_info = True))
+            self.assertEquals(headers[0].bytes(), make_header(3, 1, 9, 0) + bytearray(32))
+
+    def testResync(self):
+        data, offsets = make_stream([9, 14] * 20, False)
+        data = str(data[:1000] + '\x00\xff\xfb' + data[1000:])
+        expected = self.expected(data)
+        self.assertEquals(len(expected), 40)
+
+        self.assertEquals(self.headers(CountingFile(data)), expected)
+        self.assertEquals(self.headers(buffer(data)), expected)
+
+        for f in (CountingFile(data), buffer(data)):
+            self.assertRaises(mp3.MP3Error, list,
+                mp3.Reader(f).headers(skip_invalid_data = False))
+
+    def testTruncated(self):
+        data = str(good_frame_data * 2)[:-1]
+        self.assertEquals(len(self.headers(CountingFile(data))), 1)
+        self.assertEquals(len(self.headers(buffer(data))), 1)
+
+        for f in (CountingFile(data), buffer(data)):
+            self.assertRaises(mp3.MP3Error, list,
+                mp3.Reader(f).headers(skip_invalid_data = False))
+
+class DurationTestCase(unittest.TestCase):
+    def testTime(self):
+        for args, time in [
+            ((3, 1, 9, 0), 1152 / 44100.0), # MPEG-1 Layer III, 44.1 kHz
+            ((3, 3, 9, 1), 384 / 48000.0),  # MPEG-1 Layer I, 48 kHz
+            ((2, 1, 9, 0), 576 / 22050.0),  # MPEG-2 Layer III, 22.05 kHz
+            ((0, 2, 9, 2), 1152 / 8000.0),  # MPEG-2.5 Layer II, 8 kHz
+            ]:
+            buf = mp3.ZeroCopyBuffer(None, _buffer=make_header(*args))
+            self.assertAlmostEquals(mp3.Header(buf).time(), time)
+
+    def testCBR(self):
+        data, offsets = make_stream([9] * 500)
+        ape_tag = 'APETAGEX' + struct.pack('<IIII8x', 2000, 32, 0, 0)
+        data = str(good_id3v1_tag + data + ape_tag + good_id3v1_tag)
+
+        f = CountingFile(data)
+        seconds, method, error = mp3.duration(f)
+        self.assertEquals(method, 'cbr')
+        self.assertTrue(abs(seconds - 500 * 1152 / 44100.0) <= error)
+        self.assertTrue(f.bytes_read < len(data) / 10)
+
+    def testXing(self):
+        data, offsets = make_stream([9, 14] * 50, False)
+        lame_tag = 'LAME3.99r' + '\x00' * 12 + '\x24\x03\xe8'
+        xing = make_vbr_frame('Xing', struct.pack('>III100BI', 15, 100, len(data) + 417,
+            *([0] * 100 + [50])) + lame_tag)
+        self.assertEquals(mp3.duration(xing + data),
+            ((100 * 1152 - 576 - 1000) / 44100.0, 'xing', 0.0))
+
+        vbri = make_vbr_frame('VBRI', struct.pack('>HHHIIHHHH', 1, 576, 0, \
+            len(data) + 417, 100, 0, 1, 2, 10))
+        self.assertEquals(mp3.duration(vbri + data),
+            ((100 * 1152 - 576) / 44100.0, 'vbri', 1152 / 44100.0))
+
+        # Without a LAME tag, encoder delay and padding are unknown
+        xing = make_vbr_frame('Xing', struct.pack('>III100BI', 15, 100, len(data) + 417,
+            *([0] * 100 + [50])))
+        self.assertEquals(mp3.duration(xing + data),
+            (100 * 1152 / 44100.0, 'xing', 1152 / 44100.0))
+
+    def testScan(self):
+        data, offsets = make_stream([9, 14, 1] * 50, False)
+        self.assertEquals(mp3.duration(data), (150 * 1152 / 44100.0, 'scan', 0.0))
+
+        # Streams that only start out as CBR
+        data, offsets = make_stream([9] * 10 + [14, 1] * 50)
+        self.assertEquals(mp3.duration(stringio(str(data))), (110 * 1152 / 44100.0, 'scan', 0.0))
+
+class PipelineTestCase(unittest.TestCase):
+    def testSinks(self):
+        data, offsets = make_stream([9, 14] * 20, False)
+        data = str(good_id3v1_tag + data + good_id3v1_tag)
+
+        out = io.BytesIO()
+        digest = pipeline.DigestSink()
+        stats = pipeline.StatsSink()
+        index = pipeline.IndexSink()
+        p = pipeline.Pipeline([pipeline.DropFrames(mp3.ID3Frame)],
+                              [pipeline.FileSink(out), digest, stats, index])
+        self.assertTrue(p.run(mp3.Reader(buffer(data)).frames()))
+
+        output = out.getvalue()
+        self.assertEquals(output, data[len(good_id3v1_tag):-len(good_id3v1_tag)])
+        self.assertEquals(digest.hexdigest(), hashlib.sha1(output).hexdigest())
+
+        self.assertEquals(stats.frames, 40)
+        self.assertEquals(stats.audio_frames, 40)
+        self.assertEquals(stats.meta_frames, 0)
+        self.assertEquals(stats.bytes, len(output))
+        self.assertEquals(stats.bitrates, {128: 20, 320: 20})
+        self.assertEquals(stats.average_bitrate, 224)
+
+        expected = mp3index.build(stringio(output))
+        self.assertEquals(list(index.index.offsets), list(expected.offsets))
+        self.assertEquals(list(index.index.samples), list(expected.samples))
+
+    def testStages(self):
+        frame = make_header(3, 1, 9, 0, crc = 1) + '\x00\x00' + bytearray(32)
+        data = str(frame + bytearray(417 - len(frame))) * 3
+
+        fix_crc = pipeline.FixCRC()
+        frames = []
+        p = pipeline.Pipeline([pipeline.MangleHeaders(lambda bits: 1), fix_crc],
+                              [pipeline.FileSink(io.BytesIO())])
+        p.sinks[0].write = frames.append
+        self.assertTrue(p.run(mp3.Reader(buffer(data)).frames()))
+
+        self.assertEquals(fix_crc.fixed, 3)
+        for frame in frames:
+            self.assertTrue(frame.header.valid())
+            self.assertEquals((frame.header.private, frame.header.original), (1, 1))
+
+        # Changing files in place only touches the headers
+        f = tempfile.TemporaryFile()
+        f.write(good_id3v1_tag + data)
+        f.flush()
+        self.assertTrue(pipeline.run_in_place(f, [pipeline.MangleHeaders(lambda bits: 1)]))
+
+        f.seek(0)
+        self.assertEquals(f.read(), good_id3v1_tag + ''.join(str(frame.bytes()) for frame in frames))
+
+        # Aborting stops after the current frame
+        self.assertFalse(pipeline.Pipeline().run(mp3.Reader(buffer(data)).frames(), lambda: True))
+
+    def testLayer12CRC(self):
+        from mp3.tests import corpus
+
+        f = tempfile.TemporaryFile()
+        f.write(corpus.generate(20, layer = 2, bitrates = 'vbr', crc = True))
+        f.flush()
+        self.assertTrue(pipeline.run_in_place(f, [pipeline.MangleHeaders(lambda bits: 1)]))
+
+        f.seek(0)
+        headers = list(mp3.Reader(bytearray(f.read())).headers(include_side_info = True))
+        self.assertEquals(len(headers), 20)
+        for header in headers:
+            self.assertEquals((header.private, header.original), (1, 1))
+            self.assertTrue(header.valid())
+
+_SRC_DIR = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+
+@unittest.skipIf(xattr is None and sys.platform.startswith(('darwin', 'linux')), \
+    'sanitize-mp3 requires xattr')
+class SanitizeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    def write(self, name, data):
+        with open(self.path(name), 'wb') as f:
+            f.write(data)
+        return self.path(name)
+
+    def read(self, *names):
+        with open(self.path(*names), 'rb') as f:
+            return f.read()
+
+    def script(self):
+        """Loads sanitize-mp3 as a module, without running it."""
+        path = os.path.join(_SRC_DIR, 'sanitize-mp3')
+        module = imp.new_module('sanitize_mp3')
+        module.__file__ = path
+        execfile(path, module.__dict__)
+        return module
+
+    def sanitize(self, *args, **kwargs):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([os.path.abspath(_SRC_DIR)] + \
+            filter(None, [env.get('PYTHONPATH')]))
+        process = subprocess.Popen([sys.executable, os.path.join(_SRC_DIR, 'sanitize-mp3')] + \
+            list(args), stdout = subprocess.PIPE, stderr = subprocess.STDOUT, env = env)
+        output = process.communicate()[0]
+        self.assertEquals(process.returncode, kwargs.get('returncode', 0), output)
+        return output
+
+    def testManifest(self):
+        from mp3.tests import corpus
+
+        path = self.write('a.mp3', corpus.generate(100, id3v2 = True))
+        manifest = self.path('manifest.db')
+        args = ('-i', path, '-od', self.path('out'), '-d', 'id3', '--manifest', manifest)
+
+        # Partial output of an interrupted run is overwritten
+        os.mkdir(self.path('out'))
+        self.write(os.path.join('out', 'a.mp3'), 'partial')
+        self.assertFalse('Skipping' in self.sanitize(*args))
+        self.assertEquals(self.read('out', 'a.mp3'), corpus.generate(100))
+        self.assertTrue('Skipping 1 unchanged files' in self.sanitize(*args))
+
+        # Changed files are processed and recorded again
+        self.write('a.mp3', corpus.generate(150, id3v2 = True, seed = 1))
+        data = self.read('a.mp3')
+        self.assertFalse('Skipping' in self.sanitize(*args))
+        self.assertEquals(self.read('out', 'a.mp3'), corpus.generate(150, seed = 1))
+        self.assertTrue('Skipping 1 unchanged files' in self.sanitize(*args))
+
+        db = sqlite3.connect(manifest)
+        self.assertEquals(db.execute('SELECT digest FROM files').fetchall(), \
+            [(hashlib.sha1(data).hexdigest(),)])
+        db.close()
+
+        # Removed output is written again
+        os.unlink(self.path('out', 'a.mp3'))
+        self.assertFalse('Skipping' in self.sanitize(*args))
+        self.assertEquals(self.read('out', 'a.mp3'), corpus.generate(150, seed = 1))
+
+    def testManifestReplace(self):
+        from mp3.tests import corpus
+
+        original = corpus.generate(100, id3v2 = True)
+        path = self.write('a.mp3', original)
+        args = ('-i', path, '--replace', '-d', 'id3', '--manifest', self.path('manifest.db'))
+
+        self.sanitize(*args)
+        self.assertEquals(self.read('a.mp3'), corpus.generate(100))
+        self.assertTrue('Skipping 1 unchanged files' in self.sanitize(*args))
+
+        # The backup of the original is kept when a changed file comes back
+        self.write('a.mp3', corpus.generate(150, id3v2 = True, seed = 1))
+        self.assertTrue('Skipping %s' % path in self.sanitize(*args))
+        self.assertEquals(self.read('a.mp3.old'), original)
+
+    def testJobs(self):
+        from mp3.tests import corpus
+
+        # Smaller files first, the pool starts with the largest ones
+        paths = [self.write('%d.mp3' % i, corpus.generate(50 + 100 * i, id3v2 = True, \
+            seed = i)) for i in xrange(5)]
+        outputs = {}
+        for jobs in (1, 3):
+            outdir = self.path('out%d' % jobs)
+            output = self.sanitize('-i', *paths + ['-od', outdir, '-d', 'id3', '--stats', \
+                '-j', str(jobs), '--manifest', self.path('manifest%d.db' % jobs)])
+            outputs[jobs] = output.replace(outdir, 'out')
+            self.assertEquals(sorted(os.listdir(outdir)), sorted(map(os.path.basename, paths)))
+
+        self.assertEquals(outputs[3], outputs[1])
+        self.assertEquals([line.split()[0] for line in outputs[3].splitlines() \
+            if '-->' in line], paths)
+        for name in os.listdir(self.path('out1')):
+            self.assertEquals(self.read('out3', name), self.read('out1', name))
+        self.assertTrue('Skipping 5 unchanged files' in self.sanitize('-i', *paths + ['-od', \
+            self.path('out3'), '-d', 'id3', '-j', '3', '--manifest', self.path('manifest3.db')]))
+
+    def testInPlace(self):
+        from mp3.tests import corpus
+
+        original = corpus.generate(100, id3v2 = True)
+        path = self.write('a.mp3', original)
+        manifest = self.path('manifest.db')
+
+        # Frames are never dropped in place
+        self.assertTrue("can't be combined with --drop" in self.sanitize('-i', path, \
+            '--in-place', '--mangle', '-d', 'id3', returncode = 2))
+        self.assertEquals(self.read('a.mp3'), original)
+
+        args = ('-i', path, '--in-place', '--mangle', '--manifest', manifest)
+        self.sanitize(*args)
+
+        # Only the private and original bits of the headers change
+        mangled = self.read('a.mp3')
+        offsets = [header.offset for header in mp3.Reader(bytearray(original)).headers()]
+        mask = bytearray(len(original))
+        for offset in offsets:
+            mask[offset + 2] = 0x01
+            mask[offset + 3] = 0x04
+        changed = [i for i in xrange(len(original)) if original[i] != mangled[i]]
+        self.assertEquals(len(mangled), len(original))
+        self.assertTrue(changed)
+        self.assertTrue(all((ord(original[i]) ^ ord(mangled[i])) & ~mask[i] == 0 \
+            for i in changed))
+        self.assertEquals([header.offset for header in \
+            mp3.Reader(bytearray(mangled)).headers()], offsets)
+        self.assertTrue('Skipping 1 unchanged files' in self.sanitize(*args))
+
+        # Patching in place dropped nothing, replacing the file is still to do
+        self.assertFalse('Skipping' in self.sanitize('-i', path, '--replace', '--mangle', \
+            '--manifest', manifest))
+
+    def testInPlaceAbort(self):
+        from mp3.tests import corpus
+
+        sanitize = self.script()
+        path = self.write('a.mp3', corpus.generate(100))
+        options = argparse.Namespace(stats = False)
+
+        # Aborted files are not reported as processed
+        sanitize.want_exit = True
+        self.assertEquals(sanitize.mangle_in_place(path, options), None)
+        sanitize.want_exit = False
+        self.assertEquals(sanitize.mangle_in_place(path, options), '')
+
+class CountingWriter(object):
+    """File-like object counting write calls."""
+    def __init__(self):
+        self.data = bytearray()
+        self.writes = 0
+
+    def write(self, data):
+        self.data += data
+        self.writes += 1
+
+class CoalesceTestCase(unittest.TestCase):
+    def setUp(self):
+        data, offsets = make_stream([9, 14] * 200, False)
+        self.data = str(data[:offsets[100]] + '\x00' * 10 + data[offsets[100]:])
+        self.frames = ''.join(str(frame.bytes()) for frame in mp3.good_data(stringio(self.data)))
+
+    def testGoodData(self):
+        for f in (stringio(self.data), buffer(self.data)):
+            runs = list(mp3.good_data(f, coalesce_frames = True))
+            self.assertEquals(''.join(run.tobytes() for run in runs), self.frames)
+            self.assertTrue(len(runs) < 10)
+
+        # Only runs of frames are merged
+        runs = list(mp3.good_data(buffer(self.data), coalesce_frames = True))
+        self.assertEquals(len(runs), 2)
+
+        # Frames kept without coalescing don't hold on to whole read chunks
+        frames = list(mp3.good_data(stringio(self.data)))
+        self.assertEquals(''.join(str(frame.bytes()) for frame in frames), self.frames)
+        self.assertEquals(len(set(id(frame._buffer._buffer) for frame in frames)), len(frames))
+
+    def testFrameWriter(self):
+        out = CountingWriter()
+        writer = mp3.FrameWriter(out, buffer_size = 64 * 1024)
+        for frame in mp3.Reader(stringio(self.data)).frames(shared_buffers = True):
+            writer.write_frame(frame)
+        writer.write('TAG')
+        writer.flush()
+
+        self.assertEquals(str(out.data), self.frames + 'TAG')
+        self.assertTrue(out.writes < 10)
+
+        # Copied frames are batched as well
+        out = CountingWriter()
+        writer = mp3.FrameWriter(out, buffer_size = 64 * 1024)
+        for frame in mp3.Reader(stringio(self.data)).frames():
+            writer.write_frame(frame)
+        writer.flush()
+        self.assertEquals(str(out.data), self.frames)
+        self.assertTrue(out.writes < 10)
+
+class ParserTestCase(unittest.TestCase):
+    def feed(self, parser, data, sizes):
+        frames = []
+        position = 0
+        while position < len(data):
+            size = sizes.next()
+            frames.extend(parser.feed(data[position:position + size]))
+            position += size
+        return frames + parser.close()
+
+    def assertParses(self, data, **kwargs):
+        expected = [(frame.offset, str(frame.bytes())) \
+            for frame in mp3.Reader(stringio(data)).frames(**kwargs)]
+
+        rand = random.Random(0)
+        for sizes in (iter(lambda: 1, None), iter(lambda: rand.randint(1, 2000), None),
+            iter(lambda: len(data), None)):
+            frames = self.feed(mp3.Parser(**kwargs), data, sizes)
+            self.assertEquals([(frame.offset, str(frame.bytes())) for frame in frames],
+                              expected)
+
+    def testChunks(self):
+        data, offsets = make_stream([9, 14, 5] * 20)
+        stream = good_id3v1_tag + riff_frame + make_vbr_frame('Xing', '\x00' * 8) + \
+            str(data) + good_id3v1_tag
+        self.assertParses(stream)
+        self.assertParses(stream, emit_meta_frames = False, emit_id3_frames = False, \
+            emit_riff_frames = False)
+
+        # The Xing frame is told apart from audio frames even if it arrives
+        # one byte at a time
+        parser = mp3.Parser()
+        frames = []
+        for c in str(make_vbr_frame('Xing', '\x00' * 8) + data):
+            frames.extend(parser.feed(c))
+        self.assertTrue(isinstance(frames[0], mp3.XingFrame))
+        self.assertEquals(len(frames), 61)
+
+    def testResync(self):
+        rand = random.Random(0)
+        garbage = ''.join(chr(rand.getrandbits(8)) for i in xrange(5000))
+        self.assertParses(good_frame_data * 3 + '\x00' + garbage + good_frame_data * 3)
+        self.assertParses('\x00' + good_frame_data * 2 + '\x00' * 100 + good_frame_data * 3)
+        self.assertParses('\x00' + good_frame_data * 2)
+
+    def testShortInput(self):
+        # Frames are only returned once complete, the rest waits for more data
+        parser = mp3.Parser()
+        self.assertEquals(parser.feed(good_frame_data[:-1]), [])
+        self.assertEquals(parser.feed(good_frame_data[-1:] + good_frame_data[:10]),
+                          [ good_frame_new ])
+        self.assertEquals(parser.tell(), len(good_frame_data))
+
+        # A truncated last frame is dropped at the end of the stream...
+        self.assertEquals(parser.close(), [])
+        self.assertEquals(parser.close(), [])
+        self.assertRaises(ValueError, parser.feed, good_frame_data)
+
+        # ... or is an error
+        parser = mp3.Parser(skip_invalid_data = False)
+        self.assertEquals(parser.feed(good_frame_data[:-1]), [])
+        self.assertRaises(mp3.MP3Error, parser.close)
+
+        parser = mp3.Parser(skip_invalid_data = False)
+        self.assertRaises(mp3.MP3Error, parser.feed, '\x00' * 100)
+
+    def testFramesOutliveChunks(self):
+        parser = mp3.Parser()
+        frames = parser.feed(good_frame_data * 2 + good_frame_data[:100])
+        frames += parser.feed(good_frame_data[100:]) + parser.close()
+        self.assertEquals(frames, [ good_frame_new ] * 3)
+        self.assertEquals([frame.offset for frame in frames],
+                          [i * len(good_frame_data) for i in xrange(3)])
+
+@unittest.skipIf(numpy is None, 'requires NumPy')
+class FrameTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+        rand = random.Random(0)
+        data, offsets = make_stream([9, 14, 5, 1] * 50)
+        garbage = '\x00' + ''.join(chr(rand.getrandbits(8)) for i in xrange(3000))
+        self.data = 'ID3\x03\x00\x00\x00\x00\x01\x00' + '\xff\xfb' * 64 + \
+            str(make_vbr_frame('Xing', '\x00' * 8)) + str(data[:offsets[100]]) + \
+            garbage + str(data[offsets[100]:]) + good_id3v1_tag
+        self.path = os.path.join(self.dir, 'test.mp3')
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testBuild(self):
+        headers = list(mp3.Reader(stringio(self.data)).headers())
+        self.assertEquals(len(headers), 200)
+
+        for f in (open(self.path, 'rb'), stringio(self.data)):
+            table = mp3.FrameTable.build(f)
+            self.assertEquals(len(table), 200)
+            for name in ('offset', 'bitrate', 'samplingrate', 'channelmode', 'padding', 'crc'):
+                self.assertEquals(list(getattr(table, name)),
+                                  [getattr(header, name) for header in headers])
+            self.assertEquals(list(table.length), [header.frame_length() for header in headers])
+            f.close()
+
+        self.assertEquals(len(mp3.FrameTable.build(stringio(good_id3v1_tag))), 0)
+
+        # Offsets are absolute, whether the file is mapped or read
+        with open(self.path, 'wb') as f:
+            f.write('\x00' * 100 + self.data)
+        for f in (open(self.path, 'rb'), stringio('\x00' * 100 + self.data)):
+            f.seek(100)
+            self.assertEquals(list(mp3.FrameTable.build(f).offset), \
+                [header.offset + 100 for header in headers])
+            f.close()
+
+    def testSave(self):
+        with open(self.path, 'rb') as f:
+            table = mp3.FrameTable.build(f)
+
+        for name in ('table.npy', 'table.npz'):
+            path = os.path.join(self.dir, name)
+            table.save(path)
+            self.assertEquals(mp3.FrameTable.load(path), table)
+
+        records = table.to_records()
+        self.assertEquals(list(records['offset']), list(table.offset))
+        self.assertEquals(mp3.FrameTable.from_records(records), table)
+        self.assertNotEquals(mp3.FrameTable(), table)
+
+class ProjectionTestCase(unittest.TestCase):
+    def setUp(self):
+        data, offsets = make_stream([9, 14, 5] * 20)
+        self.data = good_id3v1_tag + str(make_vbr_frame('Xing', '\x00' * 8)) + \
+            str(data[:offsets[30]]) + '\x00' * 100 + str(data[offsets[30]:]) + good_id3v1_tag
+
+    def project(self, frame, fields):
+        header = isinstance(frame, mp3.MPEGFrame) and frame.header
+        values = {'offset': frame.offset, 'length': frame.length, 'type': type(frame),
+            'data': str(frame.bytes()), 'samples': header.samples() if header else None}
+        return tuple(values[name] if name in values else \
+            (getattr(header, name) if header else None) for name in fields)
+
+    def testFields(self):
+        for fields in [('offset', 'length', 'type', 'data'), ('length', 'bitrate', 'samples'),
+            ('type', 'version', 'layer', 'crc', 'samplingrate', 'padding', 'channelmode', 'private')]:
+            for f in (stringio(self.data), buffer(self.data)):
+                reader = mp3.Reader(f)
+                expected = [self.project(frame, fields) for frame in reader.frames()]
+                self.assertEquals(len(expected), 63)
+
+                if isinstance(f, StringIO.StringIO):
+                    f.seek(0)
+                result = [tuple(isinstance(value, memoryview) and value.tobytes() or value \
+                    for value in record) for record in mp3.Reader(f).frames(fields = fields)]
+                self.assertEquals(result, expected)
+
+        records = list(mp3.Reader(buffer(self.data)).frames(fields = ('type', 'bitrate'), \
+            emit_meta_frames = False, emit_id3_frames = False))
+        self.assertEquals(records[0].type, mp3.XingFrame)
+        self.assertEquals(records[1].bitrate, 128)
+        self.assertEquals(len(records), 61)
+
+        self.assertRaises(ValueError, mp3.Reader(buffer(self.data)).frames, fields = ('length', 'foo'))
+
+    def testInvalidData(self):
+        frames = mp3.Reader(buffer(self.data)).frames(fields = ('length',), skip_invalid_data = False)
+        self.assertRaises(mp3.MP3Error, list, frames)
+
+class CorpusTestCase(unittest.TestCase):
+    def testStreams(self):
+        from mp3.tests import corpus
+
+        for version in (1, 2, 2.5):
+            for layer in (1, 2, 3):
+                for crc in (False, True):
+                    data = corpus.generate(50, version, layer, 'vbr', crc = crc, seed = layer)
+                    headers = list(mp3.Reader(buffer(data)).headers())
+                    self.assertEquals(len(headers), 50)
+                    for header in headers:
+                        self.assertEquals((header.version, header.layer), (version, layer))
+                        self.assertTrue(header.valid())
+
+    def testXing(self):
+        from mp3.tests import corpus
+
+        data = corpus.generate(100, bitrates = (128, 192), xing = True)
+        frames = list(mp3.Reader(buffer(data)).frames(emit_meta_frames = True))
+        self.assertTrue(isinstance(frames[0], mp3.XingFrame))
+        self.assertEquals(len(frames), 101)
+        self.assertEquals(mp3.duration(buffer(data)).method, 'xing')
+
+    def testTags(self):
+        from mp3.tests import corpus
+
+        data = corpus.generate(20, id3v1 = True, id3v2 = True, ape = True)
+        frames = list(mp3.Reader(buffer(data)).frames(emit_id3_frames = True, emit_ape_frames = True))
+        self.assertEquals([type(frame) for frame in frames], [mp3.ID3Frame] + \
+            [mp3.MPEGFrame] * 20 + [mp3.APEFrame, mp3.ID3Frame])
+        self.assertEquals((frames[0].version, frames[-1].version), \
+            (mp3.ID3Frame.V2, mp3.ID3Frame.V1))
+
+        data = corpus.generate(20, riff = True)
+        frames = list(mp3.Reader(buffer(data)).frames(emit_riff_frames = True))
+        self.assertEquals([type(frame) for frame in frames], [mp3.RIFFFrame] * 4 + \
+            [mp3.MPEGFrame] * 20)
+
+    def testCorruption(self):
+        from mp3.tests import corpus
+
+        data = corpus.generate(200, garbage = 5, bit_flips = 20, truncate = True, seed = 3)
+        self.assertEquals(data, corpus.generate(200, garbage = 5, bit_flips = 20, \
+            truncate = True, seed = 3))
+        self.assertNotEquals(data, corpus.generate(200, garbage = 5, bit_flips = 20, \
+            truncate = True, seed = 4))
+
+        frames = list(mp3.Reader(buffer(data)).frames(skip_invalid_data = True))
+        self.assertTrue(0 < len(frames) <= 200)
+
+class BenchmarksTestCase(unittest.TestCase):
+    def testCompare(self):
+        from mp3.tests import benchmarks
+
+        result = benchmarks.measure('bitpack', repeat = 1)
+        self.assertTrue(result['seconds'] > 0)
+        self.assertEquals(result['unit'], 'ops/s')
+
+        baseline = {'a': {'seconds': 1.0, 'rss_growth_kb': 100},
+                    'b': {'seconds': 1.0, 'rss_growth_kb': 100},
+                    'c': {'seconds': 1.0, 'rss_growth_kb': 100},
+                    'd': {'error': 'failed'}}
+        results = {'a': {'seconds': 1.05, 'rss_growth_kb': 100},
+                   'b': {'seconds': 1.5, 'rss_growth_kb': 100},
+                   'c': {'seconds': 0.5, 'rss_growth_kb': 100 + 10 * 1024},
+                   'd': {'seconds': 1.0, 'rss_growth_kb': 0},
+                   'e': {'seconds': 1.0, 'rss_growth_kb': 0}}
+
+        stdout = sys.stdout
+        sys.stdout = stringio()
+        try:
+            self.assertEquals(benchmarks.compare(results, baseline, 0.1), ['b', 'c'])
+        finally:
+            sys.stdout = stdout
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork()')
+    def testMemory(self):
+        from mp3.tests import benchmarks
+
+        # Reading a file whole has to show up as memory growth, reading it in
+        # chunks must not, however much memory it took to set up
+        size = 8 * 1024 * 1024
+        def setup(slurp):
+            def setup(directory, scale):
+                scratch = bytearray(4 * size)
+                path = benchmarks.write_file(directory, 'input', str(scratch[:size]))
+                def run():
+                    with open(path, 'rb') as f:
+                        if slurp:
+                            bytearray(f.read())
+                        else:
+                            while f.read(64 * 1024):
+                                pass
+                return run, size
+            return setup
+
+        benchmarks.BENCHMARKS['slurp'] = (setup(True), 'MB')
+        benchmarks.BENCHMARKS['chunks'] = (setup(False), 'MB')
+        try:
+            slurp = benchmarks.measure_isolated('slurp', repeat = 1)
+            chunks = benchmarks.measure_isolated('chunks', repeat = 1)
+        finally:
+            del benchmarks.BENCHMARKS['slurp'], benchmarks.BENCHMARKS['chunks']
+
+        self.assertTrue(slurp['rss_growth_kb'] >= size / 1024, slurp)
+        self.assertTrue(chunks['rss_growth_kb'] < benchmarks._MEMORY_SLACK_KB, chunks)
+
+        stdout = sys.stdout
+        sys.stdout = stringio()
+        try:
+            self.assertEquals(benchmarks.compare({'a': slurp}, {'a': chunks}, 0.1), ['a'])
+        finally:
+            sys.stdout = stdout
+
+def syncsafe(size):
+    return ''.join(chr(size >> shift & 0x7f) for shift in (21, 14, 7, 0))
+
+def unsynchronize(data):
+    return re.sub('\xff(?=[\x00\xe0-\xff]|$)', '\xff\x00', data)
+
+def make_id3v2_tag(version, frames, flags = 0, padding = 16):
+    """Builds an ID3v2 tag of (id, data, flags) frames."""
+    body = ''
+    for frame_id, data, frame_flags in frames:
+        if version == 2:
+            body += frame_id + struct.pack('>I', len(data))[1:] + data
+        elif version == 3:
+            body += frame_id + struct.pack('>IH', len(data), frame_flags) + data
+        else:
+            if frame_flags & 0x0002 or flags & 0x80:
+                data = unsynchronize(data)
+            body += frame_id + syncsafe(len(data)) + struct.pack('>H', frame_flags) + data
+    body += '\x00' * padding
+
+    if flags & 0x80 and version < 4:
+        body = unsynchronize(body)
+    return 'ID3' + chr(version) + '\x00' + chr(flags) + syncsafe(len(body)) + body
+
+class ID3v2TestCase(unittest.TestCase):
+    binary = '\xff\x00\xff\xe0\xff\xff' * 100 + '\xff'
+
+    def frames(self, version):
+        ids = version == 2 and ('TT2', 'TP1', 'TAL', 'TRK', 'PIC') or \
+            ('TIT2', 'TPE1', 'TALB', 'TRCK', 'APIC')
+        values = ['\x00Title\xff', '\x01' + u'Art\xefst'.encode('utf-16'), \
+            '\x03Alb\xc3\xbcm\x00', '\x003/12', self.binary]
+        return zip(ids, values)
+
+    def testVersions(self):
+        from id3 import v2
+
+        for version in (2, 3, 4):
+            frames = self.frames(version)
+            for flags, frame_flags in ((0, 0), (0x80, 0), (0, 0x0002)):
+                if version < 4 and frame_flags:
+                    continue
+
+                data = make_id3v2_tag(version, [(frame_id, value, frame_flags) \
+                    for frame_id, value in frames], flags)
+                tag = v2.read(stringio(data + good_frame_data))
+                self.assertEquals((tag.version, tag.size), (version, len(data)))
+                self.assertEquals([frame.id for frame in tag.all_frames], \
+                    [frame_id for frame_id, value in frames])
+                self.assertEquals([tag.frames[frame_id].value for frame_id, value in frames], \
+                    [u'Title\xff', u'Art\xefst', u'Alb\xfcm', u'3/12', None])
+                self.assertEquals(tag.frames[frames[-1][0]].data, self.binary)
+
+    def testFrameFlags(self):
+        from id3 import v2
+
+        compressed = zlib.compress('\x00Compressed')
+        data = make_id3v2_tag(3, [('TIT2', struct.pack('>I', 11) + compressed, 0x0080),
+            ('TPE1', '\x01\x00Encrypted', 0x0040), ('TALB', '\x01\x00Album', 0x0020)])
+        tag = v2.parse(data)
+        self.assertEquals(tag.value('TIT2'), u'Compressed')
+        self.assertFalse('TPE1' in tag.frames)
+        self.assertEquals(tag.value('TALB'), u'Album')
+
+        data = make_id3v2_tag(4, [('TIT2', syncsafe(11) + compressed, 0x0009),
+            ('TALB', '\x01\x00Album', 0x0040), ('TPE1', '\x00Artist', 0)])
+        tag = v2.parse(data)
+        self.assertEquals(tag.value('TIT2'), u'Compressed')
+        self.assertEquals(tag.value('TALB', 'TPE1'), u'Album')
+
+        # Extended headers are skipped
+        body = struct.pack('>I', 6) + '\x00' * 6 + 'TIT2' + struct.pack('>IH', 6, 0) + '\x00Title'
+        data = 'ID3\x03\x00\x40' + syncsafe(len(body)) + body
+        self.assertEquals(v2.parse(data).value('TIT2'), u'Title')
+
+    def testLazyFrames(self):
+        from id3 import v2
+
+        for version in (3, 4):
+            data = make_id3v2_tag(version, [(frame_id, value, 0) \
+                for frame_id, value in self.frames(version)], 0x80)
+            tag = v2.parse(data)
+            picture = tag.frames['APIC']
+            self.assertEquals(picture._data, None)
+            self.assertEquals(picture.value, None)
+            self.assertEquals(picture.data, self.binary)
+
+            tag = v2.parse(data, ids = ('TIT2', 'TALB'))
+            self.assertEquals(sorted(tag.frames), ['TALB', 'TIT2'])
+            self.assertEquals(tag.value('TPE1', 'TIT2'), u'Title\xff')
+
+    def testErrors(self):
+        from id3 import v2, neds_id3reader
+
+        self.assertEquals(v2.read(stringio(good_frame_data)), None)
+        self.assertEquals(v2.tag_size('ID3\x03\x00\x00\x00\x00\x80\x00'), None)
+
+        # Unknown text encodings are read as latin-1
+        data = make_id3v2_tag(3, [('TIT2', '\x07Titl\xe9\x00', 0)])
+        self.assertEquals(v2.parse(data).value('TIT2'), u'Titl\xe9')
+
+        data = make_id3v2_tag(3, [('TIT2', '\x00Title', 0)])
+        self.assertRaises(neds_id3reader.Id3Error, v2.parse, data[:-20])
+        self.assertRaises(neds_id3reader.Id3Error, v2.parse, \
+            data.replace('\x00\x00\x00\x06', '\x00\x00\x01\x00'))
+
+    def testLoad(self):
+        import id3
+
+        data = make_id3v2_tag(3, [(frame_id, value, 0) for frame_id, value in self.frames(3)] + \
+            [('TYER', '\x002012', 0)])
+        tagged = tempfile.NamedTemporaryFile(suffix = '.mp3')
+        tagged.write(data + good_frame_data + good_id3v1_tag)
+        tagged.flush()
+
+        tag = id3.load(tagged.name)
+        self.assertEquals((tag['title'], tag['artist'], tag['album'], tag['track'], tag['year']), \
+            (u'Title\xff', u'Art\xefst', u'Alb\xfcm', 0, u'2012'))
+        tagged.close()
+
+class ID3LoadTestCase(unittest.TestCase):
+    def setUp(self):
+        from mp3.tests import corpus
+
+        self.v2 = make_id3v2_tag(3, [('TIT2', '\x00Title 2', 0), ('TPE1', '\x00', 0), \
+            ('TRCK', '\x007', 0)])
+        self.ape = str(corpus.ape_tag({'Title': 'Title APE', 'ARTIST': 'Art\xc3\xafst', \
+            'Album': 'Album APE', 'Track': '3/12'}))
+        self.v1 = str(corpus.id3v1_tag(title = 'Title 1', artist = 'Artist 1', \
+            album = 'Alb\xfcm 1', track = 5))
+        self.audio = corpus.generate(200)
+
+    def id3tag(self, data, **kwargs):
+        import id3
+
+        f = CountingFile(data)
+        return id3.id3tag(f, **kwargs), f.reads
+
+    def testPrecedence(self):
+        tag, reads = self.id3tag(self.audio, title = 'Title', path = 'a.mp3')
+        self.assertEquals((tag['title'], tag['artist'], tag['path']), (u'Title', None, 'a.mp3'))
+
+        tag, reads = self.id3tag(self.audio + self.v1)
+        self.assertEquals((tag['title'], tag['album'], tag['track'], tag['year']), \
+            (u'Title 1', u'Alb\xfcm 1', 5, u'2012'))
+
+        tag, reads = self.id3tag(self.audio + self.ape + self.v1)
+        self.assertEquals((tag['title'], tag['artist'], tag['album'], tag['track']), \
+            (u'Title APE', u'Art\xefst', u'Album APE', 5))
+
+        tag, reads = self.id3tag(self.v2 + self.audio + self.ape + self.v1)
+        self.assertEquals((tag['title'], tag['artist'], tag['album'], tag['track'], \
+            tag['genre']), (u'Title 2', u'Art\xefst', u'Album APE', 7, u'Other'))
+
+    def testReads(self):
+        import id3
+
+        self.assert_(len(self.audio) > id3._HEAD_SIZE + id3._TAIL_SIZE)
+        for data in (self.audio, self.v2 + self.audio + self.ape + self.v1):
+            self.assertEquals(self.id3tag(data)[1], 2)
+        self.assertEquals(self.id3tag(self.v2 + good_frame_data + self.v1)[1], 1)
+
+        # The rest of a tag larger than the head is only read if frames are
+        # missing
+        text = [(frame_id, '\x00Title 2', 0) for frame_id in \
+            ('TIT2', 'TPE1', 'TALB', 'TRCK', 'TYER')]
+        picture = [('APIC', '\x00' * id3._HEAD_SIZE, 0)]
+        for frames, reads in ((text + picture, 2), (text[:1] + picture, 3), (picture + text, 3)):
+            tag, count = self.id3tag(make_id3v2_tag(4, frames) + self.audio)
+            self.assertEquals((tag['title'], count), (u'Title 2', reads))
+
+        # Nor if the head ends in padding, and then only from where the
+        # head ends, seeking past frames that are not needed
+        f = CountingFile(make_id3v2_tag(4, text[:2], padding = 200 * 1024) + self.audio)
+        self.assertEquals((id3.id3tag(f)['title'], f.reads), (u'Title 2', 2))
+        # (one small read for each picture)
+        f = CountingFile(make_id3v2_tag(4, text[:1] + picture * 3 + text[1:]) + self.audio)
+        self.assertEquals((id3.id3tag(f)['artist'], f.reads), (u'Title 2', 5))
+        self.assert_(f.bytes_read < 2 * id3._HEAD_SIZE, f.bytes_read)
+
+    def testLargeAPETag(self):
+        from mp3.tests import corpus
+        import id3
+
+        # APE tags larger than the tail are read in one more read
+        ape = str(corpus.ape_tag({'Title': 'Title APE', 'Comment': 'x' * id3._TAIL_SIZE}))
+        for data, reads in ((self.audio + ape, 3), (self.audio + ape + self.v1, 3), \
+            (good_frame_data + ape + self.v1, 1)):
+            tag, count = self.id3tag(data)
+            self.assertEquals((tag['title'], tag['comment'], count), \
+                (u'Title APE', u'x' * id3._TAIL_SIZE, reads))
+
+    def testTruncated(self):
+        from id3 import v2
+
+        data = make_id3v2_tag(3, [('TIT2', '\x00Title', 0), ('APIC', '\x00' * 100, 0), \
+            ('TALB', '\x00Album', 0)])
+        for size, ids in ((len(data), ['TIT2', 'APIC', 'TALB']), (50, ['TIT2']), (10, [])):
+            tag = v2.parse(data[:size], truncated = True)
+            self.assertEquals(([frame.id for frame in tag.all_frames], tag.truncated), \
+                (ids, size < len(data)))
+
+    def testResume(self):
+        from id3 import v2
+
+        picture = '\x01' * (v2._RESUME_SIZE * 2)
+        for version, flags in ((3, 0), (4, 0), (3, 0x80)):
+            data = make_id3v2_tag(version, [('TIT2', '\x00Title', 0), ('APIC', picture, 0), \
+                ('COMM', '\x00eng\x00\xff\xe0', 0), ('TALB', '\x00Album', 0)], flags)
+            tag = v2.parse(data[:30], truncated = True)
+            v2.resume(stringio(data), tag)
+            self.assertEquals(([frame.id for frame in tag.all_frames], tag.truncated), \
+                (['TIT2', 'APIC', 'COMM', 'TALB'], False))
+            self.assertEquals(str(tag.frames['APIC'].data), picture)
+
+            # Cut off files stay truncated
+            tag = v2.parse(data[:30], ['TALB'], truncated = True)
+            v2.resume(stringio(data[:-40]), tag, ['TALB'])
+            self.assertEquals((tag.all_frames, tag.truncated), ([], True))
+
+    def testApe(self):
+        from id3 import ape
+        from mp3.tests import corpus
+
+        # Binary items are left out
+        data = corpus.ape_tag({'Cover': '\x00\xff', 'Title': 'Title'})
+        data[36:40] = struct.pack('<I', 2)
+        self.assertEquals(ape.parse(str(data)), {'title': 'Title'})
+
+        self.assertEquals(ape.parse(self.ape + self.v1, len(self.ape)), {'title': 'Title APE', \
+            'artist': 'Art\xc3\xafst', 'album': 'Album APE', 'track': '3/12'})
+        self.assertEquals(ape.parse(self.ape[len(self.ape) / 2:]), None)
+        self.assertEquals(ape.parse(self.v1), None)
+
+    def testEncodings(self):
+        from mp3.tests import corpus
+
+        for title, expected in (('Plain', u'Plain'), ('Caf\xc3\xa9', u'Caf\xe9'), \
+            ('Caf\xe9', u'Caf\xe9'), ('\xed\x9f\xbf\xf4\x8f\xbf\xbf', u'\ud7ff\U0010ffff'), \
+            ('\xc0\xaf\xf4\x90\x80\x80', u'\xc0\xaf\xf4\x90\x80\x80')):
+            tag, reads = self.id3tag(self.audio + str(corpus.id3v1_tag(title)))
+            self.assertEquals(tag['title'], expected)
+
 suite = unittest.TestSuite()
 suite.addTests([unittest.makeSuite(GoodDataTestCase, 'test')])
 suite.addTests([unittest.makeSuite(FramesTestCase, 'test')])
+suite.addTests([unittest.makeSuite(MappedTestCase, 'test')])
+suite.addTests([unittest.makeSuite(SharedBuffersTestCase, 'test')])
+suite.addTests([unittest.makeSuite(HeaderTestCase, 'test')])
+suite.addTests([unittest.makeSuite(CompactHeaderTestCase, 'test')])
+suite.addTests([unittest.makeSuite(BitpackTestCase, 'test')])
+suite.addTests([unittest.makeSuite(ResyncTestCase, 'test')])
+suite.addTests([unittest.makeSuite(StatsTestCase, 'test')])
+suite.addTests([unittest.makeSuite(IndexTestCase, 'test')])
+suite.addTests([unittest.makeSuite(DuplicatesTestCase, 'test')])
+suite.addTests([unittest.makeSuite(SeekTestCase, 'test')])
+suite.addTests([unittest.makeSuite(HeadersTestCase, 'test')])
+suite.addTests([unittest.makeSuite(DurationTestCase, 'test')])
+suite.addTests([unittest.makeSuite(PipelineTestCase, 'test')])
+suite.addTests([unittest.makeSuite(SanitizeTestCase, 'test')])
+suite.addTests([unittest.makeSuite(CoalesceTestCase, 'test')])
+suite.addTests([unittest.makeSuite(ParserTestCase, 'test')])
+suite.addTests([unittest.makeSuite(FrameTableTestCase, 'test')])
+suite.addTests([unittest.makeSuite(ProjectionTestCase, 'test')])
+suite.addTests([unittest.makeSuite(CorpusTestCase, 'test')])
+suite.addTests([unittest.makeSuite(BenchmarksTestCase, 'test')])
+suite.addTests([unittest.makeSuite(ID3v2TestCase, 'test')])
+suite.addTests([unittest.makeSuite(ID3LoadTestCase, 'test')])
 
 __all__ = ['suite']
 
@@ -0,0 +1,440 @@
+#
+# benchmarks.py -- Benchmarks for the hot paths of python-mp3
+# Copyright (C) 2012 Lorenz Bauer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Benchmarks for the parser, buffer and command line hot paths.
+
+Run them with
+
+    python -m mp3.tests.benchmarks [-o results.json] [-b baseline.json] [name ...]
+
+Every benchmark runs in a child process of its own, forked once its input
+has been generated. It reports the best time out of a few runs, the
+resulting throughput and how much the child's peak resident set size
+(ru_maxrss) grew while running, which should stay flat for the long inputs.
+Comparing a *_long benchmark's throughput to that of its regular sized
+counterpart shows whether its running time is linear in the input size.
+
+Results are written as JSON; given a baseline written by an earlier run,
+benchmarks that got slower or use more memory than the threshold allows
+are reported and make the runner exit with status 1.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import struct
+import shutil
+import platform
+import resource
+import tempfile
+import argparse
+import subprocess
+
+import mp3
+import id3
+from mp3 import _bitpack
+from mp3._crc16 import crc16
+from mp3.tests import corpus
+
+# name -> (setup function, unit)
+BENCHMARKS = {}
+
+# Frames in the regular inputs, the long ones have _LONG_FACTOR times as many
+_FRAMES = 10000
+_LONG_FACTOR = 8
+# Bytes of adversarial input for the resynchronisation benchmarks
+_GARBAGE_SIZE = 256 * 1024
+# Peak memory growth below this is noise
+_MEMORY_SLACK_KB = 1024
+
+_SANITIZE_MP3 = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, 'sanitize-mp3')
+
+def benchmark(unit):
+    """Registers a benchmark. The decorated function is called with a
+    scratch directory and the scale, and returns a function running the
+    benchmark once and the amount of work (in unit) that run does."""
+    def register(setup):
+        BENCHMARKS[setup.__name__] = (setup, unit)
+        return setup
+    return register
+
+def cbr_stream(frames):
+    return corpus.generate(frames)
+
+def vbr_stream(frames):
+    return corpus.generate(frames, bitrates = 'vbr', xing = True)
+
+def garbage_stream(frames):
+    """A stream with a run of up to 1000 bytes of garbage every 50 frames."""
+    return corpus.generate(frames, garbage = frames / 50)
+
+def _repeat(pattern, size):
+    return (pattern * (size / len(pattern) + 1))[:size]
+
+def write_file(directory, name, data):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+def _read_frames(path):
+    def run():
+        with open(path, 'rb') as f:
+            for frame in mp3.Reader(f).frames():
+                pass
+    return run, os.path.getsize(path)
+
+@benchmark('MB')
+def frames_cbr(directory, scale):
+    return _read_frames(write_file(directory, 'cbr.mp3', cbr_stream(_FRAMES * scale)))
+
+@benchmark('MB')
+def frames_cbr_long(directory, scale):
+    return _read_frames(write_file(directory, 'long.mp3', \
+        cbr_stream(_FRAMES * _LONG_FACTOR * scale)))
+
+@benchmark('MB')
+def frames_vbr(directory, scale):
+    return _read_frames(write_file(directory, 'vbr.mp3', vbr_stream(_FRAMES * scale)))
+
+@benchmark('MB')
+def frames_garbage(directory, scale):
+    return _read_frames(write_file(directory, 'garbage.mp3', garbage_stream(_FRAMES * scale)))
+
+def _resync(directory, name, data):
+    """Reads data, between two valid frames, which the reader has to
+    resynchronise through."""
+    frame = str(corpus.frame())
+    return _read_frames(write_file(directory, name + '.mp3', frame + data + frame))
+
+@benchmark('MB')
+def resync_random(directory, scale):
+    return _resync(directory, 'random', \
+        str(corpus._random_bytes(random.Random(0), _GARBAGE_SIZE * scale)))
+
+@benchmark('MB')
+def resync_zeroes(directory, scale):
+    return _resync(directory, 'zeroes', '\x00' * _GARBAGE_SIZE * scale)
+
+@benchmark('MB')
+def resync_0xff(directory, scale):
+    return _resync(directory, '0xff', '\xff' * _GARBAGE_SIZE * scale)
+
+# Valid headers and tag headers, but never followed by another frame
+
+@benchmark('MB')
+def resync_fake_sync(directory, scale):
+    return _resync(directory, 'sync', _repeat('\xff\xfb\x90\x64', _GARBAGE_SIZE * scale))
+
+@benchmark('MB')
+def resync_fake_sync_long(directory, scale):
+    return _resync(directory, 'sync', \
+        _repeat('\xff\xfb\x90\x64', _GARBAGE_SIZE * _LONG_FACTOR * scale))
+
+@benchmark('MB')
+def resync_fake_id3v1(directory, scale):
+    return _resync(directory, 'id3v1', _repeat('TAG', _GARBAGE_SIZE * scale))
+
+@benchmark('MB')
+def resync_fake_id3v2(directory, scale):
+    return _resync(directory, 'id3v2', \
+        _repeat('ID3\x03\x00\x00\x00\x00\x01\x00', _GARBAGE_SIZE * scale))
+
+@benchmark('MB')
+def resync_fake_ape(directory, scale):
+    return _resync(directory, 'ape', \
+        _repeat('APETAGEX\xd0\x07\x00\x00\x10\x00\x00\x00\x00', _GARBAGE_SIZE * scale))
+
+@benchmark('MB')
+def frames_mmap(directory, scale):
+    path = write_file(directory, 'cbr.mp3', cbr_stream(_FRAMES * scale))
+    def run():
+        with open(path, 'rb') as f:
+            for frame in mp3.Reader(f, use_mmap = True).frames():
+                pass
+    return run, os.path.getsize(path)
+
+def _build_table(path):
+    def run():
+        with open(path, 'rb') as f:
+            mp3.FrameTable.build(f)
+    return run, os.path.getsize(path)
+
+def resync_stream(frames):
+    """A stream with a run of up to 1000 bytes of garbage every 5 frames."""
+    return corpus.generate(frames, garbage = frames / 5)
+
+@benchmark('MB')
+def table_resync(directory, scale):
+    return _build_table(write_file(directory, 'resync.mp3', resync_stream(_FRAMES * scale)))
+
+@benchmark('MB')
+def table_resync_long(directory, scale):
+    return _build_table(write_file(directory, 'resync_long.mp3', \
+        resync_stream(_FRAMES * _LONG_FACTOR * scale)))
+
+@benchmark('headers')
+def header_decode(directory, scale):
+    data = bytearray(vbr_stream(_FRAMES * scale))
+    buf = mp3.MappedBuffer(data)
+    offsets = [header.offset for header in mp3.Reader(data).headers()]
+    def run():
+        for offset in offsets:
+            mp3.Header(buf, offset)
+    return run, len(offsets)
+
+@benchmark('headers')
+def header_decode_uncached(directory, scale):
+    data = bytearray(vbr_stream(1000))
+    words = list(set(struct.unpack_from('>I', data, header.offset)[0] \
+        for header in mp3.Reader(data).headers())) * 50 * scale
+    def run():
+        for word in words:
+            mp3.Header._decode_uncached(word)
+    return run, len(words)
+
+@benchmark('ops')
+def bitpack(directory, scale):
+    fmt = mp3.Header._FORMAT
+    data = corpus.frame()[:4]
+    values = _bitpack.bitunpack_from(fmt, data)
+    count = 20000 * scale
+    def run():
+        buf = bytearray(4)
+        for i in xrange(count):
+            fmt.unpack_from(data)
+            _bitpack.bitpack_into(fmt, buf, 0, *values)
+    return run, count
+
+@benchmark('MB')
+def crc16_side_info(directory, scale):
+    data = str(corpus.frame(rand = random.Random(0))[4:38])
+    count = 20000 * scale
+    def run():
+        for i in xrange(count):
+            crc16(data)
+    return run, count * len(data)
+
+@benchmark('MB')
+def buffer_fill(directory, scale):
+    data = cbr_stream(_FRAMES * scale)
+    def run():
+        buf = mp3.ZeroCopyBuffer(8192, io.BytesIO(data))
+        try:
+            while True:
+                buf.fill(at_least = 1000)
+                buf.delete(1000)
+        except EOFError:
+            pass
+    return run, len(data)
+
+@benchmark('files')
+def id3_load(directory, scale):
+    audio = cbr_stream(100)
+    paths = []
+    for i in xrange(50 * scale):
+        tag = corpus.id3v2_tag({'TIT2': 'Title %d' % i, 'TPE1': 'Artist', 'TALB': 'Album', \
+            'TRCK': str(i)})
+        paths.append(write_file(directory, 'tagged%d.mp3' % i, \
+            str(tag + audio + corpus.id3v1_tag())))
+    def run():
+        for path in paths:
+            id3.load(path)
+    return run, len(paths)
+
+@benchmark('MB')
+def sanitize_mp3(directory, scale):
+    if not os.path.exists(_SANITIZE_MP3):
+        raise RuntimeError('sanitize-mp3 not found at %s' % _SANITIZE_MP3)
+
+    path = write_file(directory, 'sanitize.mp3', corpus.generate(_FRAMES * scale, \
+        bitrates = 'vbr', xing = True, id3v1 = True, id3v2 = True))
+    outfile = os.path.join(directory, 'sanitized.mp3')
+    def run():
+        # Existing output files are skipped
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call([sys.executable, _SANITIZE_MP3, '-i', path, '-o', outfile, \
+                '--mangle'], stdout = devnull)
+    return run, os.path.getsize(path)
+
+def _maxrss(who = resource.RUSAGE_SELF):
+    """Peak resident set size in KB."""
+    rss = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return rss
+
+def _run(run, amount, unit, repeat):
+    """Runs a set up benchmark repeat times and returns its results."""
+    rss = _maxrss()
+
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        run()
+        times.append(time.time() - start)
+
+    seconds = max(min(times), 1e-9)
+    if unit == 'MB':
+        amount /= 1024.0 * 1024.0
+
+    result = {
+        'seconds': seconds,
+        'rate': amount / seconds,
+        'unit': unit + '/s',
+        'rss_growth_kb': _maxrss() - rss,
+    }
+    children = _maxrss(resource.RUSAGE_CHILDREN)
+    if children:
+        result['child_peak_rss_kb'] = children
+    return result
+
+def measure(name, scale = 1, repeat = 3):
+    """measure(name, scale = 1, repeat = 3) -> dict
+
+    Runs a benchmark repeat times in this process and returns its results.
+    Memory used to set it up counts towards the peak, see
+    measure_isolated().
+    """
+    setup, unit = BENCHMARKS[name]
+    directory = tempfile.mkdtemp()
+    try:
+        run, amount = setup(directory, scale)
+        return _run(run, amount, unit, repeat)
+    finally:
+        shutil.rmtree(directory)
+
+def measure_isolated(name, scale = 1, repeat = 3):
+    """Like measure(), but sets the benchmark up in this process and runs it
+    in a forked child process. A child's peak memory usage starts out at
+    what it inherits, so neither the input nor other benchmarks count."""
+    if not hasattr(os, 'fork'):
+        return measure(name, scale, repeat)
+
+    setup, unit = BENCHMARKS[name]
+    directory = tempfile.mkdtemp()
+    try:
+        try:
+            run, amount = setup(directory, scale)
+        except Exception, e:
+            return {'error': '%s: %s' % (type(e).__name__, e)}
+
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            try:
+                result = _run(run, amount, unit, repeat)
+            except Exception, e:
+                result = {'error': '%s: %s' % (type(e).__name__, e)}
+            with os.fdopen(write_fd, 'w') as f:
+                json.dump(result, f)
+            os._exit(0)
+
+        os.close(write_fd)
+        with os.fdopen(read_fd) as f:
+            output = f.read()
+        os.waitpid(pid, 0)
+    finally:
+        shutil.rmtree(directory)
+
+    try:
+        return json.loads(output)
+    except ValueError:
+        return {'error': 'benchmark process died'}
+
+def compare(results, baseline, threshold):
+    """compare(results, baseline, threshold) -> names of regressed benchmarks
+
+    Prints how results differ from baseline. A benchmark regressed if it
+    takes more than threshold (e.g. 0.1 for 10%) longer than in the
+    baseline, or if its peak memory grew by that much more.
+    """
+    regressed = []
+    for name in sorted(results):
+        result = results[name]
+        base = baseline.get(name)
+        if not base or 'seconds' not in result or 'seconds' not in base:
+            continue
+
+        change = result['seconds'] / base['seconds'] - 1
+        memory = result['rss_growth_kb'] - base['rss_growth_kb']
+        slow = change > threshold
+        hungry = memory > max(_MEMORY_SLACK_KB, base['rss_growth_kb'] * threshold)
+
+        print '%-24s %+7.1f%% time %+9d KB memory%s' % (name, change * 100, memory, \
+            (slow or hungry) and '  REGRESSION' or '')
+        if slow or hungry:
+            regressed.append(name)
+
+    return regressed
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description = 'Run the python-mp3 benchmarks.')
+    parser.add_argument('names', nargs = '*', metavar = 'name',
+        help = 'benchmarks to run (default: all of %s)' % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('-o', '--output', help = 'write results to this JSON file')
+    parser.add_argument('-b', '--baseline', help = 'compare against results in this JSON file')
+    parser.add_argument('-t', '--threshold', type = float, default = 0.1,
+        help = 'relative slowdown counted as a regression (default: 0.1)')
+    parser.add_argument('-s', '--scale', type = int, default = 1,
+        help = 'multiply input sizes by this factor (default: 1)')
+    parser.add_argument('-r', '--repeat', type = int, default = 3,
+        help = 'runs per benchmark, the best one counts (default: 3)')
+    options = parser.parse_args(args)
+
+    names = options.names or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: %s' % name)
+
+    results = {}
+    for name in names:
+        result = results[name] = measure_isolated(name, options.scale, options.repeat)
+        if 'error' in result:
+            print '%-24s failed: %s' % (name, result['error'])
+        else:
+            print '%-24s %9.4f s %12.1f %-10s %+9d KB' % (name, result['seconds'], \
+                result['rate'], result['unit'], result['rss_growth_kb'])
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'python': platform.python_version(), 'platform': platform.platform(),
+                'scale': options.scale, 'benchmarks': results}, f, indent = 2, sort_keys = True)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+
+        if baseline.get('scale', 1) != options.scale:
+            parser.error('baseline was run with --scale %d' % baseline.get('scale', 1))
+
+        print
+        if compare(results, baseline['benchmarks'], options.threshold):
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,277 @@
+#
+# corpus.py -- Synthetic MP3 streams for tests and benchmarks
+# Copyright (C) 2012 Lorenz Bauer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Synthetic MP3 streams for tests and benchmarks.
+
+Streams consist of valid MPEG 1, 2 or 2.5 Layer I, II or III frames built
+from the Header tables, with random (but not meaningful) audio data. They
+can have CBR or VBR bitrates, CRCs, a Xing/Info frame, ID3v1/v2 and APE
+tags, a RIFF wrapper and seeded corruption. The same seed always gives the
+same bytes, so inputs of any size can be reproduced instead of shipped.
+
+    data = corpus.generate(frames = 1000, bitrates = 'vbr', xing = True, id3v2 = True)
+"""
+
+import struct
+import random
+import binascii
+
+from mp3 import Header, Channelmode
+
+__all__ = ['ape_tag', 'corrupt', 'frame', 'generate', 'id3v1_tag', 'id3v2_tag', 'riff_wrap', \
+    'stream', 'valid_bitrates', 'xing_frame']
+
+_DEFAULT_SAMPLINGRATES = {1: 44100, 2: 22050, 2.5: 11025}
+
+def _random_bytes(rand, size):
+    if not size:
+        return bytearray()
+    return bytearray(binascii.unhexlify('%0*x' % (size * 2, rand.getrandbits(size * 8))))
+
+def _header(version, layer, bitrate, samplingrate, padding, channelmode, crc):
+    header = Header(None)
+    header.sync = 0x7ff
+    header.version = version
+    header.layer = layer
+    header.crc = crc
+    header.bitrate = bitrate
+    header.samplingrate = samplingrate
+    header.padding = bool(padding)
+    header.channelmode = channelmode
+    header.private = header.copyright = header.original = False
+    header.modeextension = header.emphasis = 0
+    return header
+
+def valid_bitrates(version, layer):
+    """valid_bitrates(version, layer) -> list of bitrates in kbit/s"""
+    return list(Header._BITRATES[int(version) - 1][layer - 1])
+
+def frame(version = 1, layer = 3, bitrate = 128, samplingrate = None, padding = False, \
+    channelmode = Channelmode.STEREO, crc = False, payload = None, rand = None):
+    """frame(version = 1, layer = 3, bitrate = 128, samplingrate = None, padding = False, \\
+        channelmode = Channelmode.STEREO, crc = False, payload = None, rand = None) -> bytearray
+
+    Builds a single frame. The side info and the data following it are
+    payload (padded or cut to size), or random bytes from rand, or zeros.
+    Protected frames get a valid CRC, covering the side info (Layer III) or
+    the bit allocation at the start of the data (Layer I and II).
+    """
+    samplingrate = samplingrate or _DEFAULT_SAMPLINGRATES[version]
+    header = _header(version, layer, bitrate, samplingrate, padding, channelmode, crc)
+    length = header.frame_length()
+
+    data_size = length - header.length(include_side_info = False)
+    if payload is None:
+        payload = rand and _random_bytes(rand, data_size) or bytearray(data_size)
+    payload = bytearray(payload[:data_size])
+    payload += bytearray(data_size - len(payload))
+
+    side_info_size = header.side_info_size()
+    header._side_info = payload[:side_info_size]
+    if crc and layer != 3:
+        header._crc_data = payload[:Header._CRC_DATA_SIZE]
+    data = header.bytes()
+    data += payload[side_info_size:]
+
+    assert len(data) == length
+    return data
+
+def stream(frames, version = 1, layer = 3, bitrates = 128, samplingrate = None, \
+    channelmode = Channelmode.JOINT_STEREO, crc = False, seed = 0):
+    """stream(frames, version = 1, layer = 3, bitrates = 128, samplingrate = None, \\
+        channelmode = Channelmode.JOINT_STEREO, crc = False, seed = 0) -> (bytearray, offsets)
+
+    Builds a stream of audio frames and returns it with the frames' offsets.
+    bitrates is a bitrate (CBR), a sequence of bitrates that is repeated, or
+    'vbr' for random bitrates. Frames are padded like an encoder would, to
+    keep the average bitrate exact.
+    """
+    rand = random.Random(seed)
+    samplingrate = samplingrate or _DEFAULT_SAMPLINGRATES[version]
+
+    if bitrates == 'vbr':
+        choices = valid_bitrates(version, layer)
+        pattern = lambda i: rand.choice(choices)
+    elif isinstance(bitrates, (int, long)):
+        pattern = lambda i: bitrates
+    else:
+        pattern = lambda i: bitrates[i % len(bitrates)]
+
+    # Layer I frames consist of 4 byte slots
+    samples = Header._SAMPLES[version != 1][layer - 1]
+    slot_factor = layer == 1 and 12 or samples / 8
+
+    data = bytearray()
+    offsets = []
+    remainder = 0
+    for i in xrange(frames):
+        bitrate = pattern(i)
+        remainder += slot_factor * bitrate * 1000 % samplingrate
+        padding = remainder >= samplingrate
+        if padding:
+            remainder -= samplingrate
+
+        offsets.append(len(data))
+        data += frame(version, layer, bitrate, samplingrate, padding, channelmode, crc, \
+            rand = rand)
+
+    return data, offsets
+
+def xing_frame(data, offsets, version = 1, layer = 3, samplingrate = None, info = False, \
+    encoder = 'LAME3.99r', delay = 576, padding = 0):
+    """xing_frame(data, offsets, version = 1, layer = 3, samplingrate = None, info = False, \\
+        encoder = 'LAME3.99r', delay = 576, padding = 0) -> bytearray
+
+    Builds a Xing frame (or an Info frame, as written for CBR streams)
+    describing the stream data with frames at offsets, including a TOC and
+    a LAME tag with the encoder delay and padding. The frame uses the
+    highest bitrate, so that everything fits.
+    """
+    samplingrate = samplingrate or _DEFAULT_SAMPLINGRATES[version]
+    bitrate = valid_bitrates(version, layer)[-1]
+    header = _header(version, layer, bitrate, samplingrate, False, Channelmode.JOINT_STEREO, \
+        False)
+    length = header.frame_length()
+    total = len(data) + length
+
+    toc = bytearray(min(255, (length + offsets[len(offsets) * i / 100]) * 256 / total) \
+        for i in xrange(100))
+    tag = (info and 'Info' or 'Xing') + struct.pack('>III', 0xf, len(offsets), total) + \
+        str(toc) + struct.pack('>I', 50)
+    if encoder:
+        lame = bytearray(36)
+        lame[0:9] = encoder[:9].ljust(9)
+        lame[21:24] = struct.pack('>I', delay << 12 | padding)[1:]
+        tag += str(lame)
+
+    side_info = bytearray(header.side_info_size())
+    return frame(version, layer, bitrate, samplingrate, payload = side_info + tag)
+
+def id3v1_tag(title = 'Title', artist = 'Artist', album = 'Album', year = '2012', \
+    comment = 'Comment', track = 1, genre = 12):
+    """Builds an ID3v1.1 tag."""
+    return bytearray('TAG' + title[:30].ljust(30, '\x00') + artist[:30].ljust(30, '\x00') + \
+        album[:30].ljust(30, '\x00') + year[:4].ljust(4, '\x00') + \
+        comment[:28].ljust(28, '\x00') + '\x00' + chr(track) + chr(genre))
+
+def id3v2_tag(frames = None, padding = 0):
+    """id3v2_tag(frames = None, padding = 0) -> bytearray
+
+    Builds an ID3v2.3 tag of text frames, given as a dict of frame ids and
+    (latin-1) values, followed by padding bytes.
+    """
+    if frames is None:
+        frames = {'TIT2': 'Title', 'TPE1': 'Artist', 'TALB': 'Album', 'TRCK': '1'}
+
+    body = ''.join(name + struct.pack('>IH', len(value) + 1, 0) + '\x00' + value \
+        for name, value in sorted(frames.items())) + '\x00' * padding
+    size = len(body)
+    syncsafe = ''.join(chr(size >> shift & 0x7f) for shift in (21, 14, 7, 0))
+    return bytearray('ID3\x03\x00\x00' + syncsafe + body)
+
+def ape_tag(items = None, header = True):
+    """ape_tag(items = None, header = True) -> bytearray
+
+    Builds an APEv2 tag of text items, given as a dict, with a footer and,
+    if header is True, a header.
+    """
+    if items is None:
+        items = {'Title': 'Title', 'Artist': 'Artist'}
+
+    body = ''.join(struct.pack('<II', len(value), 0) + key + '\x00' + value \
+        for key, value in sorted(items.items()))
+    size = len(body) + 32
+    flags = header and 0x80000000 or 0
+
+    footer = 'APETAGEX' + struct.pack('<IIII', 2000, size, len(items), flags) + '\x00' * 8
+    tag = body + footer
+    if header:
+        tag = 'APETAGEX' + struct.pack('<IIII', 2000, size, len(items), flags | 0x20000000) + \
+            '\x00' * 8 + tag
+    return bytearray(tag)
+
+def riff_wrap(data, samplingrate = 44100, bitrate = 128):
+    """riff_wrap(data, samplingrate = 44100, bitrate = 128) -> bytearray
+
+    Wraps an MPEG stream into a RIFF WAVE file, as some Windows tools do.
+    """
+    # MPEGLAYER3WAVEFORMAT
+    fmt = struct.pack('<HHIIHHHHIHHH', 0x55, 2, samplingrate, bitrate * 1000 / 8, 1, 0, \
+        12, 1, 2, 417, 1, 1393)
+    chunks = 'fmt ' + struct.pack('<I', len(fmt)) + fmt + \
+        'fact' + struct.pack('<II', 4, 0) + 'data' + struct.pack('<I', len(data))
+    return bytearray('RIFF' + struct.pack('<I', 4 + len(chunks) + len(data)) + 'WAVE' + chunks) \
+        + data
+
+def corrupt(data, seed = 0, garbage = 0, garbage_size = 1000, bit_flips = 0, truncate = False):
+    """corrupt(data, seed = 0, garbage = 0, garbage_size = 1000, bit_flips = 0, \\
+        truncate = False) -> bytearray
+
+    Returns a corrupted copy of data: with garbage runs of up to
+    garbage_size random bytes inserted at random positions, bit_flips
+    random bits flipped and, if truncate is True, cut off in its last
+    tenth.
+    """
+    rand = random.Random(seed)
+    data = bytearray(data)
+
+    for position in sorted((rand.randrange(len(data) + 1) for i in xrange(garbage)), \
+        reverse = True):
+        data[position:position] = _random_bytes(rand, rand.randint(1, garbage_size))
+
+    for i in xrange(bit_flips):
+        data[rand.randrange(len(data))] ^= 1 << rand.randrange(8)
+
+    if truncate and data:
+        del data[len(data) - rand.randint(1, max(1, len(data) / 10)):]
+
+    return data
+
+def generate(frames = 1000, version = 1, layer = 3, bitrates = 128, samplingrate = None, \
+    crc = False, xing = False, id3v1 = False, id3v2 = False, ape = False, riff = False, \
+    seed = 0, **corruption):
+    """generate(frames = 1000, version = 1, layer = 3, bitrates = 128, samplingrate = None, \\
+        crc = False, xing = False, id3v1 = False, id3v2 = False, ape = False, riff = False, \\
+        seed = 0, **corruption) -> str
+
+    Builds a complete file: an optional ID3v2 tag, an optional Xing frame
+    and the audio frames (see stream()), followed by optional APE and ID3v1
+    tags. With riff, the audio is wrapped in a RIFF file instead of being
+    tagged. Keyword arguments of corrupt() apply corruption to the result.
+    """
+    data, offsets = stream(frames, version, layer, bitrates, samplingrate, crc = crc, \
+        seed = seed)
+    if xing:
+        data = xing_frame(data, offsets, version, layer, samplingrate, \
+            info = not isinstance(bitrates, (str, list, tuple))) + data
+
+    if riff:
+        data = riff_wrap(data, samplingrate or _DEFAULT_SAMPLINGRATES[version])
+    else:
+        if id3v2:
+            data = id3v2_tag(padding = 256) + data
+        if ape:
+            data += ape_tag()
+        if id3v1:
+            data += id3v1_tag()
+
+    if corruption:
+        data = corrupt(data, seed, **corruption)
+
+    return str(data)